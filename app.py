@@ -1,18 +1,50 @@
-import streamlit as st
+import io
+import os
+import random
 import sys
+from contextlib import nullcontext
 from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent))
+
+import streamlit as st
+
+# st.set_page_config باید اولین فراخوانی streamlit باشد
+st.set_page_config(
+    page_title="سامانه پیشنهاد کتاب",
+    page_icon="📚",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
 from src.book_data import BookDataManager
+from src.concurrency import file_version
+from src.profiling import DEFAULT_KEEP, profile_rerun, profiling_enabled
 from src.recommender import BookRecommender
-from src.utils import *
+from src.validation import VALID_LENGTHS, VALID_STYLES
+from src.utils import (
+    calculate_reading_time,
+    categorize_page_count,
+    generate_reading_report,
+    get_genre_emoji,
+    get_star_display,
+)
 
-sys.path.append(str(Path(__file__).parent))
+
+@st.cache_resource
+def read_static_asset(file_path: str):
+    """خواندن فایل‌های ثابت (CSS و ...) فقط یک بار در هر پروسه"""
+    path = Path(file_path)
+    if not path.exists():
+        return None
+    return path.read_text(encoding="utf-8")
 
 
 def load_css(file_path: str):
     """بارگذاری فایل CSS در Streamlit"""
-    if Path(file_path).exists():
-        with open(file_path, "r", encoding="utf-8") as f:
-            st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    css = read_static_asset(file_path)
+    if css is not None:
+        st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
     else:
         st.warning(f"فایل CSS پیدا نشد: {file_path}")
 
@@ -21,19 +53,177 @@ load_css("style.css")
 @st.cache_resource
 def init_system():
     """مقداردهی سیستم"""
-    book_manager = BookDataManager()
-    recommender = BookRecommender()
+    # BOOK_RECOMMENDER_SHARED_CATALOG=1: share one memory-mapped catalog
+    # between all app/API worker processes on this host
+    # BOOK_RECOMMENDER_CHUNKED_CATALOG=1: read the catalog from compressed
+    # chunks and load descriptions only for the books on screen
+    book_manager = BookDataManager(
+        shared_catalog=os.environ.get("BOOK_RECOMMENDER_SHARED_CATALOG") == "1",
+        chunked_catalog=os.environ.get("BOOK_RECOMMENDER_CHUNKED_CATALOG") == "1"
+    )
+    # BOOK_RECOMMENDER_HALF_LIFE_DAYS=365: a rating loses half of its weight
+    # in the profile every 365 days (unset = all ratings weigh the same)
+    half_life_days = os.environ.get("BOOK_RECOMMENDER_HALF_LIFE_DAYS")
+    recommender = BookRecommender(
+        half_life_days=float(half_life_days) if half_life_days else None,
+        book_manager=book_manager
+    )
+
+    # warm up catalog and profile once per process (not on every rerun)
+    # and check the data files once at startup
+    books_report, ratings_report = book_manager.check_integrity(recommender.load_ratings())
+    books_report.print_errors()
+    ratings_report.print_errors()
+    recommender.load_profile()
     return book_manager, recommender
 
 book_manager, recommender = init_system()
 
 
-st.set_page_config(
-    page_title="سامانه پیشنهاد کتاب",
-    page_icon="📚",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+@st.cache_resource
+def init_sharding():
+    """
+    BOOK_RECOMMENDER_SHARDS=host:port,host:port,...: score on catalog shards
+    (python -m src.sharding) instead of in this process
+    """
+    shards = os.environ.get("BOOK_RECOMMENDER_SHARDS")
+    if not shards:
+        return None
+
+    from src.sharding import ShardedRecommender, SocketTransport
+
+    transports = []
+    for address in shards.split(","):
+        host, port = address.strip().rsplit(":", 1)
+        transports.append(SocketTransport(host, int(port)))
+    return ShardedRecommender(recommender, transports)
+
+coordinator = init_sharding()
+
+
+# ================== کش داده‌ها ==================
+# every read is keyed on the on-disk version (mtime, size) of its file, so a
+# rerun that doesn't change any file (slider move, tab switch, ...) never
+# touches the json files. writes made through the app clear their entries
+# explicitly (see invalidate_*), which also covers same-mtime rewrites.
+
+@st.cache_resource(max_entries=2)
+def _load_books(version):
+    # cache_resource: the catalog is shared by all sessions without copying,
+    # so callers must treat it as read-only
+    return book_manager.load_books()
+
+
+@st.cache_data(max_entries=4)
+def _load_ratings(version):
+    return recommender.load_ratings()
+
+
+@st.cache_data(max_entries=4)
+def _load_profile(version):
+    return recommender.load_profile()
+
+
+@st.cache_resource(max_entries=2)
+def _catalog_views(version):
+    # from the catalog counters; adding a book swaps in an updated copy
+    return {
+        'genres': book_manager.get_all_genres(),
+        'statistics': book_manager.get_statistics(),
+    }
+
+
+@st.cache_data(max_entries=16)
+def _recommendations(books_version, ratings_version, profile_version,
+                     top_n, diversity, seed):
+    options = dict(top_n=top_n, with_breakdown=True, diversity=diversity,
+                   seed=seed, stratify_genres=True)
+    recommendations = None
+    if coordinator is not None:
+        try:
+            recommendations = coordinator.get_recommendations(**options)
+        except Exception as e:
+            # a shard is down: score here, same result (never cache an empty list)
+            print(f"Error {e} while getting sharded recommendations, scoring locally")
+    if recommendations is None:
+        recommendations = recommender.get_recommendations(_load_books(books_version), **options)
+    return [
+        (book, score, recommender.render_explanation(breakdown))
+        for book, score, breakdown in recommendations
+    ]
+
+
+@st.cache_data(max_entries=2)
+def _ratings_csv(books_version, ratings_version):
+    export = io.StringIO()
+    count = recommender.export_ratings(export, file_format="csv")
+    return count, export.getvalue().encode("utf-8")
+
+
+def get_books():
+    return _load_books(file_version(book_manager.books_file))
+
+
+def get_ratings():
+    return _load_ratings(file_version(recommender.ratings_file))
+
+
+def get_profile():
+    return _load_profile(file_version(recommender.profile_file))
+
+
+def get_catalog_views():
+    return _catalog_views(file_version(book_manager.books_file))
+
+
+def get_recommendations(top_n: int, diversity: float = 0.0):
+    # one seed per browser session: cold-start picks differ between
+    # sessions but stay the same across reruns of one session
+    if 'session_seed' not in st.session_state:
+        st.session_state['session_seed'] = random.randrange(2 ** 31)
+
+    return _recommendations(
+        file_version(book_manager.books_file),
+        file_version(recommender.ratings_file),
+        file_version(recommender.profile_file),
+        top_n,
+        diversity,
+        st.session_state['session_seed']
+    )
+
+
+def get_descriptions(books):
+    """توضیحات کتاب‌های روی صفحه؛ در حالت chunked فقط از chunkهای لازم خوانده می‌شود"""
+    books = list(books)
+    descriptions = {b['id']: b['description'] for b in books if 'description' in b}
+    if book_manager.chunked_catalog:
+        descriptions.update(book_manager.get_descriptions(
+            b['id'] for b in books if 'description' not in b
+        ))
+    return descriptions
+
+
+def get_ratings_csv():
+    return _ratings_csv(
+        file_version(book_manager.books_file),
+        file_version(recommender.ratings_file)
+    )
+
+
+def invalidate_ratings():
+    """بعد از ثبت یا حذف امتیاز"""
+    _ratings_csv.clear()
+    _load_ratings.clear()
+    _load_profile.clear()
+    _recommendations.clear()
+
+
+def invalidate_books():
+    """بعد از اضافه کردن کتاب"""
+    _load_books.clear()
+    _catalog_views.clear()
+    _recommendations.clear()
+
 
 def home_page():
     st.markdown("""
@@ -53,9 +243,8 @@ def home_page():
 
 
     # بارگذاری داده‌ها
-    books = book_manager.load_books()
-    ratings = recommender.load_ratings()
-    profile = recommender.load_profile()
+    books = get_books()
+    profile = get_profile()
 
     # نمایش وضعیت
     col1, col2, col3 = st.columns(3)
@@ -75,7 +264,7 @@ def home_page():
     # 🔍 جستجوی کتاب
     search_query = st.text_input("🔎 جستجوی ژانر، کتاب، موضوع یا نویسنده:")
     if search_query:
-        search_results = book_manager.search_books(search_query)
+        search_results = book_manager.search_books(search_query, books)
         if search_results:
             st.subheader(f"نتایج جستجو برای '{search_query}':")
             for book in search_results:
@@ -94,7 +283,7 @@ def home_page():
 
 
 
-    col = st.columns([0.2, 1])[0]  # ستون باریک برای selectbox
+    col, col_diversity = st.columns([0.2, 1])  # ستون باریک برای selectbox
 
     with col:
         num_recommendations = st.selectbox(
@@ -103,13 +292,21 @@ def home_page():
             index=1
         )
 
-    recommendations = recommender.get_recommendations(books, top_n=num_recommendations)
+    with col_diversity:
+        diversity = st.slider(
+            "تنوع پیشنهادات:",
+            0.0, 1.0, 0.0, 0.1,
+            help="مقدار بیشتر = کتاب‌هایی با ژانر، سبک و موضوع متفاوت‌تر"
+        )
+
+    recommendations = get_recommendations(num_recommendations, diversity)
 
     if not recommendations:
         st.warning("همه کتاب‌ها را امتیاز داده‌اید! 🎉")
         st.info("کتاب جدید اضافه کنید تا پیشنهادات جدید دریافت کنید.")
     else:
-        for i, (book, score) in enumerate(recommendations, 1):
+        descriptions = get_descriptions(book for book, _, _ in recommendations)
+        for i, (book, score, explanation) in enumerate(recommendations, 1):
             with st.container():
                 col1, col2 = st.columns([2, 1])
                 with col1:
@@ -118,9 +315,8 @@ def home_page():
                     st.markdown(f"**ژانر:** {book['genre']} | **سبک:** {book['style']}")
                     st.markdown(f"**صفحات:** {book['pages']} ({book['length_category']})")
                     st.markdown(f"**موضوع:** {book['topic']}")
-                    if 'description' in book:
-                        st.markdown(f"*{book['description']}*")
-                    explanation = recommender.explain_recommendation(book)
+                    if book['id'] in descriptions:
+                        st.markdown(f"*{descriptions[book['id']]}*")
                     st.info(f"💭 **چرا این کتاب؟** {explanation}")
                 with col2:
                     st.metric(label="امتیاز پیشبینی", value=f"{score:.1f}", delta=get_star_display(score))
@@ -130,6 +326,7 @@ def home_page():
                         rating = st.slider("امتیاز:", 1.0, 5.0, 3.0, 0.5, key=f"quick_rate_{book['id']}")
                         if st.button("ثبت امتیاز", key=f"submit_{book['id']}"):
                             if recommender.save_rating(book['id'], rating):
+                                invalidate_ratings()
                                 st.success("✅ امتیاز ثبت شد!")
                                 st.rerun()
 
@@ -140,8 +337,9 @@ def rating_page():
     st.title("⭐ امتیازدهی به کتاب‌ها")
     st.markdown("---")
 
-    books = book_manager.load_books()
-    ratings = recommender.load_ratings()
+    books = get_books()
+    ratings = get_ratings()
+    catalog = get_catalog_views()
 
     selected_book_id = st.session_state.get('selected_book_id', None)
 
@@ -160,32 +358,58 @@ def rating_page():
         st.subheader("لیست کتاب‌ها")
 
         # فیلترها
-        col1, col2, col3 = st.columns(3)
+        # the query runs before the widgets are drawn, so each dropdown can
+        # show live counts; the current choices come from session_state
+        all_label = "همه"
+        status_options = {
+            all_label: None,
+            "امتیاز داده نشده": False,
+            "امتیاز داده شده": True,
+        }
+        selected = {
+            field: st.session_state.get(f"filter_{field}", all_label)
+            for field in ('genre', 'length_category', 'style')
+        }
+        result = book_manager.query(
+            text=st.session_state.get("filter_text") or None,
+            filters={f: v for f, v in selected.items() if v != all_label},
+            rated=status_options[st.session_state.get("filter_status", all_label)],
+            ratings=ratings,
+            facets=('genre', 'length_category', 'style')
+        )
+
+        def with_count(field):
+            counts = result['facets'][field]
+            return lambda v: v if v == all_label else f"{v} ({counts.get(v, 0)})"
+
+        st.text_input("🔎 جستجو در عنوان، نویسنده، ژانر یا موضوع:", key="filter_text")
+
+        col1, col2, col3, col4 = st.columns(4)
 
         with col1:
-            genres = ["همه"] + book_manager.get_all_genres()
-            selected_genre = st.selectbox("ژانر:", genres)
+            genres = [all_label] + catalog['genres']
+            st.selectbox("ژانر:", genres, key="filter_genre",
+                         format_func=with_count('genre'))
 
         with col2:
-            lengths = ["همه", "کوتاه", "متوسط", "بلند"]
-            selected_length = st.selectbox("طول:", lengths)
+            lengths = [all_label] + VALID_LENGTHS
+            st.selectbox("طول:", lengths, key="filter_length_category",
+                         format_func=with_count('length_category'))
 
         with col3:
-            styles = ["همه", "ساده", "آکادمیک", "شاعرانه"]
-            selected_style = st.selectbox("سبک:", styles)
-
-        # فیلتر کردن
-        filtered_books = books
-        if selected_genre != "همه":
-            filtered_books = [b for b in filtered_books if b['genre'] == selected_genre]
-        if selected_length != "همه":
-            filtered_books = [b for b in filtered_books if b['length_category'] == selected_length]
-        if selected_style != "همه":
-            filtered_books = [b for b in filtered_books if b['style'] == selected_style]
+            styles = [all_label] + VALID_STYLES
+            st.selectbox("سبک:", styles, key="filter_style",
+                         format_func=with_count('style'))
+
+        with col4:
+            st.selectbox("وضعیت:", list(status_options), key="filter_status")
+
+        filtered_books = result['books']
 
         st.info(f"📊 {len(filtered_books)} کتاب یافت شد")
 
         # نمایش کتاب‌ها
+        descriptions = get_descriptions(filtered_books)
         for book in filtered_books:
             with st.container():
                 col1, col2 = st.columns([3, 1])
@@ -193,8 +417,8 @@ def rating_page():
                 with col1:
                     st.markdown(f"### {get_genre_emoji(book['genre'])} {book['title']}")
                     st.markdown(f"**{book['author']}** | {book['genre']} | {book['pages']} صفحه")
-                    if 'description' in book:
-                        st.markdown(f"*{book['description']}*")
+                    if book['id'] in descriptions:
+                        st.markdown(f"*{descriptions[book['id']]}*")
 
                 with col2:
                     current_rating = ratings.get(book['id'], None)
@@ -212,6 +436,7 @@ def rating_page():
 
                     if st.button("ثبت/ویرایش", key=f"btn_{book['id']}"):
                         if recommender.save_rating(book['id'], new_rating):
+                            invalidate_ratings()
                             st.success("✅ ثبت شد!")
                             st.rerun()
 
@@ -223,8 +448,7 @@ def rating_page():
         if not ratings:
             st.info("هنوز به هیچ کتابی امتیاز نداده‌اید!")
         else:
-            rated_books = [book_manager.get_book_by_id(bid) for bid in ratings.keys()]
-            rated_books = [b for b in rated_books if b]  # حذف None
+            rated_books = [b for b in books if b['id'] in ratings]
 
             # مرتب‌سازی
             sort_order = st.radio(
@@ -253,24 +477,58 @@ def rating_page():
                     )
                     if st.button("حذف", key=f"del_{book['id']}"):
                         # حذف امتیاز
-                        del ratings[book['id']]
-                        import json
-                        with open("data/user_ratings.json", 'w', encoding='utf-8') as f:
-                            json.dump(ratings, f)
-                        recommender._update_profile()
+                        recommender.delete_rating(book['id'])
+                        invalidate_ratings()
                         st.rerun()
 
                 st.markdown("---")
 
 
+def ratings_import_export():
+    """ورود و خروج گروهی امتیازها (CSV / JSONL، مثلاً خروجی Goodreads)"""
+    with st.expander("📥 ورود / خروج امتیازها"):
+        uploaded = st.file_uploader(
+            "فایل امتیازها (CSV یا JSONL):", type=["csv", "jsonl"], key="ratings_upload"
+        )
+        overwrite = st.checkbox("جایگزینی امتیازهای قبلی همان کتاب", value=True)
+
+        if uploaded is not None and st.button("📥 ورود امتیازها"):
+            progress = st.progress(0.0, text="در حال خواندن فایل...")
+            result = recommender.import_ratings(
+                uploaded,
+                progress_callback=lambda fraction, _: progress.progress(fraction),
+                overwrite=overwrite
+            )
+            invalidate_ratings()
+
+            st.success(f"✅ {result['imported']} امتیاز وارد شد")
+            if result['skipped']:
+                st.info(f"{result['skipped']} ردیف بدون امتیاز نادیده گرفته شد")
+            if result['unmatched']:
+                st.warning(f"{len(result['unmatched'])} کتاب در کتابخانه پیدا نشد "
+                           f"(ردیف‌ها: {', '.join(map(str, result['unmatched'][:20]))})")
+            for error in result['errors'][:20]:
+                st.caption(f"• ردیف {error['row']}: {error['message']}")
+
+        count, data = get_ratings_csv()
+        st.download_button(
+            f"📤 خروجی CSV ({count} امتیاز)",
+            data=data,
+            file_name="ratings.csv",
+            mime="text/csv"
+        )
+
+
 def profile_page():
     """صفحه پروفایل کاربر"""
     st.title("👤 پروفایل من")
     st.markdown("---")
 
-    profile = recommender.load_profile()
-    ratings = recommender.load_ratings()
-    books = book_manager.load_books()
+    profile = get_profile()
+    ratings = get_ratings()
+    books = get_books()
+
+    ratings_import_export()
 
     if profile['total_ratings'] == 0:
         st.info("هنوز پروفایلی ایجاد نشده! لطفاً به کتاب‌ها امتیاز دهید.")
@@ -299,12 +557,13 @@ def profile_page():
     st.markdown("---")
 
     # ترجیحات
+    import pandas as pd
+
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("🏷️ ژانرهای مورد علاقه")
         if profile['genre_preferences']:
-            import pandas as pd
             genre_df = pd.DataFrame([
                 {"ژانر": k, "امتیاز میانگین": v}
                 for k, v in sorted(
@@ -318,7 +577,6 @@ def profile_page():
     with col2:
         st.subheader("✨ سبک‌های مورد علاقه")
         if profile['style_preferences']:
-            import pandas as pd
             style_df = pd.DataFrame([
                 {"سبک": k, "امتیاز میانگین": v}
                 for k, v in sorted(
@@ -334,7 +592,7 @@ def profile_page():
     # نمودار
     st.subheader("📈 توزیع امتیازات")
 
-    stats = recommender.get_rating_statistics()
+    stats = recommender.get_rating_statistics(ratings)
     if stats['total'] > 0:
         import plotly.graph_objects as go
 
@@ -372,12 +630,12 @@ def add_book_page():
             year = st.number_input("سال انتشار *", min_value=-1000, max_value=2025, value=2020)
 
         with col2:
-            genres = book_manager.get_all_genres()
+            genres = get_catalog_views()['genres']
             genre = st.selectbox("ژانر *", genres + ["سایر"])
             if genre == "سایر":
                 genre = st.text_input("ژانر جدید:")
 
-            style = st.selectbox("سبک نگارش *", ["ساده", "آکادمیک", "شاعرانه"])
+            style = st.selectbox("سبک نگارش *", VALID_STYLES)
             length = categorize_page_count(pages)
             # st.markdown(f"**طول کتاب:** {length}")  # نمایش طول محاسبه شده
             topic = st.text_input("موضوع اصلی *")
@@ -405,10 +663,14 @@ def add_book_page():
                 if description:
                     new_book['description'] = description
 
-                if book_manager.add_book(new_book):
+                report = book_manager.add_books([new_book])
+                if report.ok:
+                    invalidate_books()
                     st.success(f"✅ کتاب '{title}' با موفقیت اضافه شد!")
                 else:
                     st.error("❌ خطا در اضافه کردن کتاب!")
+                    for error in report.errors:
+                        st.caption(f"• {error['field']}: {error['message']}")
 
 
 # ================== صفحه آمار ==================
@@ -417,7 +679,7 @@ def statistics_page():
     st.title("📊 آمار سیستم")
     st.markdown("---")
 
-    stats = book_manager.get_statistics()
+    stats = get_catalog_views()['statistics']
 
     if not stats:
         st.warning("هیچ داده‌ای موجود نیست!")
@@ -467,6 +729,24 @@ def statistics_page():
         st.plotly_chart(fig2, use_container_width=True)
 
 
+def page_profiler(page_name: str):
+    """
+    sampling profiler for one rerun of a page, off unless
+    BOOK_RECOMMENDER_PROFILE=1 (or =url and the url has ?profile=1)
+    files go to BOOK_RECOMMENDER_PROFILE_DIR (default: profiles/), the
+    newest BOOK_RECOMMENDER_PROFILE_KEEP (default: 50) reruns are kept
+    """
+    if not profiling_enabled(st.query_params):
+        return nullcontext()
+    interval_ms = os.environ.get("BOOK_RECOMMENDER_PROFILE_INTERVAL_MS")
+    return profile_rerun(
+        page_name,
+        out_dir=os.environ.get("BOOK_RECOMMENDER_PROFILE_DIR", "profiles"),
+        interval=float(interval_ms) / 1000 if interval_ms else 0.005,
+        keep=int(os.environ.get("BOOK_RECOMMENDER_PROFILE_KEEP", DEFAULT_KEEP)),
+    )
+
+
 def main():
     st.sidebar.title("📚منوی اصلی")
     st.sidebar.markdown("---")
@@ -489,16 +769,16 @@ def main():
     """)
 
     # نمایش صفحه مربوطه
-    if menu == "🏠 خانه":
-        home_page()
-    elif menu == "⭐ امتیازدهی":
-        rating_page()
-    elif menu == "👤 پروفایل من":
-        profile_page()
-    elif menu == "➕ اضافه کردن کتاب":
-        add_book_page()
-    elif menu == "📊 آمار":
-        statistics_page()
+    pages = {
+        "🏠 خانه": home_page,
+        "⭐ امتیازدهی": rating_page,
+        "👤 پروفایل من": profile_page,
+        "➕ اضافه کردن کتاب": add_book_page,
+        "📊 آمار": statistics_page,
+    }
+    page = pages[menu]
+    with page_profiler(page.__name__):
+        page()
 
 
 if __name__ == "__main__":
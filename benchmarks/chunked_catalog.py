@@ -0,0 +1,81 @@
+"""
+books.json vs the chunked catalog: bytes on disk, and time / peak memory of
+the common path (load catalog, statistics, recommendations) plus showing the
+descriptions of one page of cards (peak RSS from /proc, Linux only)
+
+each case runs in a fresh process so nothing is cached between them.
+
+usage: python benchmarks/chunked_catalog.py [n_books]
+"""
+import multiprocessing as mp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.memory import peak_rss_kb
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.recommender import BookRecommender
+
+
+def common_path(data_dir, chunked: bool, results):
+    start = time.perf_counter()
+
+    manager = BookDataManager(data_dir, chunked_catalog=chunked)
+    recommender = BookRecommender(data_dir, book_manager=manager)
+    books = manager.load_books()
+    manager.get_statistics(books)
+    recommendations = recommender.get_recommendations(books, top_n=10)
+    scored = time.perf_counter()
+
+    # like app.get_descriptions: books.json books carry their description
+    page = [book for book, _ in recommendations]
+    descriptions = {b['id']: b['description'] for b in page if 'description' in b}
+    if chunked:
+        descriptions.update(manager.get_descriptions(b['id'] for b in page))
+    done = time.perf_counter()
+
+    peak = peak_rss_kb() * 1024
+    results.put((scored - start, done - scored, peak, len(descriptions)))
+
+
+def run(data_dir, chunked: bool):
+    # spawn: a forked child would inherit (and count) the parent's memory
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=common_path, args=(data_dir, chunked, results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(n_books))
+        recommender = BookRecommender(data_dir)
+        for book_id, rating in synthetic_ratings(n_books, 20).items():
+            recommender.save_rating(book_id, rating)
+        BookDataManager(data_dir, chunked_catalog=True).load_books()  # publish
+
+        json_size = (data_dir/"books.json").stat().st_size
+        hot_size = sum(p.stat().st_size for p in (data_dir/"catalog").glob("hot-*.json.gz"))
+        cold_size = sum(p.stat().st_size for p in (data_dir/"catalog").glob("cold-*.json.gz"))
+        print(f"{n_books} books on disk: books.json {json_size / 2**20:.1f} MB, "
+              f"chunked hot {hot_size / 2**20:.1f} MB + cold {cold_size / 2**20:.1f} MB")
+
+        print(f"{'layout':>8} {'score+stats (s)':>16} {'descriptions (ms)':>18} {'peak RSS (MB)':>14}")
+        for name, chunked in (('json', False), ('chunked', True)):
+            scored, described, peak, _ = run(data_dir, chunked)
+            print(f"{name:>8} {scored:>16.2f} {described * 1000:>18.1f} {peak / 2**20:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+cold-start timing report for app.py
+
+- import time per module (python -X importtime, in a fresh interpreter)
+- time-to-first-render of app.py (streamlit AppTest, fresh interpreter)
+
+the app runs on a copy of the working tree in a temporary directory, so
+the lock files, caches and precomputed lists it writes to data/ stay out
+of the repository. with --baseline REV the same is measured on a checkout
+of that git revision (git archive into another temporary directory) and
+printed next to the current tree, e.g. --baseline f3c0af6 for the code
+before the deferred imports and asset caches.
+
+usage: python benchmarks/cold_start.py [--baseline REV]
+"""
+import argparse
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    'streamlit',
+    'numpy',
+    'pandas',
+    'plotly.graph_objects',
+    'src.book_data',
+    'src.recommender',
+    'src.utils',
+]
+
+FIRST_RENDER_SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app!r}, default_timeout=120)
+at.run()
+t1 = time.perf_counter()
+heavy = [m for m in ('numpy', 'pandas', 'plotly') if m in sys.modules]
+print(f"{{t1 - t0:.3f}}|{{','.join(heavy)}}|{{len(at.exception)}}")
+"""
+
+
+def import_time(module: str, root: Path) -> float:
+    """cumulative import time (seconds) of a module in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=root, capture_output=True, text=True
+    )
+    for line in reversed(result.stderr.splitlines()):
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return float('nan')
+
+
+def first_render(root: Path) -> str:
+    result = subprocess.run(
+        [sys.executable, '-c', FIRST_RENDER_SCRIPT.format(app=str(root / 'app.py'))],
+        cwd=root, capture_output=True, text=True
+    )
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        return f"failed: {result.stderr.strip().splitlines()[-1:]}"
+    seconds, heavy, errors = lines[-1].split('|')
+    return (f"{float(seconds):.3f}s (heavy modules loaded: {heavy or '-'}, "
+            f"exceptions: {errors})")
+
+
+def copy_working_tree(target: Path):
+    """tracked and untracked (not ignored) files as they are now, in target"""
+    files = subprocess.run(
+        ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout.split('\0')
+    for name in filter(None, files):
+        source = ROOT / name
+        if source.is_file():  # deleted but not yet staged
+            (target / name).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(source, target / name)
+
+
+def checkout(revision: str, target: Path):
+    """the tree of a git revision (code and tracked data) in target"""
+    archive = target / 'tree.tar'
+    subprocess.run(['git', 'archive', '--output', str(archive), revision], cwd=ROOT, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(target)
+    archive.unlink()
+
+
+def report(roots):
+    """roots: [(label, path), ...], one column each"""
+    labels = "".join(f"{label:>14}" for label, _ in roots)
+    print("import time per module (cumulative, fresh interpreter, ms)")
+    print(f"  {'':<24}{labels}")
+    for module in MODULES:
+        times = "".join(f"{import_time(module, root) * 1000:14.1f}" for _, root in roots)
+        print(f"  {module:<24}{times}")
+
+    print()
+    print("time-to-first-render (app.py)")
+    for label, root in roots:
+        print(f"  {label}: {first_render(root)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold-start timing report for app.py")
+    parser.add_argument('--baseline', help="git revision to compare against, e.g. f3c0af6")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        current = Path(tmp) / 'current'
+        copy_working_tree(current)
+        roots = [('current', current)]
+        if args.baseline:
+            baseline = Path(tmp) / 'baseline'
+            baseline.mkdir()
+            checkout(args.baseline, baseline)
+            roots.insert(0, (args.baseline, baseline))
+        report(roots)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+many threads on one BookRecommender + BookDataManager, the way Streamlit
+sessions share them through cache_resource
+
+- rating threads: each saves ratings for its own books, some books every
+  thread rates (last write wins), and a few ratings it deletes again
+- a catalog thread adds books
+- reader threads: load_snapshot / load_profile / get_recommendations and
+  catalog queries, checking every profile they see against its ratings
+
+at the end the ratings on disk must be exactly what the threads wrote (no
+lost ratings), the profile must equal one rebuilt from them, and the
+catalog index / statistics must match a rebuild.
+
+with n_processes > 1 every process runs this set of threads on the same
+data directory and user (several app workers): the file locks of
+src/concurrency.py must keep ratings and book ids from being lost or
+handed out twice across processes too.
+
+usage: python benchmarks/concurrency_stress.py [n_writers] [n_readers] [ratings_per_writer] [half_life_days] [n_processes]
+"""
+import math
+import multiprocessing as mp
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import synthetic_books
+from src.book_data import BookDataManager
+from src.recommender import BookRecommender
+
+N_BOOKS = 2000
+SHARED_BOOKS = 10  # rated by every writer
+N_ADDED_BOOKS = 50
+
+
+def same(a, b, tolerance=1e-4) -> bool:
+    """equal dicts / lists / numbers, floats up to a relative tolerance"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k], tolerance) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(same(x, y, tolerance) for x, y in zip(a, b))
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=tolerance, abs_tol=tolerance)
+    return a == b
+
+
+def torn(ratings, profile) -> str:
+    """why a profile can't belong to these ratings, '' if it can"""
+    if profile['total_ratings'] != len(ratings):
+        return f"profile has {profile['total_ratings']} ratings, snapshot {len(ratings)}"
+    if ratings and 'decay' not in profile:
+        average = sum(ratings.values()) / len(ratings)
+        if not math.isclose(profile['average_rating'], average, rel_tol=1e-9):
+            return f"profile average {profile['average_rating']}, ratings average {average}"
+    return ''
+
+
+def stress(data_dir, p, n_writers, n_readers, per_writer, half_life_days, results=None):
+    """one process' threads; writers of process p rate their own range of books"""
+    manager = BookDataManager(data_dir)
+    recommender = BookRecommender(data_dir, half_life_days=half_life_days, book_manager=manager)
+
+    problems = []
+    counts = {'writes': 0, 'reads': 0, 'queries': 0}
+    expected = {}  # book_id -> rating
+    done = threading.Event()
+    guard = threading.Lock()
+
+    def report(problem):
+        with guard:
+            if len(problems) < 20:
+                problems.append(problem)
+
+    def writer(w):
+        first = SHARED_BOOKS + 1 + (p * n_writers + w) * per_writer
+        for n, book_id in enumerate(range(first, first + per_writer)):
+            rating = 1 + (book_id + w) % 9 / 2
+            if not recommender.save_rating(book_id, rating):
+                report(f"save_rating({book_id}) failed")
+            if n % 5 == 0:
+                shared = 1 + n // 5 % SHARED_BOOKS
+                recommender.save_rating(shared, 1 + w % 9 / 2)
+            if n % 7 == 3:
+                if not recommender.delete_rating(book_id):
+                    report(f"delete_rating({book_id}) found nothing to delete")
+                rating = None
+            with guard:
+                counts['writes'] += 1
+                if rating is not None:
+                    expected[book_id] = rating
+
+    def catalog_writer():
+        for i in range(N_ADDED_BOOKS):
+            book = dict(synthetic_books(1, seed=i)[0], title=f"کتاب افزوده {p}-{i}")
+            del book['id']
+            if not manager.add_book(book):
+                report(f"add_book {i} failed")
+
+    def reader(r):
+        books = manager.load_books()
+        while not done.is_set():
+            try:
+                ratings, profile = recommender.load_snapshot()
+                problem = torn(ratings, profile)
+                if problem:
+                    report(f"torn snapshot: {problem}")
+                recommender.load_profile()
+                if r % 2:
+                    recommender.get_recommendations(books, top_n=5, diversity=0.3 * (r % 3))
+                else:
+                    total = manager.query(text='کتاب', facets=['genre'])['total']
+                    statistics = manager.get_statistics()
+                    if statistics['total_books'] < total:
+                        report(f"statistics older than the index: {statistics['total_books']} < {total}")
+                    with guard:
+                        counts['queries'] += 1
+                with guard:
+                    counts['reads'] += 1
+            except Exception as e:
+                report(f"reader {r}: {type(e).__name__}: {e}")
+
+    writers = [threading.Thread(target=writer, args=(w,)) for w in range(n_writers)]
+    writers.append(threading.Thread(target=catalog_writer))
+    readers = [threading.Thread(target=reader, args=(r,)) for r in range(n_readers)]
+
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    problems += manager.check_consistency()
+    result = {'expected': expected, 'problems': problems, 'counts': counts}
+    if results is not None:
+        results.put(result)
+    return result
+
+
+def main():
+    n_writers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    per_writer = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+    half_life_days = float(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] != '-' else None
+    n_processes = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        BookDataManager(data_dir).save_books(synthetic_books(N_BOOKS))
+        arguments = (n_writers, n_readers, per_writer, half_life_days)
+
+        start = time.perf_counter()
+        if n_processes == 1:
+            results = [stress(data_dir, 0, *arguments)]
+        else:
+            ctx = mp.get_context('spawn')
+            queue = ctx.Queue()
+            processes = [ctx.Process(target=stress, args=(data_dir, p, *arguments, queue))
+                         for p in range(n_processes)]
+            for process in processes:
+                process.start()
+            results = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+        elapsed = time.perf_counter() - start
+
+        problems = [problem for result in results for problem in result['problems']]
+        expected = {}
+        for result in results:
+            expected.update(result['expected'])
+        counts = {key: sum(result['counts'][key] for result in results) for key in results[0]['counts']}
+
+        # what must be on disk: own books as written, shared books rated by someone
+        recommender = BookRecommender(data_dir, half_life_days=half_life_days)
+        ratings = recommender._read_ratings_file()
+        own = {book_id: r for book_id, r in ratings.items() if book_id > SHARED_BOOKS}
+        lost = set(expected) - set(own)
+        if lost:
+            problems.append(f"{len(lost)} lost ratings, e.g. {sorted(lost)[:5]}")
+        if own != {book_id: expected[book_id] for book_id in own if book_id in expected}:
+            problems.append("ratings on disk differ from the last ones written")
+        if len(own) != len(expected):
+            problems.append(f"{len(own)} own-book ratings on disk, {len(expected)} expected")
+
+        profile = recommender.load_profile()
+        with recommender._writing():
+            recommender._update_profile()
+        if not same(profile, recommender.load_profile()):
+            problems.append("profile differs from one rebuilt from the final ratings")
+
+        manager = BookDataManager(data_dir)
+        books = manager.load_books()
+        n_books = N_BOOKS + N_ADDED_BOOKS * n_processes
+        if len(books) != n_books or len({b['id'] for b in books}) != len(books):
+            problems.append(f"catalog has {len(books)} books / {len({b['id'] for b in books})} ids, "
+                            f"expected {n_books}")
+        problems += manager.check_consistency()
+
+        print(f"{n_processes} x ({n_writers} writers, {n_readers} readers), decay={half_life_days}: "
+              f"{counts['writes']} rating writes, {N_ADDED_BOOKS * n_processes} added books, "
+              f"{counts['reads']} reads ({counts['queries']} catalog queries) in {elapsed:.1f} s")
+        print(f"writes/s: {counts['writes'] / elapsed:.0f}, reads/s: {counts['reads'] / elapsed:.0f}")
+        print(f"problems: {problems or 'none'}")
+        return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
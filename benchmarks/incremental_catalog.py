@@ -0,0 +1,110 @@
+"""
+cost of keeping the derived catalog structures (index, statistics, popularity
+ranking) up to date when a book is added or edited: rebuild vs apply the
+change, and a consistency check of the incremental state against a rebuild
+at the end
+
+also the whole BookDataManager.add_book per storage mode. that is still
+O(catalog): books.json is rewritten (and the shared / chunked copy
+republished) on every add, only the derived structures are incremental
+
+usage: python benchmarks/incremental_catalog.py [n_books] [n_added]
+"""
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import GENRES, synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.catalog_feed import CatalogStats
+from src.catalog_index import CatalogIndex
+from src.popularity import PopularityRanking
+from src.recommender import BAYESIAN_M
+
+
+MODES = {
+    'json': {},
+    'shared': {'shared_catalog': True},
+    'chunked': {'chunked_catalog': True},
+}
+ADD_BOOK_RUNS = 3
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_added = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        with open(data_dir/"user_ratings.json", 'w', encoding='utf-8') as f:
+            json.dump(synthetic_ratings(n_books, 1000), f)
+        books = synthetic_books(n_books)
+        added = synthetic_books(n_books + n_added)[n_books:]
+
+        index = CatalogIndex(list(books))
+        stats = CatalogStats(books)
+        popularity = PopularityRanking.build(data_dir, books, BAYESIAN_M)
+
+        start = time.perf_counter()
+        catalog = list(books)
+        for book in added[:10]:
+            catalog.append(book)
+            CatalogIndex(catalog)
+            CatalogStats(catalog)
+            PopularityRanking.build(data_dir, catalog, BAYESIAN_M)
+        rebuild = (time.perf_counter() - start) / 10
+
+        start = time.perf_counter()
+        for position, book in enumerate(added, n_books):
+            change = {'op': 'add', 'position': position, 'book': book, 'old': None}
+            index = index.apply(change)
+            stats = stats.apply(change)
+            popularity = popularity.apply(change)
+        incremental = (time.perf_counter() - start) / n_added
+
+        # edits move books to another genre (index chunk copy, popularity overlay)
+        catalog = books + added
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for _ in range(n_added):
+            position = rng.randrange(len(catalog))
+            old = catalog[position]
+            book = dict(old, genre=rng.choice(GENRES), pages=old['pages'] + 1)
+            change = {'op': 'edit', 'position': position, 'book': book, 'old': old}
+            catalog[position] = book
+            index = index.apply(change)
+            stats = stats.apply(change)
+            popularity = popularity.apply(change)
+        edited = (time.perf_counter() - start) / n_added
+
+        problems = []
+        if index.snapshot() != CatalogIndex(catalog).snapshot():
+            problems.append('index')
+        if stats.snapshot() != CatalogStats(catalog).snapshot():
+            problems.append('statistics')
+        problems += popularity.differences(PopularityRanking.build(data_dir, catalog, BAYESIAN_M))
+
+        print(f"{n_books} books, per added book: rebuild {rebuild * 1000:.1f} ms, "
+              f"incremental {incremental * 1000:.3f} ms; per edit: incremental {edited * 1000:.3f} ms")
+        print(f"consistency after {n_added} additions and {n_added} edits: {problems or 'ok'}")
+
+        for mode, options in MODES.items():
+            BookDataManager(data_dir/mode).save_books(books)
+            manager = BookDataManager(data_dir/mode, **options)
+            manager.load_books()  # publish the shared / chunked copy
+            manager.get_index()
+            manager.get_catalog_stats()
+            start = time.perf_counter()
+            for book in added[:ADD_BOOK_RUNS]:
+                manager.add_book({k: v for k, v in book.items() if k != 'id'})
+            seconds = (time.perf_counter() - start) / ADD_BOOK_RUNS
+            print(f"add_book ({mode}, writes the whole catalog): {seconds * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
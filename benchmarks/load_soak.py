@@ -0,0 +1,349 @@
+"""
+load / soak test: simulated app users on a synthetic data directory
+
+every session is a thread that keeps going through the pages and calls the
+core functions the page calls (the catalog is cached by file version as in
+app.py, everything else is computed per request like a cache miss):
+- home: load_snapshot, get_recommendations (breakdowns, diversity, a
+  session seed) + explanations, sometimes search_books
+- rating: catalog views, query with random filters / text / rated status,
+  then save_rating or delete_rating of a listed book
+- profile: load_profile, load_ratings, generate_reading_report,
+  get_rating_statistics, sometimes export_ratings
+- statistics: get_statistics, get_all_genres
+
+each process shares one BookDataManager and one BookRecommender per user
+between its threads, as Streamlit's cache_resource does. by default a
+user's sessions all run in one process; with --shared-users they are
+spread over all processes (one user in several app workers: the file
+locks of src/concurrency.py must keep their writes from getting lost). a
+session only writes ratings of its own share of book ids, so the final
+ratings are known. process 0 also adds a book every --add-interval seconds.
+
+reports throughput, latency percentiles and errors per page, throughput
+and p95 per interval (a drift over a long run = a leak or a growing cost),
+peak memory per process and integrity checks:
+- every snapshot a session read had a profile matching its ratings
+- ratings on disk = what the sessions wrote last, profiles = the profile
+  of a new user importing the exported ratings
+- recommendations from the materialized lists = scoring the catalog
+- catalog: ids unique, no lost books; index and statistics = a rebuild
+
+usage: python benchmarks/load_soak.py [--duration 60] [--processes 2] [--threads 8]
+           [--users 8] [--books 20000] [--think 0.05] [--add-interval 2] [--shared-users]
+"""
+import argparse
+import io
+import multiprocessing as mp
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.concurrency_stress import same, torn
+from benchmarks.memory import peak_rss_kb
+from benchmarks.synthetic import GENRES, LENGTHS, STYLES, synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.concurrency import file_version
+from src.recommender import BookRecommender
+from src.utils import generate_reading_report
+
+# compared between the materialized lists and scoring the catalog
+RECOMMENDATION_SETTINGS = [
+    {'top_n': 20},
+    {'top_n': 10, 'diversity': 0.5, 'seed': 1},
+]
+PAGES = {'home': 4, 'rating': 3, 'profile': 2, 'statistics': 1}  # page -> weight
+SEARCH_TERMS = ['کتاب', 'نویسنده 1', 'موضوع 4', 'علمی']
+
+
+class Process:
+    """what one worker process shares between its sessions"""
+    def __init__(self, data_dir, users):
+        self.manager = BookDataManager(data_dir)
+        self.recommenders = {u: BookRecommender(data_dir, user_id=f"user{u}", book_manager=self.manager)
+                             for u in users}
+        self._books = None
+
+    def books(self):
+        # app.py's _load_books: cached until books.json changes
+        version = file_version(self.manager.books_file)
+        cached = self._books
+        if cached is None or cached[0] != version:
+            cached = (version, self.manager.load_books())
+            self._books = cached
+        return cached[1]
+
+
+class Session:
+    def __init__(self, process: Process, user: int, share: int, shares: int,
+                 seed_ratings, seed: int):
+        self.process = process
+        self.recommender = process.recommenders[user]
+        self.user = user
+        self.share, self.shares = share, shares
+        self.rng = random.Random(seed)
+        self.session_seed = seed
+        # ratings this session is responsible for, as they must end up on disk
+        self.expected = {b: r for b, r in seed_ratings.items() if b % shares == share}
+        self.problems = []
+
+    def home(self):
+        ratings, profile = self.recommender.load_snapshot()
+        problem = torn(ratings, profile)
+        if problem:
+            self.problems.append(f"user{self.user}: torn snapshot: {problem}")
+        books = self.process.books()
+        recommendations = self.recommender.get_recommendations(
+            books, top_n=self.rng.choice([5, 10, 15]), with_breakdown=True,
+            diversity=self.rng.choice([0.0, 0.0, 0.3, 0.7]), seed=self.session_seed
+        )
+        for _, _, breakdown in recommendations:
+            self.recommender.render_explanation(breakdown)
+        if self.rng.random() < 0.2:
+            self.process.manager.search_books(self.rng.choice(SEARCH_TERMS), books)
+
+    def rating(self) -> bool:
+        manager = self.process.manager
+        ratings = self.recommender.load_ratings()
+        manager.get_all_genres()
+        manager.get_statistics()
+        filters = {}
+        if self.rng.random() < 0.5:
+            filters['genre'] = self.rng.choice(GENRES)
+        if self.rng.random() < 0.3:
+            filters['length_category'] = self.rng.choice(LENGTHS)
+        if self.rng.random() < 0.3:
+            filters['style'] = self.rng.choice(STYLES)
+        result = manager.query(
+            text=self.rng.choice(SEARCH_TERMS) if self.rng.random() < 0.3 else None,
+            filters=filters, rated=self.rng.choice([None, None, True, False]),
+            ratings=ratings, facets=('genre', 'length_category', 'style')
+        )
+
+        mine = [b['id'] for b in result['books'][:200] if b['id'] % self.shares == self.share]
+        if not mine:
+            return True
+        book_id = self.rng.choice(mine)
+        if book_id in self.expected and self.rng.random() < 0.3:
+            ok = self.recommender.delete_rating(book_id)
+            self.expected.pop(book_id, None)
+        else:
+            rating = self.rng.choice([1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5, 5])
+            ok = self.recommender.save_rating(book_id, rating)
+            if ok:
+                self.expected[book_id] = rating
+        return ok
+
+    def profile(self):
+        profile = self.recommender.load_profile()
+        ratings = self.recommender.load_ratings()
+        generate_reading_report(ratings, self.process.books())
+        self.recommender.get_rating_statistics(ratings)
+        if profile['total_ratings'] and self.rng.random() < 0.1:
+            self.recommender.export_ratings(io.StringIO(), file_format="csv")
+
+    def statistics(self):
+        self.process.manager.get_statistics()
+        self.process.manager.get_all_genres()
+
+
+def run_session(session: Session, start: float, end: float, think: float, results):
+    pages, weights = list(PAGES), list(PAGES.values())
+    while time.time() < end:
+        page = session.rng.choices(pages, weights)[0]
+        began = time.perf_counter()
+        try:
+            ok = getattr(session, page)()
+            error = None if ok is not False else f"{page}: a save / delete failed"
+        except Exception as e:
+            error = f"{page}: {type(e).__name__}: {e}"
+        results.append((page, time.time() - start, time.perf_counter() - began, error))
+        if think:
+            time.sleep(session.rng.uniform(0, 2 * think))
+
+
+def add_books(manager: BookDataManager, start: float, end: float, interval: float, results, added):
+    i = 0
+    while time.time() + interval < end:
+        time.sleep(interval)
+        book = synthetic_books(1, seed=10_000 + i)[0]
+        del book['id']
+        book['title'] = f"کتاب افزوده {i}"
+        began = time.perf_counter()
+        ok = manager.add_book(book)
+        results.append(('add_book', time.time() - start, time.perf_counter() - began,
+                        None if ok else "add_book failed"))
+        added.append(ok)
+        i += 1
+
+
+def assignment(p: int, args) -> list:
+    """(user, share, shares) of each session of process p"""
+    if args.shared_users:
+        # sessions numbered over all processes, users dealt out round robin
+        total = args.processes * args.threads
+        return [(g % args.users, g // args.users, len(range(g % args.users, total, args.users)))
+                for g in range(p * args.threads, (p + 1) * args.threads)]
+    users = [u for u in range(args.users) if u % args.processes == p]
+    return [(users[t % len(users)], t // len(users), len(range(t % len(users), args.threads, len(users))))
+            for t in range(args.threads)]
+
+
+def worker(p: int, args, data_dir, barrier, queue):
+    sessions = assignment(p, args)
+    process = Process(data_dir, sorted({user for user, _, _ in sessions}))
+    sessions = [Session(process, user, share, shares, process.recommenders[user].load_ratings(),
+                        seed=p * 1000 + t)
+                for t, (user, share, shares) in enumerate(sessions)]
+
+    # warm up like a running app: index, statistics, every user's list
+    process.manager.get_index()
+    process.manager.get_statistics()
+    for recommender in process.recommenders.values():
+        recommender.get_recommendations(process.books())
+
+    barrier.wait()
+    start = time.time()
+    end = start + args.duration
+    results, added = [], []
+    threads = [threading.Thread(target=run_session, args=(s, start, end, args.think, results))
+               for s in sessions]
+    if p == 0 and args.add_interval:
+        threads.append(threading.Thread(target=add_books,
+                                        args=(process.manager, start, end, args.add_interval, results, added)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    problems = [problem for s in sessions for problem in s.problems[:5]]
+    problems += process.manager.check_consistency()
+
+    expected = {}
+    for s in sessions:
+        expected.setdefault(s.user, {}).update(s.expected)
+    queue.put({'results': results, 'added': sum(added), 'problems': problems,
+               'expected': expected, 'peak_rss_kb': peak_rss_kb()})
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load / soak test of the recommender core")
+    parser.add_argument('--duration', type=float, default=60, help="seconds")
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help="sessions per process")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--books', type=int, default=20_000)
+    parser.add_argument('--ratings', type=int, default=20, help="initial ratings per user")
+    parser.add_argument('--think', type=float, default=0.05, help="mean pause between pages, s")
+    parser.add_argument('--add-interval', type=float, default=2.0, help="s between added books, 0 = none")
+    parser.add_argument('--shared-users', action='store_true',
+                        help="spread each user's sessions over all processes")
+    args = parser.parse_args()
+    fewest = 1 if args.shared_users else args.processes
+    args.users = max(fewest, min(args.users, args.processes * args.threads))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(args.books))
+        for u in range(args.users):
+            recommender = BookRecommender(data_dir, user_id=f"user{u}", book_manager=manager)
+            lines = "".join(f"{book_id},{rating}\n" for book_id, rating in
+                            synthetic_ratings(args.books, args.ratings, seed=u).items())
+            recommender.import_ratings(io.BytesIO(f"book_id,rating\n{lines}".encode()), file_format='csv')
+
+        ctx = mp.get_context('spawn')
+        barrier = ctx.Barrier(args.processes + 1)
+        queue = ctx.Queue()
+        processes = [ctx.Process(target=worker, args=(p, args, data_dir, barrier, queue))
+                     for p in range(args.processes)]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        reports = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        results = [r for report in reports for r in report['results']]
+        problems = [problem for report in reports for problem in report['problems']]
+
+        # what is on disk after the run
+        expected = {}
+        for report in reports:
+            for u, ratings in report['expected'].items():
+                expected.setdefault(u, {}).update(ratings)
+        manager = BookDataManager(data_dir)
+        books = manager.load_books()
+        for u, ratings in sorted(expected.items()):
+            recommender = BookRecommender(data_dir, user_id=f"user{u}", book_manager=manager)
+            on_disk = recommender.load_ratings()
+            if on_disk != ratings:
+                lost = len(set(ratings) - set(on_disk))
+                problems.append(f"user{u}: ratings on disk differ from the last ones written "
+                                f"({lost} missing, {len(on_disk)} on disk, {len(ratings)} expected)")
+
+            exported = io.StringIO()
+            recommender.export_ratings(exported, file_format="csv")
+            rebuild = BookRecommender(data_dir, user_id=f"rebuild{u}", book_manager=manager,
+                                      materialize_top=0)
+            rebuild.import_ratings(io.BytesIO(exported.getvalue().encode()), file_format='csv')
+            if not same(recommender.load_profile(), rebuild.load_profile()):
+                problems.append(f"user{u}: profile differs from a rebuild")
+            for settings in RECOMMENDATION_SETTINGS:
+                if recommender.get_recommendations(books, **settings) != \
+                        rebuild.get_recommendations(books, **settings):
+                    problems.append(f"user{u}: materialized recommendations {settings} "
+                                    f"differ from scoring the catalog")
+
+        problems += manager.check_consistency()
+        n_added = sum(report['added'] for report in reports)
+        if len(books) != args.books + n_added or len({b['id'] for b in books}) != len(books):
+            problems.append(f"catalog: {len(books)} books, {len({b['id'] for b in books})} ids, "
+                            f"{args.books + n_added} expected")
+
+    print(f"{args.processes} processes × {args.threads} sessions, {args.users} users"
+          f"{' (shared by the processes)' if args.shared_users else ''}, "
+          f"{args.books} books, {args.duration:.0f} s, think {args.think * 1000:.0f} ms")
+    print(f"{'page':<11}{'requests':>9}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+    for page in list(PAGES) + ['add_book', 'total']:
+        rows = [r for r in results if page in (r[0], 'total')]
+        if not rows:
+            continue
+        latencies = [r[2] for r in rows]
+        print(f"{page:<11}{len(rows):>9}{len(rows) / args.duration:>8.1f}"
+              f"{percentile(latencies, 0.5):>9.1f}{percentile(latencies, 0.95):>9.1f}"
+              f"{percentile(latencies, 0.99):>9.1f}{max(latencies) * 1000:>9.1f}"
+              f"{sum(1 for r in rows if r[3]):>8}")
+
+    # up to 10 buckets of at least 1 s that end with the run
+    n_buckets = max(1, min(10, int(args.duration)))
+    interval = args.duration / n_buckets
+    buckets = {}
+    for page, offset, latency, _ in results:
+        buckets.setdefault(min(int(offset // interval), n_buckets - 1), []).append(latency)
+    print(f"per {interval:g} s, req/s: " + " ".join(
+        f"{len(buckets.get(i, [])) / interval:.0f}" for i in range(n_buckets)))
+    print(f"per {interval:g} s, p95 ms: " + " ".join(
+        f"{percentile(buckets.get(i, []), 0.95):.0f}" for i in range(n_buckets)))
+    print("peak RSS per process (MB): " + ", ".join(
+        f"{report['peak_rss_kb'] / 1024:.0f}" for report in reports))
+
+    errors = [r[3] for r in results if r[3]]
+    for error in sorted(set(errors))[:10]:
+        print(f"error: {error}")
+    print(f"integrity: {problems or 'ok'}")
+    return 1 if errors or problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
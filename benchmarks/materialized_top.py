@@ -0,0 +1,97 @@
+"""
+materialized top-N vs scoring the catalog per request
+
+reports get_recommendations latency with and without the materialized list
+and the cost of keeping it current (add_book: one score + threshold check,
+rating change: re-rank from the index columns); checks that both give
+identical results and that the list updated by the added books, and the one
+re-ranked after a rating, equal a rebuild calling score_book per book
+
+usage: python benchmarks/materialized_top.py [n_books] [n_added]
+"""
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.materialized import MaterializedTopN
+from src.recommender import BookRecommender
+
+SETTINGS = [
+    {'top_n': 5},
+    {'top_n': 10, 'with_breakdown': True},
+    {'top_n': 10, 'diversity': 0.5},
+]
+
+
+def timed(call, repeat: int) -> float:
+    """median ms"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def rebuilt(recommender: BookRecommender, manager: BookDataManager) -> MaterializedTopN:
+    """the list built by scoring every book with score_book"""
+    state = recommender._snapshot()
+    index = manager.get_index()
+    return MaterializedTopN.build(
+        recommender, index.books[:index.count], recommender.load_profile(), state.ratings,
+        recommender.materialize_top, state.version[2], manager._books_version()
+    )
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    n_added = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(n_books))
+        recommender = BookRecommender(data_dir, book_manager=manager)
+        scoring = BookRecommender(data_dir, book_manager=manager, materialize_top=0)
+        for book_id, rating in synthetic_ratings(n_books, 30).items():
+            recommender.save_rating(book_id, rating)
+
+        books = manager.load_books()
+        recommender.get_recommendations(books)  # first build
+        for settings in SETTINGS:
+            lookup = timed(lambda: recommender.get_recommendations(books, **settings), 50)
+            full = timed(lambda: scoring.get_recommendations(books, **settings), 3)
+            print(f"{settings}: materialized {lookup:.2f} ms, scoring {full:.1f} ms")
+
+        start = time.perf_counter()
+        for i in range(n_added):
+            book = synthetic_books(1, seed=i)[0]
+            del book['id']
+            book['title'] = f"کتاب تازه {i}"
+            manager.add_book(book)
+        added = (time.perf_counter() - start) / n_added
+
+        # the list after the additions (applied, not rebuilt) vs a rebuild
+        books = manager.load_books()
+        problems = [
+            f"{settings}: results differ" for settings in SETTINGS
+            if recommender.get_recommendations(books, **settings) !=
+            scoring.get_recommendations(books, **settings)
+        ]
+        problems += recommender._top.differences(rebuilt(recommender, manager))
+
+        rated = timed(lambda: recommender.save_rating(1, 4.5), 3)
+        problems += [f"after rating: {problem}"
+                     for problem in recommender._top.differences(rebuilt(recommender, manager))]
+        print(f"add_book (incl. saving books.json): {added * 1000:.1f} ms, "
+              f"save_rating (incl. re-ranking): {rated:.1f} ms")
+        print(f"consistency after {n_added} additions and a rating: {problems or 'ok'}")
+
+
+if __name__ == '__main__':
+    main()
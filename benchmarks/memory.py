@@ -0,0 +1,20 @@
+"""memory of the current process, from /proc (Linux only)"""
+
+
+def peak_rss_kb() -> int:
+    # VmHWM, not getrusage: ru_maxrss survives exec and would include the parent
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1])
+    return 0
+
+
+def private_kb() -> int:
+    """memory not shared with other processes"""
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean', 'Private_Dirty')):
+                total += int(line.split()[1])
+    return total
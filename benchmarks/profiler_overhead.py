@@ -0,0 +1,75 @@
+"""
+cost and accuracy of the sampling profiler (src/profiling.py)
+
+runs a page-like workload (get_recommendations scoring the whole catalog)
+without the profiler and under it at several intervals; reports the
+slowdown, the samples actually taken (the sampler competes for the GIL)
+and the time the speedscope profile accounts for vs the measured run.
+
+usage: python benchmarks/profiler_overhead.py [n_books] [repeat]
+"""
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.profiling import SamplingProfiler
+from src.recommender import BookRecommender
+
+INTERVALS = [0.001, 0.005, 0.02]
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(n_books))
+        recommender = BookRecommender(data_dir, book_manager=manager, materialize_top=0)
+        for book_id, rating in synthetic_ratings(n_books, 30).items():
+            recommender.save_rating(book_id, rating)
+        books = manager.load_books()
+
+        def page():
+            recommender.get_recommendations(books, top_n=10, with_breakdown=True)
+
+        def run(interval=None):
+            profiler = SamplingProfiler(interval=interval) if interval else None
+            start = time.perf_counter()
+            if profiler:
+                profiler.start()
+            page()
+            if profiler:
+                profiler.stop()
+            return time.perf_counter() - start, profiler
+
+        page()  # warm up
+        # interleaved, so drift in machine load hits every setting alike
+        times = {interval: [] for interval in [None] + INTERVALS}
+        last = {}
+        for _ in range(repeat):
+            for interval in times:
+                seconds, profiler = run(interval)
+                times[interval].append(seconds)
+                last[interval] = (seconds, profiler)
+
+        base = statistics.median(times[None])
+        print(f"{n_books} books, get_recommendations without profiler: {base * 1000:.0f} ms")
+        print(f"{'interval':>9} {'median ms':>10} {'overhead':>9} {'samples':>8} "
+              f"{'expected':>9} {'profiled ms':>12}")
+        for interval in INTERVALS:
+            median = statistics.median(times[interval])
+            seconds, profiler = last[interval]
+            profiled = profiler.speedscope('run')['profiles'][0]['endValue']
+            print(f"{interval * 1000:>7.0f}ms {median * 1000:>10.0f} {median / base - 1:>9.1%} "
+                  f"{profiler.sample_count:>8} {int(seconds / interval):>9} {profiled * 1000:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+sharded vs single-node recommendations
+
+starts n shard processes over local sockets (LocalShardCluster), then for
+several synthetic users and request settings compares the coordinator's
+result with BookRecommender.get_recommendations over the whole catalog
+(books, order and scores must be identical) and reports request latency.
+
+usage: python benchmarks/sharded_serving.py [n_books] [n_shards] [n_users]
+"""
+import io
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.recommender import BookRecommender
+from src.sharding import LocalShardCluster, ShardedRecommender
+
+SETTINGS = [
+    {'top_n': 5},
+    {'top_n': 10, 'with_breakdown': True},
+    {'top_n': 10, 'diversity': 0.5},
+    {'top_n': 8, 'diversity': 1.0, 'with_breakdown': True},
+]
+COLD_START_SETTINGS = [
+    {'top_n': 5},
+    {'top_n': 5, 'seed': 7, 'stratify_genres': True, 'with_breakdown': True},
+]
+
+
+def timed(call, **kwargs):
+    start = time.perf_counter()
+    result = call(**kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    n_shards = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    n_users = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(n_books))
+        books = manager.load_books()
+
+        users = [BookRecommender(data_dir, user_id="new", book_manager=manager)]
+        for u in range(n_users):
+            recommender = BookRecommender(data_dir, user_id=f"user{u}", book_manager=manager)
+            ratings = synthetic_ratings(n_books, 30, seed=u)
+            lines = "".join(json.dumps({'book_id': i, 'rating': r}) + "\n" for i, r in ratings.items())
+            recommender.import_ratings(io.BytesIO(lines.encode()), file_format='jsonl')
+            users.append(recommender)
+
+        mismatches = 0
+        single_times, sharded_times = [], []
+        with LocalShardCluster(data_dir, n_shards) as transports:
+            for recommender in users:
+                coordinator = ShardedRecommender(recommender, transports)
+                settings = COLD_START_SETTINGS if recommender.user_id == "new" else SETTINGS
+                for kwargs in settings:
+                    expected, t_single = timed(recommender.get_recommendations, books=books, **kwargs)
+                    result, t_sharded = timed(coordinator.get_recommendations, **kwargs)
+                    single_times.append(t_single)
+                    sharded_times.append(t_sharded)
+                    if result != expected:
+                        mismatches += 1
+                        print(f"MISMATCH user={recommender.user_id} {kwargs}")
+                coordinator.close()
+
+        print(f"{n_books} books, {n_shards} shards, {len(single_times)} requests, {mismatches} mismatches")
+        print(f"median latency: single node {statistics.median(single_times) * 1000:.0f} ms, "
+              f"sharded {statistics.median(sharded_times) * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
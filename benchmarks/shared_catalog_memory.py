@@ -0,0 +1,80 @@
+"""
+per-worker memory with and without the shared (memory-mapped) catalog
+
+each worker loads the catalog, keeps it (like the app's cache does) and walks
+it once, then serves one user the way the pages do: saves a few ratings,
+asks for recommendations and runs the rating page's filtered query. we
+report private memory per worker (/proc/self/smaps_rollup, Linux only) -
+memory that is NOT shared with the other workers - after loading and after
+serving.
+
+usage: python benchmarks/shared_catalog_memory.py [n_books] [n_workers]
+"""
+import multiprocessing as mp
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.memory import private_kb
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.book_data import BookDataManager
+from src.recommender import BookRecommender
+
+
+def worker(data_dir, shared, barrier, results):
+    before = private_kb()
+    manager = BookDataManager(data_dir, shared_catalog=shared)
+    books = manager.load_books()
+    pages = sum(b['pages'] for b in books)
+    loaded = private_kb() - before
+
+    recommender = BookRecommender(data_dir, user_id=f"worker{mp.current_process().pid}",
+                                  book_manager=manager)
+    for book_id, rating in synthetic_ratings(len(books), 20).items():
+        recommender.save_rating(book_id, rating)
+    ratings = recommender.load_ratings()
+    recommender.get_recommendations(books, top_n=5)
+    genre = manager.get_index().vocabularies['genre'][0]
+    manager.query(text='شماره 12', filters={'genre': genre}, rated=False, ratings=ratings,
+                  facets=('genre', 'length_category', 'style'))
+    barrier.wait()  # all workers attached at the same time
+    results.put((loaded, private_kb() - before, pages))
+    barrier.wait()
+
+
+def run(data_dir, shared: bool, n_workers: int):
+    barrier = mp.Barrier(n_workers)
+    results = mp.Queue()
+    processes = [mp.Process(target=worker, args=(data_dir, shared, barrier, results))
+                 for _ in range(n_workers)]
+    for p in processes:
+        p.start()
+    sizes = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return (sum(s[0] for s in sizes) / len(sizes),
+            sum(s[1] for s in sizes) / len(sizes))
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = BookDataManager(data_dir)
+        manager.save_books(synthetic_books(n_books))
+        BookDataManager(data_dir, shared_catalog=True).load_books()  # publish
+
+        print(f"{n_books} books, private memory per worker (MB)")
+        print(f"{'workers':>8} {'json load':>10} {'served':>10} {'shared load':>12} {'served':>10}")
+        for n_workers in range(1, max_workers + 1):
+            plain_loaded, plain_served = run(data_dir, False, n_workers)
+            shared_loaded, shared_served = run(data_dir, True, n_workers)
+            print(f"{n_workers:>8} {plain_loaded / 1024:>10.1f} {plain_served / 1024:>10.1f} "
+                  f"{shared_loaded / 1024:>12.1f} {shared_served / 1024:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""synthetic catalogs / ratings for the benchmarks"""
+import random
+from typing import Dict, List
+
+GENRES = ['داستانی', 'علمی', 'روانشناسی', 'فلسفی', 'تاریخی', 'هنری', 'خودیاری', 'آموزشی']
+STYLES = ['ساده', 'آکادمیک', 'شاعرانه']
+LENGTHS = ['کوتاه', 'متوسط', 'بلند']
+
+
+def synthetic_books(n: int, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    return [{
+        'id': i,
+        'title': f'کتاب شماره {i}',
+        'author': f'نویسنده {rng.randrange(n // 10 + 1)}',
+        'genre': rng.choice(GENRES),
+        'pages': rng.randrange(50, 1500),
+        'length_category': rng.choice(LENGTHS),
+        'style': rng.choice(STYLES),
+        'topic': f'موضوع {rng.randrange(500)}',
+        'year': rng.randrange(1800, 2025),
+        'description': 'توضیحات ' * rng.randrange(5, 30),
+    } for i in range(1, n + 1)]
+
+
+def synthetic_ratings(n_books: int, n_ratings: int, seed: int = 0) -> Dict[int, float]:
+    rng = random.Random(seed)
+    book_ids = rng.sample(range(1, n_books + 1), min(n_ratings, n_books))
+    return {book_id: rng.choice([1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5, 5]) for book_id in book_ids}
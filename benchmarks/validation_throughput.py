@@ -0,0 +1,54 @@
+"""
+throughput of the batch validation layer (src/validation.py)
+
+usage: python benchmarks/validation_throughput.py [n_books]
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import synthetic_books, synthetic_ratings
+from src.validation import validate_books, validate_ratings
+
+
+def timed(func, *args, repeat: int = 3, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    n_books = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    books = synthetic_books(n_books)
+    known_ids = {b['id'] for b in books}
+
+    # a few broken rows so the error paths are exercised too
+    broken = [dict(b) for b in books[:1000]]
+    for i, b in enumerate(broken):
+        if i % 3 == 0:
+            b['pages'] = -1
+        elif i % 3 == 1:
+            b['style'] = 'نامعتبر'
+        else:
+            del b['year']
+
+    seconds, report = timed(validate_books, books)
+    print(f"validate_books       {n_books:>8} rows  {n_books / seconds:>12,.0f} rows/s  errors: {len(report.errors)}")
+
+    new_books = [{k: v for k, v in b.items() if k != 'id'} for b in broken]
+    seconds, report = timed(validate_books, new_books, existing=books, require_id=False)
+    print(f"validate_books (new) {len(new_books):>8} rows  {len(new_books) / seconds:>12,.0f} rows/s  errors: {len(report.errors)}"
+          f"  (vs. {n_books} existing)")
+
+    ratings = list(synthetic_ratings(n_books, n_books // 2).items()) + [(n_books + 1, 3), (1, 9)]
+    seconds, report = timed(validate_ratings, ratings, known_ids=known_ids)
+    print(f"validate_ratings     {len(ratings):>8} rows  {len(ratings) / seconds:>12,.0f} rows/s  errors: {len(report.errors)}")
+
+
+if __name__ == '__main__':
+    main()
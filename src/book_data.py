@@ -1,14 +1,51 @@
 import json
 import os
-from typing import List, Dict, Optional
+
+from src.catalog_feed import CatalogFeed, CatalogStats, compare_snapshots
+from src.concurrency import atomic_write_json, file_version, write_lock
+from typing import List, Dict, Optional, Sequence
 from pathlib import Path
 
 class BookDataManager:
-    def __init__(self, data_dir: str = "data"):
+    """
+    shared_catalog=True: books are served from a memory-mapped catalog file
+    (data/catalog.mmap) that all worker processes on the host share, see
+    src/shared_catalog.py. books.json stays the source of truth; every
+    save_books publishes a new generation that workers pick up on their next
+    load_books, and a catalog file older than books.json is republished.
+
+    chunked_catalog=True: books are read from a compressed, chunked copy of
+    the catalog (data/catalog/, see src/chunked_catalog.py) in which
+    descriptions are stored apart and loaded by id on demand
+    (get_descriptions); load_books returns the books without them.
+
+    added / edited books are published on self.feed (src/catalog_feed.py);
+    the index and statistics kept here are updated from it instead of being
+    rebuilt, check_consistency compares them with a rebuild.
+
+    one manager can be shared by all sessions' threads (see
+    src/concurrency.py): writes to books.json are serialized and replace
+    the file atomically, the index and statistics are swapped for updated
+    copies, so reads never wait and never see half an update.
+    """
+    def __init__(self, data_dir: str = "data", shared_catalog: bool = False,
+                 chunked_catalog: bool = False):
         self.data_dir = Path(data_dir)
         self.books_file = self.data_dir/"books.json"
         self.ratings_file = self.data_dir/"user_ratings.json"
         self.profile_file = self.data_dir/"user_profile.json"
+        self.shared_catalog_file = self.data_dir/"catalog.mmap"
+        self.chunked_catalog_dir = self.data_dir/"catalog"
+
+        self.shared_catalog = shared_catalog
+        self._shared = None
+        self.chunked_catalog = chunked_catalog
+        self._chunked = None
+        # (books.json version, structure) - one attribute, so it is swapped at once
+        self._index_state = None
+        self._stats_state = None
+        self.feed = CatalogFeed()
+        self._lock = write_lock(self.books_file)
 
         self.data_dir.mkdir(exist_ok=True)
 
@@ -16,8 +53,7 @@ class BookDataManager:
 
     def _initialize_files(self):
         if not self.ratings_file.exists():
-            with open(self.ratings_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
+            atomic_write_json(self.ratings_file, {})
 
         # user_profile file
         if not self.profile_file.exists():
@@ -29,10 +65,60 @@ class BookDataManager:
                 "total_ratings": 0,
                 "average_rating": 0
             }
-            with open(self.profile_file, 'w', encoding='utf-8') as f:
-                json.dump(initial_profile, f, ensure_ascii=False, indent=2)
+            atomic_write_json(self.profile_file, initial_profile)
 
     def load_books(self) -> List[Dict]:
+        if self.shared_catalog:
+            return self._load_shared_books()
+        if self.chunked_catalog:
+            return self._chunked_store().books()
+
+        return self._load_books_file()
+
+    def _load_shared_books(self) -> Sequence[Dict]:
+        from src.shared_catalog import open_shared_catalog, publish_catalog
+
+        # attach once, re-attach only when a new generation was published
+        if self._shared is None or not self._shared.is_current():
+            self._shared = open_shared_catalog(self.shared_catalog_file)
+
+        if not self._shared_up_to_date():
+            with self._lock:
+                self._shared = open_shared_catalog(self.shared_catalog_file)
+                if not self._shared_up_to_date():
+                    # first process on this host, or books.json was changed
+                    # without a publish (deploy, hand edit): publish from it
+                    publish_catalog(self._load_books_file(), self.shared_catalog_file,
+                                    source_version=self._books_version())
+                    self._shared = open_shared_catalog(self.shared_catalog_file)
+
+        return self._shared.books()
+
+    def _shared_up_to_date(self) -> bool:
+        version = self._books_version()
+        return self._shared is not None and self._shared.source_version == (list(version) if version else None)
+
+    def _chunked_store(self):
+        from src.chunked_catalog import open_chunked_catalog, publish_chunked
+
+        if self._chunked is None or not self._chunked.is_current():
+            self._chunked = open_chunked_catalog(self.chunked_catalog_dir)
+
+        if not self._chunked_up_to_date():
+            with self._lock:
+                if not self._chunked_up_to_date():
+                    # first run, or books.json was edited by hand: rebuild from it
+                    publish_chunked(self._load_books_file(), self.chunked_catalog_dir,
+                                    source_version=self._books_version())
+                    self._chunked = open_chunked_catalog(self.chunked_catalog_dir)
+
+        return self._chunked
+
+    def _chunked_up_to_date(self) -> bool:
+        version = self._books_version()
+        return self._chunked is not None and self._chunked.source_version == (list(version) if version else None)
+
+    def _load_books_file(self) -> List[Dict]:
         try:
             with open(self.books_file, 'r', encoding='utf-8') as f:
                 books = json.load(f)
@@ -46,8 +132,22 @@ class BookDataManager:
 
     def save_books(self, books: List[Dict]) -> bool:
         try:
-            with open(self.books_file, 'w', encoding='utf-8') as f:
-                json.dump(books, f, ensure_ascii=False, indent=2)
+            with self._lock:
+                books = list(books)
+                if self.chunked_catalog:
+                    # books loaded from the chunked catalog come without descriptions
+                    store = self._chunked_store()
+                    cold = store.cold_fields(b['id'] for b in books)
+                    books = [store.restore(b, cold[b['id']]) if b['id'] in cold else b for b in books]
+
+                atomic_write_json(self.books_file, books)
+
+                if self.shared_catalog:
+                    from src.shared_catalog import publish_catalog
+                    publish_catalog(books, self.shared_catalog_file, source_version=self._books_version())
+                if self.chunked_catalog:
+                    from src.chunked_catalog import publish_chunked
+                    publish_chunked(books, self.chunked_catalog_dir, source_version=self._books_version())
             return True
         except Exception as e:
             print(f"Error {e} while saving book!")
@@ -57,65 +157,169 @@ class BookDataManager:
         books = self.load_books()
         for book in books:
             if book['id'] == book_id:
+                if self.chunked_catalog:
+                    store = self._chunked_store()
+                    book = store.restore(book, store.cold_fields([book_id]).get(book_id, {}))
                 return book
         return None
 
+    def get_books_by_ids(self, book_ids) -> Dict[int, Dict]:
+        """
+        {book_id: book} for the given ids that are in the catalog; with
+        shared_catalog the ids are looked up in the shared id column, so a
+        worker doesn't build the whole index for a few books
+        """
+        book_ids = [i for i in book_ids if isinstance(i, int) and not isinstance(i, bool)]
+        if self.shared_catalog:
+            catalog = self._load_shared_books().catalog
+            return {book_id: catalog.book(position)
+                    for book_id, position in catalog.find(book_ids).items()}
+
+        index = self.get_index()
+        return {book_id: index.books[index.positions[book_id]]
+                for book_id in book_ids if book_id in index.positions}
+
+    def get_descriptions(self, book_ids) -> Dict[int, str]:
+        """
+        {book_id: description} for books that have one; with
+        chunked_catalog only the chunks holding these ids are read
+        """
+        book_ids = list(book_ids)
+        if self.chunked_catalog:
+            cold = self._chunked_store().cold_fields(book_ids)
+            return {i: fields['description'] for i, fields in cold.items() if 'description' in fields}
+
+        index = self.get_index()
+        descriptions = {}
+        for book_id in book_ids:
+            position = index.positions.get(book_id)
+            if position is not None and 'description' in index.books[position]:
+                descriptions[book_id] = index.books[position]['description']
+        return descriptions
+
     def add_book(self, book_data: Dict) -> bool:
-        books = self.load_books()
+        report = self.add_books([book_data])
+        report.print_errors()
+        return report.ok
 
-        # generate new id
-        if books:
-            new_id = max(book['id'] for book in books) + 1
-        else:
-            new_id = 1
+    def add_books(self, new_books: List[Dict], skip_invalid: bool = False):
+        """
+        bulk import: validate the whole batch, assign ids, write once
 
-        book_data['id'] = new_id
+        skip_invalid=False: nothing is added if any book is invalid
+        skip_invalid=True: valid books are added, invalid ones reported
+        returns the ValidationReport (rows = positions in new_books)
+        """
+        from src.validation import validate_books
 
-        if not self._validate_book(book_data):
-            return False
+        # load -> assign ids -> save, one writer at a time
+        with self._lock:
+            books = list(self.load_books())
+            report = validate_books(new_books, existing=books, require_id=False)
 
-        books.append(book_data)
-        return self.save_books(books)
+            if report.errors and not skip_invalid:
+                return report
 
-    def _validate_book(self, book: Dict) -> bool:
-        required_fields = [
-            'title', 'author', 'genre', 'pages',
-            'length_category', 'style', 'topic', 'year'
-        ]
+            # generate new ids
+            new_id = self.get_catalog_stats().next_id
+            before = self._books_version()
 
-        for field in required_fields:
-            if field not in book:
-                print(f"Field {field} does not exist!")
-                return False
+            changes = []
+            for row in report.valid_rows():
+                new_books[row]['id'] = new_id
+                changes.append(('add', len(books), new_books[row], None))
+                books.append(new_books[row])
+                new_id += 1
 
-        if not isinstance(book['pages'], int) or book['pages'] <= 0:
-            print("The number of pages must be a positive integer!")
-            return False
+            if changes:
+                if self.save_books(books):
+                    self._publish(changes, before)
+                else:
+                    report.add(-1, 'books', 'io', "Error while saving books!")
+            return report
 
-        if not isinstance(book['year'], int):
-            print("the year value must be an integer number!")
-            return False
+    def update_book(self, book_id: int, changes: Dict):
+        """
+        edit fields of a book (its id stays the same); returns the
+        ValidationReport, nothing is saved if the edited book is invalid
+        """
+        from src.validation import ValidationReport, validate_books
 
-        valid_lengths = ['کوتاه', 'متوسط', 'بلند']
-        if book['length_category'] not in valid_lengths:
-            print(f"the length of the book must be one of {valid_lengths}")
-            return False
+        with self._lock:
+            books = list(self.load_books())
+            position = self.get_index().positions.get(book_id)
+            if position is None:
+                report = ValidationReport(1)
+                report.add(0, 'id', 'unknown_book', f"book {book_id} does not exist!")
+                return report
 
-        valid_styles = ['ساده', 'آکادمیک', 'شاعرانه']
-        if book['style'] not in valid_styles:
-            print(f"the style of the book must be one of {valid_styles}")
-            return False
+            old = books[position]
+            book = {**old, **changes, 'id': book_id}
+            report = validate_books([book], existing=books[:position] + books[position + 1:])
+            if not report.ok:
+                return report
 
-        return True
+            before = self._books_version()
+            books[position] = book
+            if self.save_books(books):
+                self._publish([('edit', position, book, old)], before)
+            else:
+                report.add(-1, 'books', 'io', "Error while saving books!")
+            return report
+
+    def _publish(self, changes, before):
+        """
+        apply saved changes to the index / statistics (if they were built
+        from the catalog as it was before the write), then to subscribers;
+        called with the write lock held
+        """
+        after = self._books_version()
+        changes = [{'op': op, 'position': position, 'book': book, 'old': old}
+                   for op, position, book, old in changes]
+
+        # a shared catalog's books can't be appended to: rebuild its index
+        state = self._index_state
+        if state is not None and state[0] == before and not self.shared_catalog:
+            index = state[1]
+            for change in changes:
+                index = index.apply(change)
+            self._index_state = (after, index)
+        state = self._stats_state
+        if state is not None and state[0] == before:
+            stats = state[1]
+            for change in changes:
+                stats = stats.apply(change)
+            self._stats_state = (after, stats)
+
+        for change in changes:
+            self.feed.publish(change['op'], change['position'], change['book'], change['old'],
+                              before, after)
+
+    def check_integrity(self, ratings: Optional[Dict[int, float]] = None):
+        """
+        load-time check of the whole catalog (and optionally of a user's
+        ratings against it); returns (books report, ratings report)
+        """
+        from src.validation import validate_books, validate_ratings
 
-    def get_all_genres(self) -> List[str]:
         books = self.load_books()
+        books_report = validate_books(books)
+        ratings_report = validate_ratings(
+            (ratings or {}).items(), known_ids={b['id'] for b in books}
+        )
+        return books_report, ratings_report
+
+    def get_all_genres(self, books: Optional[List[Dict]] = None) -> List[str]:
+        if books is None:
+            return self.get_catalog_stats().vocabulary('genre')
         genres = list(set(book['genre'] for book in books))
         return sorted(genres)
 
 
-    def search_books(self, query: str) -> List[Dict]:
-        books = self.load_books()
+    def search_books(self, query: str,
+                     books: Optional[List[Dict]] = None) -> List[Dict]:
+        if books is None:
+            books = self.load_books()
         query = query.lower()
 
         results = []
@@ -128,8 +332,9 @@ class BookDataManager:
 
         return results
 
-    def get_statistics(self) -> Dict:
-        books = self.load_books()
+    def get_statistics(self, books: Optional[List[Dict]] = None) -> Dict:
+        if books is None:
+            return self.get_catalog_stats().statistics()
 
         if not books:
             return {}
@@ -149,4 +354,76 @@ class BookDataManager:
             'styles': styles,
             'lengths': lengths,
             'avg_pages': sum(b['pages'] for b in books) / len(books) if books else 0
-        }
\ No newline at end of file
+        }
+
+    def _books_version(self):
+        return file_version(self.books_file)
+
+    def get_index(self):
+        """
+        CatalogIndex of the current catalog, rebuilt only when books.json
+        changes; a shared catalog is indexed from its mapped columns
+        """
+        from src.catalog_index import CatalogIndex
+
+        if self.shared_catalog:
+            return self._derived('_index_state', lambda books: CatalogIndex.from_shared(books.catalog))
+        return self._derived('_index_state', CatalogIndex)
+
+    def get_catalog_stats(self) -> CatalogStats:
+        """
+        counters behind get_statistics / get_all_genres and the next free
+        id, rebuilt only when books.json was changed by someone else
+        """
+        return self._derived('_stats_state', CatalogStats)
+
+    def _derived(self, attribute: str, build):
+        """
+        the structure in self.<attribute> if it is current, else build(books);
+        kept only if books.json did not change while it was being built,
+        otherwise a write landing meanwhile would be applied to it twice
+        """
+        version = self._books_version()
+        state = getattr(self, attribute)
+        if state is not None and state[0] == version:
+            return state[1]
+        structure = build(self.load_books())
+        if self._books_version() == version:
+            setattr(self, attribute, (version, structure))
+        return structure
+
+    def check_consistency(self) -> List[str]:
+        """
+        compare the incrementally updated index and statistics with a full
+        rebuild from the catalog on disk; [] = consistent
+        """
+        from src.catalog_index import CatalogIndex
+
+        with self._lock:
+            books = self.load_books()
+            version = self._books_version()
+            index_state, stats_state = self._index_state, self._stats_state
+
+        problems = []
+        # structures that are out of date are rebuilt on their next use anyway
+        if index_state is not None and index_state[0] == version:
+            problems += compare_snapshots('index', index_state[1].snapshot(), CatalogIndex(books).snapshot())
+        if stats_state is not None and stats_state[0] == version:
+            problems += compare_snapshots('statistics', stats_state[1].snapshot(), CatalogStats(books).snapshot())
+        return problems
+
+    def query(self, text: Optional[str] = None,
+              filters: Optional[Dict] = None,
+              pages: Optional[tuple] = None,
+              year: Optional[tuple] = None,
+              rated: Optional[bool] = None,
+              ratings: Optional[Dict[int, float]] = None,
+              facets=()) -> Dict:
+        """
+        combined search + filters over the catalog indexes, with facet counts
+        (see CatalogIndex.query)
+        """
+        return self.get_index().query(
+            text=text, filters=filters, pages=pages, year=year,
+            rated=rated, ratings=ratings, facets=facets
+        )
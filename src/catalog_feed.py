@@ -0,0 +1,134 @@
+"""
+catalog change feed + incrementally maintained catalog statistics
+
+BookDataManager publishes one change per added or edited book once it is
+saved:
+
+    {'seq': n, 'op': 'add' | 'edit', 'position': i, 'book': {...}, 'old': {...} or None,
+     'before': books.json version before the write, 'after': and after it}
+
+the structures derived from the catalog apply it instead of being rebuilt
+from the whole catalog. apply returns an updated copy (sharing what did not
+change), so a thread still reading the previous one never sees it half
+updated:
+- CatalogStats (below): id counter, value counts per field, page total
+- CatalogIndex.apply: ids, codes, vocabularies, text index
+- PopularityRanking.apply: the cold-start score table
+- MaterializedTopN.apply: a user's precomputed recommendations
+
+a structure built before a change made by *another* process is still
+rebuilt from books.json (the version check in BookDataManager).
+check_consistency compares the incremental state with a full rebuild.
+"""
+import copy
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional, Sequence
+
+# statistics key -> book field
+COUNTED_FIELDS = {
+    'genres': 'genre',
+    'styles': 'style',
+    'lengths': 'length_category',
+    'topics': 'topic',
+}
+
+
+class CatalogFeed:
+    def __init__(self, max_log: int = 1000):
+        self.seq = 0
+        self.log = deque(maxlen=max_log)
+        self._subscribers: List[Callable[[Dict], None]] = []
+
+    def subscribe(self, callback: Callable[[Dict], None]):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Dict], None]):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def publish(self, op: str, position: int, book: Dict, old: Optional[Dict] = None,
+                before=None, after=None) -> Dict:
+        self.seq += 1
+        change = {'seq': self.seq, 'op': op, 'position': position, 'book': book, 'old': old,
+                  'before': before, 'after': after}
+        self.log.append(change)
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception as e:
+                print(f"Error {e} while applying catalog change {self.seq}")
+        return change
+
+    def changes_since(self, seq: int) -> Optional[List[Dict]]:
+        """changes after seq, or None if some of them are no longer in the log"""
+        if seq < self.seq - len(self.log):
+            return None
+        return [c for c in self.log if c['seq'] > seq]
+
+
+class CatalogStats:
+    """what get_statistics / get_all_genres / add_book need, kept up to date per change"""
+    def __init__(self, books: Sequence[Dict]):
+        self.count = 0
+        self.total_pages = 0
+        self.next_id = 1
+        self.counts = {key: Counter() for key in COUNTED_FIELDS}
+        for book in books:
+            self._add(book)
+
+    def _add(self, book: Dict):
+        self.count += 1
+        self.total_pages += book['pages']
+        self.next_id = max(self.next_id, book['id'] + 1)
+        for key, field in COUNTED_FIELDS.items():
+            self.counts[key][book[field]] += 1
+
+    def _remove(self, book: Dict):
+        self.count -= 1
+        self.total_pages -= book['pages']
+        for key, field in COUNTED_FIELDS.items():
+            counter = self.counts[key]
+            counter[book[field]] -= 1
+            if counter[book[field]] <= 0:
+                del counter[book[field]]
+
+    def apply(self, change: Dict) -> 'CatalogStats':
+        stats = copy.copy(self)
+        stats.counts = {key: Counter(counter) for key, counter in self.counts.items()}
+        if change['op'] == 'edit':
+            stats._remove(change['old'])
+        stats._add(change['book'])
+        return stats
+
+    def vocabulary(self, field: str) -> List[str]:
+        key = next(k for k, f in COUNTED_FIELDS.items() if f == field)
+        return sorted(self.counts[key])
+
+    def statistics(self) -> Dict:
+        """same shape as BookDataManager.get_statistics"""
+        if not self.count:
+            return {}
+        return {
+            'total_books': self.count,
+            'genres': dict(self.counts['genres']),
+            'styles': dict(self.counts['styles']),
+            'lengths': dict(self.counts['lengths']),
+            'avg_pages': self.total_pages / self.count
+        }
+
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'total_pages': self.total_pages,
+            'next_id': self.next_id,
+            **{key: dict(counter) for key, counter in self.counts.items()},
+        }
+
+
+def compare_snapshots(name: str, current: Dict, rebuilt: Dict) -> List[str]:
+    """human-readable differences between two snapshot() dicts"""
+    problems = []
+    for key in sorted(set(current) | set(rebuilt)):
+        if current.get(key) != rebuilt.get(key):
+            problems.append(f"{name}.{key}: incremental state differs from a rebuild")
+    return problems
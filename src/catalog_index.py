@@ -0,0 +1,465 @@
+"""
+precomputed catalog indexes + composable multi-facet queries
+
+- categorical fields are encoded once as integer codes; each value gets a
+  bitmap (numpy bool array over catalog positions), built lazily and reused
+- pages / year are kept as numpy columns for vectorized range checks
+- text search keeps the old substring semantics of search_books: all
+  searchable fields of all books are lowercased into one string, and
+  str.find walks it in C; match offsets map back to positions via bisect
+
+a query ANDs the bitmaps of its filters. facet counts come from one
+np.bincount per facet over the books that pass every *other* filter, so a
+dropdown keeps showing the alternatives to its current choice.
+
+added / edited books are applied by apply (fed by the catalog change
+feed), which returns a new index and leaves the old one untouched, so
+threads still querying it see a consistent catalog. columns, books and
+texts are stored in chunks of CHUNK_ROWS rows shared by the old and the
+new index: an add writes into the spare room of the last chunk (the old
+index only looks at its first `count` rows), an edit copies the one chunk
+holding the row. apply is O(1) for an add and O(CHUNK_ROWS + N /
+CHUNK_ROWS) for an edit. a new value gets the next code at the end of its
+vocabulary; the contiguous columns the queries use (ids / codes /
+numeric), the bitmaps and the text haystack are put together on the next
+query that needs them.
+
+an index of a shared (memory-mapped) catalog is built by from_shared: its
+columns are the mapped arrays, its books / positions look rows up in the
+file, and text search scans the file's search column, so a worker doesn't
+decode the catalog to index it. it is rebuilt rather than applied to.
+"""
+import copy
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+CATEGORICAL_FIELDS = ['genre', 'style', 'length_category', 'topic']
+NUMERIC_FIELDS = ['pages', 'year']
+TEXT_FIELDS = ['title', 'author', 'genre', 'topic']
+
+_SEPARATOR = '\x00'
+
+CHUNK_ROWS = 4096
+
+
+def _dtype(column: str):
+    return np.int32 if column in CATEGORICAL_FIELDS else np.int64
+
+
+def normalize_name(text: str) -> str:
+    """casefold, drop punctuation, collapse whitespace"""
+    text = ''.join(c if c.isalnum() else ' ' for c in text.casefold())
+    return ' '.join(text.split())
+
+
+def normalize_title(title: str) -> str:
+    # "The Hobbit (The Lord of the Rings, #0)" -> "the hobbit"
+    title = re.sub(r'\s*\([^)]*#[^)]*\)\s*$', '', title)
+    return normalize_name(title)
+
+
+def _chunk_array(column: np.ndarray) -> List[np.ndarray]:
+    """a column as chunks of CHUNK_ROWS rows, the last one padded"""
+    n_chunks = -(-len(column) // CHUNK_ROWS)
+    padded = np.zeros(n_chunks * CHUNK_ROWS, dtype=column.dtype)
+    padded[:len(column)] = column
+    return list(padded.reshape(n_chunks, CHUNK_ROWS))
+
+
+class Rows(Sequence):
+    """the first `count` rows of a list of chunks (index.books)"""
+    def __init__(self, chunks: List[List], count: int):
+        self._chunks = chunks
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._chunks[i // CHUNK_ROWS][i % CHUNK_ROWS]
+
+    def __iter__(self) -> Iterator:
+        remaining = self._count
+        for chunk in self._chunks:
+            yield from chunk[:remaining]
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+
+
+class CatalogIndex:
+    def __init__(self, books: Sequence[Dict]):
+        self.count = len(books)
+        self._shared = None
+        self._books = [list(books[i:i + CHUNK_ROWS]) for i in range(0, self.count, CHUNK_ROWS)]
+
+        # columns: chunks with room to grow, self.ids / codes / numeric are
+        # their first `count` rows put together (see _column)
+        ids = np.array([b['id'] for b in books], dtype=np.int64)
+        self._columns = {'id': _chunk_array(ids)}
+        self.positions = {int(book_id): i for i, book_id in enumerate(ids)}
+
+        self.vocabularies = {}
+        for field in CATEGORICAL_FIELDS:
+            vocabulary = sorted(set(b[field] for b in books))
+            index = {v: i for i, v in enumerate(vocabulary)}
+            self.vocabularies[field] = vocabulary
+            self._columns[field] = _chunk_array(
+                np.array([index[b[field]] for b in books], dtype=np.int32))
+        self._value_codes = {
+            field: {v: i for i, v in enumerate(vocabulary)}
+            for field, vocabulary in self.vocabularies.items()
+        }
+        self._bitmaps = {}
+
+        for field in NUMERIC_FIELDS:
+            self._columns[field] = _chunk_array(np.array([b[field] for b in books], dtype=np.int64))
+        # rows written to the last chunks, by this index or a newer one
+        self._written = [self.count]
+        self._views = {}
+
+        # text: one lowercased haystack, starts[i] = offset of book i
+        # (joined lazily, so appends don't copy it)
+        self._texts = [[self._book_text(b) for b in chunk] for chunk in self._books]
+        self._text = None
+        self._text_starts = []
+        self._text_cache = lru_cache(maxsize=64)(self._text_bitmap)
+
+    @classmethod
+    def from_shared(cls, catalog) -> 'CatalogIndex':
+        """index of a SharedCatalog, without decoding its books"""
+        index = cls.__new__(cls)
+        index.count = catalog.count
+        index._shared = catalog
+        index._books = None
+        index._columns = None
+        index._written = [index.count]
+        # the mapped columns are already contiguous
+        index._views = {name: catalog.columns[name]
+                        for name in ['id'] + CATEGORICAL_FIELDS + NUMERIC_FIELDS}
+        index.positions = catalog.positions()
+        # the published vocabularies are sorted, like the ones built above
+        index.vocabularies = {field: list(catalog.vocabularies[field])
+                              for field in CATEGORICAL_FIELDS}
+        index._value_codes = {
+            field: {v: i for i, v in enumerate(vocabulary)}
+            for field, vocabulary in index.vocabularies.items()
+        }
+        index._bitmaps = {}
+        index._texts = None
+        index._text = None
+        index._text_starts = []
+        index._text_cache = lru_cache(maxsize=64)(index._text_bitmap)
+        return index
+
+    @property
+    def books(self) -> Sequence[Dict]:
+        if self._shared is not None:
+            return self._shared.books()
+        return Rows(self._books, self.count)
+
+    def _column(self, name: str) -> np.ndarray:
+        """first `count` rows of a column, contiguous (joined once per index)"""
+        view = self._views.get(name)
+        if view is None:
+            chunks = self._columns[name][:-(-self.count // CHUNK_ROWS)]
+            if len(chunks) == 1:
+                view = chunks[0][:self.count]
+            elif chunks:
+                view = np.concatenate(chunks)[:self.count]
+            else:
+                view = np.zeros(0, dtype=_dtype(name))
+            self._views[name] = view
+        return view
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._column('id')
+
+    @property
+    def codes(self) -> Dict[str, np.ndarray]:
+        return {field: self._column(field) for field in CATEGORICAL_FIELDS}
+
+    @property
+    def numeric(self) -> Dict[str, np.ndarray]:
+        return {field: self._column(field) for field in NUMERIC_FIELDS}
+
+    @staticmethod
+    def _book_text(book: Dict) -> str:
+        return _SEPARATOR.join(book[field].lower() for field in TEXT_FIELDS) + _SEPARATOR
+
+    def _join_text(self):
+        if self._shared is not None:
+            texts = [self._shared.text(i) for i in range(self.count)]
+        else:
+            # _texts may be shared with a newer index that appended to it
+            texts = Rows(self._texts, self.count)
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text)
+        self._text_starts = starts
+        self._text = ''.join(texts)
+
+    def _code(self, field: str, value: str) -> int:
+        """code of a value, appending new values to the vocabulary"""
+        codes = self._value_codes[field]
+        if value not in codes:
+            codes[value] = len(self.vocabularies[field])
+            self.vocabularies[field].append(value)
+        return codes[value]
+
+    def _write_row(self, position: int, book: Dict):
+        chunk, row = divmod(position, CHUNK_ROWS)
+        columns = self._columns
+        columns['id'][chunk][row] = book['id']
+        for field in CATEGORICAL_FIELDS:
+            columns[field][chunk][row] = self._code(field, book[field])
+        for field in NUMERIC_FIELDS:
+            columns[field][chunk][row] = book[field]
+
+    def apply(self, change: Dict) -> 'CatalogIndex':
+        """
+        apply one catalog change ({'op': 'add' | 'edit', 'position', 'book'});
+        returns the updated index, O(1) for an add, O(CHUNK_ROWS) for an edit
+        """
+        if self._shared is not None:
+            raise ValueError("the index of a shared catalog is rebuilt, not applied to")
+        position, book = change['position'], change['book']
+        index = copy.copy(self)
+        index._columns = {name: list(chunks) for name, chunks in self._columns.items()}
+        index._books = list(self._books)
+        index._texts = list(self._texts)
+        chunk, row = divmod(position, CHUNK_ROWS)
+
+        if change['op'] == 'add':
+            if position != self.count:
+                raise ValueError(f"add at position {position}, index has {self.count} books")
+            if self._written[0] != self.count:
+                # a newer index already wrote past our rows: branch off its last chunk
+                index._written = [self.count]
+                index.positions = {i: p for i, p in self.positions.items() if p < self.count}
+                if row:
+                    for chunks in index._columns.values():
+                        chunks[chunk] = chunks[chunk].copy()
+                    index._books[chunk] = index._books[chunk][:row]
+                    index._texts[chunk] = index._texts[chunk][:row]
+            if not row:
+                for name, chunks in index._columns.items():
+                    chunks.append(np.zeros(CHUNK_ROWS, dtype=_dtype(name)))
+                index._books.append([])
+                index._texts.append([])
+            # rows, books and texts past self.count are invisible to self
+            index._written[0] += 1
+            index.count += 1
+            index._books[chunk].append(book)
+            index._texts[chunk].append(self._book_text(book))
+            index.positions[book['id']] = position
+        else:
+            old = self.books[position]
+            if old['id'] != book['id']:
+                raise ValueError(f"edit of book {old['id']} changes its id")
+            # copy on write: only the chunk holding the row
+            for chunks in index._columns.values():
+                chunks[chunk] = chunks[chunk].copy()
+            index._books[chunk] = list(self._books[chunk])
+            index._books[chunk][row] = book
+            index._texts[chunk] = list(self._texts[chunk])
+            index._texts[chunk][row] = self._book_text(book)
+
+        index._write_row(position, book)
+        index._views = {}
+        index._bitmaps = {}
+        index._text = None
+        index._text_starts = []
+        index._text_cache = lru_cache(maxsize=64)(index._text_bitmap)
+        index.__dict__.pop('_by_title', None)
+        index.__dict__.pop('_by_title_author', None)
+        return index
+
+    def snapshot(self) -> Dict:
+        """decoded contents, for comparing with a rebuilt index"""
+        if self._text is None:
+            self._join_text()
+        snapshot = {
+            'ids': self.ids.tolist(),
+            'positions': {i: p for i, p in self.positions.items() if p < self.count},
+            'text': self._text,
+        }
+        for field in CATEGORICAL_FIELDS:
+            vocabulary = self.vocabularies[field]
+            snapshot[field] = [vocabulary[c] for c in self.codes[field]]
+        for field in NUMERIC_FIELDS:
+            snapshot[field] = self.numeric[field].tolist()
+        return snapshot
+
+    def all(self) -> np.ndarray:
+        return np.ones(self.count, dtype=bool)
+
+    def value_bitmap(self, field: str, value: str) -> np.ndarray:
+        key = (field, value)
+        if key not in self._bitmaps:
+            code = self._value_codes[field].get(value)
+            if code is None:
+                self._bitmaps[key] = np.zeros(self.count, dtype=bool)
+            else:
+                self._bitmaps[key] = self.codes[field] == code
+        return self._bitmaps[key]
+
+    def values_bitmap(self, field: str, values: Iterable[str]) -> np.ndarray:
+        mask = np.zeros(self.count, dtype=bool)
+        for value in values:
+            mask |= self.value_bitmap(field, value)
+        return mask
+
+    def range_bitmap(self, field: str, low: Optional[int], high: Optional[int]) -> np.ndarray:
+        column = self.numeric[field]
+        mask = self.all()
+        if low is not None:
+            mask &= column >= low
+        if high is not None:
+            mask &= column <= high
+        return mask
+
+    def _text_bitmap(self, query: str) -> np.ndarray:
+        mask = np.zeros(self.count, dtype=bool)
+        query = query.lower().replace(_SEPARATOR, '')
+        if not query:
+            return self.all()
+        if self._shared is not None and self._shared.searchable:
+            mask[self._shared.search(query)] = True
+            return mask
+        if self._text is None:
+            self._join_text()
+
+        start = self._text.find(query)
+        while start != -1:
+            i = bisect_right(self._text_starts, start) - 1
+            mask[i] = True
+            # continue from the next book - one hit per book is enough
+            next_book = self._text_starts[i + 1] if i + 1 < self.count else len(self._text)
+            start = self._text.find(query, next_book)
+        return mask
+
+    def text_bitmap(self, query: str) -> np.ndarray:
+        return self._text_cache(query)
+
+    def ids_bitmap(self, book_ids: Iterable[int]) -> np.ndarray:
+        mask = np.zeros(self.count, dtype=bool)
+        if self._shared is not None:
+            mask[list(self._shared.find(list(book_ids)).values())] = True
+            return mask
+        # positions may be shared with a newer index that has more books
+        positions = [p for p in (self.positions.get(i) for i in book_ids)
+                     if p is not None and p < self.count]
+        mask[positions] = True
+        return mask
+
+    def _build_title_index(self):
+        by_title_author = {}
+        by_title = {}
+        if self._shared is not None:
+            catalog = self._shared
+            pairs = ((catalog.string('title', i), catalog.string('author', i))
+                     for i in range(self.count))
+        else:
+            pairs = ((b['title'], b['author']) for b in self.books)
+        for i, (title, author) in enumerate(pairs):
+            title = normalize_title(title)
+            by_title_author.setdefault((title, normalize_name(author)), i)
+            by_title.setdefault(title, []).append(i)
+        self._by_title_author = by_title_author
+        self._by_title = by_title
+
+    def match_book(self, title: str, author: str = '') -> Optional[Dict]:
+        """
+        find a catalog book by title (+ author), as exported by reading
+        trackers: case, punctuation and a "(Series #1)" suffix are ignored.
+        title alone is enough when only one book has that title.
+        """
+        if not hasattr(self, '_by_title'):
+            self._build_title_index()
+
+        title = normalize_title(title)
+        position = self._by_title_author.get((title, normalize_name(author)))
+        if position is None:
+            candidates = self._by_title.get(title, [])
+            if len(candidates) != 1:
+                return None
+            position = candidates[0]
+        return self.books[position]
+
+    def facet_counts(self, field: str, mask: np.ndarray) -> Dict[str, int]:
+        counts = np.bincount(self.codes[field][mask], minlength=len(self.vocabularies[field]))
+        return {v: int(c) for v, c in zip(self.vocabularies[field], counts) if c}
+
+    def query(self,
+              text: Optional[str] = None,
+              filters: Optional[Dict[str, Union[str, Iterable[str]]]] = None,
+              pages: Optional[Tuple[Optional[int], Optional[int]]] = None,
+              year: Optional[Tuple[Optional[int], Optional[int]]] = None,
+              rated: Optional[bool] = None,
+              ratings: Optional[Dict[int, float]] = None,
+              facets: Iterable[str] = ()) -> Dict:
+        """
+        text:    substring of title / author / genre / topic (case-insensitive)
+        filters: {categorical field: value or list of accepted values}
+        pages, year: inclusive (low, high) ranges, None = open end
+        rated:   True = only books in `ratings`, False = only unrated books
+        facets:  categorical fields to count values for
+
+        returns {'books': [...], 'total': int, 'facets': {field: {value: count}}}
+        """
+        masks = {}  # filter name -> bitmap
+
+        if text:
+            masks['text'] = self.text_bitmap(text)
+        for field, value in (filters or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, str):
+                masks[field] = self.value_bitmap(field, value)
+            else:
+                masks[field] = self.values_bitmap(field, value)
+        if pages is not None:
+            masks['pages'] = self.range_bitmap('pages', *pages)
+        if year is not None:
+            masks['year'] = self.range_bitmap('year', *year)
+        if rated is not None:
+            rated_mask = self.ids_bitmap((ratings or {}).keys())
+            masks['rated'] = rated_mask if rated else ~rated_mask
+
+        result = self.all()
+        for mask in masks.values():
+            result &= mask
+
+        facet_counts = {}
+        for field in facets:
+            if field in masks:
+                # everything except this facet's own filter
+                others = self.all()
+                for name, mask in masks.items():
+                    if name != field:
+                        others &= mask
+            else:
+                others = result
+            facet_counts[field] = self.facet_counts(field, others)
+
+        positions = np.flatnonzero(result)
+        books = self.books
+        return {
+            'books': [books[int(i)] for i in positions],
+            'total': len(positions),
+            'facets': facet_counts,
+        }
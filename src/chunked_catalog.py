@@ -0,0 +1,229 @@
+"""
+chunked, compressed catalog storage (data/catalog/)
+
+books.json is one pretty-printed file that has to be parsed whole, long
+descriptions included, although only the card views show them. here the
+catalog is split in two:
+
+- hot: every field scoring, search and statistics use, stored column by
+  column in one gzip file (one column of similar values compresses well)
+- cold: descriptions, in gzip chunks of `chunk_size` consecutive book ids,
+  decompressed only when a card view asks for some ids; the last few
+  chunks are kept in memory
+
+files (<gen> = generation, bumped on every publish):
+    manifest.json            generation, books.json version, chunk id ranges,
+                             field order of the books.json records (one
+                             for all, plus the records that differ from it)
+    hot-<gen>.json.gz
+    cold-<gen>-<n>.json.gz
+
+the manifest is replaced last with os.replace, so readers see either the
+old or the new generation. the previous generation's files are kept for
+readers that opened it just before the switch.
+"""
+import gzip
+import json
+import os
+from collections import Counter
+from bisect import bisect_right
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+COLD_FIELDS = ['description']
+DEFAULT_CHUNK_SIZE = 256
+CHUNK_CACHE_SIZE = 16
+
+
+def _write_json_gz(path: Path, data):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def _read_json_gz(path: Path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _manifest_version(directory: Path):
+    try:
+        stat = (directory/"manifest.json").stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _read_manifest(directory: Path) -> Optional[Dict]:
+    try:
+        with open(directory/"manifest.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error {e} while reading {directory/'manifest.json'}")
+        return None
+
+
+def _field_order(books: List[Dict]) -> List[str]:
+    """
+    all fields, each new one right after the field before it in its record;
+    the most common key order first, so it is kept as is
+    """
+    order = []
+    for keys, _ in Counter(tuple(book) for book in books).most_common():
+        previous = -1
+        for field in keys:
+            if field not in order:
+                order.insert(previous + 1, field)
+            previous = order.index(field)
+    return order
+
+
+def publish_chunked(books: List[Dict], directory, source_version=None,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    write a new generation of the chunked catalog
+
+    source_version: version of books.json the books came from, so readers
+    can tell when books.json was changed without a publish
+    returns the new generation number
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    current = _read_manifest(directory)
+    generation = current['generation'] + 1 if current else 1
+
+    # hot columns, in the order fields first appear
+    fields = []
+    for book in books:
+        for field in book:
+            if field not in COLD_FIELDS and field not in fields:
+                fields.append(field)
+    columns = {field: [b.get(field) for b in books] for field in fields}
+    hot_file = f"hot-{generation}.json.gz"
+    _write_json_gz(directory/hot_file, {'count': len(books), 'columns': columns})
+
+    # cold chunks by id range
+    ids = sorted(b['id'] for b in books)
+    cold = {
+        b['id']: {f: b[f] for f in COLD_FIELDS if f in b}
+        for b in books if any(f in b for f in COLD_FIELDS)
+    }
+    chunks = []
+    for n, start in enumerate(range(0, len(ids), chunk_size)):
+        chunk_ids = ids[start:start + chunk_size]
+        name = f"cold-{generation}-{n}.json.gz"
+        _write_json_gz(directory/name, {str(i): cold[i] for i in chunk_ids if i in cold})
+        chunks.append({'first_id': chunk_ids[0], 'last_id': chunk_ids[-1], 'file': name})
+
+    # key order of the records, so save_books writes them back unchanged
+    fields_order = _field_order(books)
+    field_orders = {}
+    for book in books:
+        keys = list(book)
+        if keys != [field for field in fields_order if field in book]:
+            field_orders[str(book['id'])] = keys
+
+    manifest = {
+        'generation': generation,
+        'source_version': list(source_version) if source_version else None,
+        'hot': hot_file,
+        'chunks': chunks,
+        'fields': fields_order,
+        'field_orders': field_orders,
+    }
+    tmp = directory/f"manifest.json.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, directory/"manifest.json")
+
+    # keep this and the previous generation
+    for path in directory.glob("*.json.gz"):
+        file_generation = int(path.name.split('-')[1].split('.')[0])
+        if file_generation < generation - 1:
+            path.unlink(missing_ok=True)
+
+    return generation
+
+
+def open_chunked_catalog(directory) -> Optional['ChunkedCatalog']:
+    directory = Path(directory)
+    version = _manifest_version(directory)
+    manifest = _read_manifest(directory)
+    if manifest is None:
+        return None
+    return ChunkedCatalog(directory, manifest, version)
+
+
+class ChunkedCatalog:
+    def __init__(self, directory: Path, manifest: Dict, manifest_version=None):
+        self.directory = directory
+        self.manifest_version = manifest_version
+        self.generation = manifest['generation']
+        self.source_version = manifest['source_version']
+        self.hot_file = manifest['hot']
+        self.chunks = manifest['chunks']
+        # None for manifests written before the field order was kept
+        self.fields = manifest.get('fields')
+        self.field_orders = {int(i): keys for i, keys in manifest.get('field_orders', {}).items()}
+        self._first_ids = [c['first_id'] for c in self.chunks]
+        self._books = None
+        self._chunk_cache = lru_cache(maxsize=CHUNK_CACHE_SIZE)(self._read_chunk)
+
+    def is_current(self) -> bool:
+        """no newer generation published (a stat, no read)"""
+        return _manifest_version(self.directory) == self.manifest_version
+
+    def books(self) -> List[Dict]:
+        """all books without their cold fields (read once per generation)"""
+        if self._books is None:
+            data = _read_json_gz(self.directory/self.hot_file)
+            columns = data['columns']
+            books = [{} for _ in range(data['count'])]
+            for field, values in columns.items():
+                for book, value in zip(books, values):
+                    if value is not None:
+                        book[field] = value
+            self._books = books
+        # a new list each time: callers may append to it (e.g. CatalogIndex.apply)
+        return list(self._books)
+
+    def restore(self, book: Dict, cold: Dict) -> Dict:
+        """book with its cold fields back, keys in the order of books.json"""
+        if self.fields is None:
+            return {**book, **{field: value for field, value in cold.items() if field not in book}}
+        merged = {**cold, **book}
+        order = self.field_orders.get(book.get('id'), self.fields)
+        restored = {field: merged[field] for field in order if field in merged}
+        restored.update(merged)  # fields added since the publish go last
+        return restored
+
+    def _read_chunk(self, n: int) -> Dict[int, Dict]:
+        data = _read_json_gz(self.directory/self.chunks[n]['file'])
+        return {int(k): v for k, v in data.items()}
+
+    def _chunk_of(self, book_id: int) -> Optional[int]:
+        n = bisect_right(self._first_ids, book_id) - 1
+        if n < 0 or book_id > self.chunks[n]['last_id']:
+            return None
+        return n
+
+    def cold_fields(self, book_ids: Iterable[int]) -> Dict[int, Dict]:
+        """{book_id: {'description': ...}}, reading only the chunks needed"""
+        by_chunk = {}
+        for book_id in book_ids:
+            n = self._chunk_of(book_id)
+            if n is not None:
+                by_chunk.setdefault(n, []).append(book_id)
+
+        result = {}
+        for n, chunk_ids in by_chunk.items():
+            chunk = self._chunk_cache(n)
+            for book_id in chunk_ids:
+                if book_id in chunk:
+                    result[book_id] = chunk[book_id]
+        return result
@@ -0,0 +1,162 @@
+"""
+thread safety for objects shared by all Streamlit sessions (cache_resource)
+
+- writers of one directory / file are serialized by a WriteLock (one per
+  path in the process, so two BookRecommender objects for the same user
+  share it). read-modify-write (load ratings, change, save) runs under it.
+- readers don't take the lock. they use the last published snapshot (an
+  immutable object, swapped in with one assignment) and re-read files only
+  when they changed. the lock's generation works like a seqlock: odd while
+  a write is in progress, so a reader can tell that files it just read
+  may be half-updated and read again (or keep the previous snapshot).
+- files are written to a temp file and moved into place with os.replace,
+  so no reader - in this or another process - ever sees a partial file.
+- across processes (several app workers on one data directory) the writer
+  also holds an exclusive flock on a lock file next to the data, and a
+  reader that has to read files again holds a shared one, so it never
+  reads the files of another process's unfinished write. without fcntl
+  (Windows) this part is off: run one worker process there.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Optional, TypeVar
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+T = TypeVar('T')
+
+
+class WriteLock:
+    def __init__(self, lock_path: Optional[Path] = None):
+        self._lock = threading.RLock()
+        self._owner = None
+        self.depth = 0
+        self.generation = 0  # odd while a write is in progress
+        # cross-process part (None = this process only)
+        self.lock_path = lock_path if fcntl is not None else None
+        self._fd = None
+        self._fd_pid = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self.depth == 0:
+            try:
+                self._lock_file(fcntl.LOCK_EX if self.lock_path else None)
+            except BaseException:
+                self._lock.release()
+                raise
+            self._owner = threading.get_ident()
+            self.generation += 1
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.generation += 1
+            self._owner = None
+            self._lock_file(fcntl.LOCK_UN if self.lock_path else None)
+        self._lock.release()
+
+    def _lock_file(self, operation):
+        if operation is None:
+            return
+        if self._fd is None or self._fd_pid != os.getpid():
+            # a forked child must not share the parent's open file (and its lock)
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._fd_pid = os.getpid()
+        fcntl.flock(self._fd, operation)
+
+    @contextmanager
+    def _shared(self, wait: bool = True):
+        """
+        no other process is writing while the block runs; wait=False yields
+        False at once instead of waiting for one that is
+        """
+        if self.lock_path is None or self.owned():
+            # the owner already holds the file lock (a second one would wait for it)
+            yield True
+            return
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def owned(self) -> bool:
+        return self._owner == threading.get_ident()
+
+    def busy(self) -> bool:
+        """another thread is writing right now"""
+        owner = self._owner
+        return owner is not None and owner != threading.get_ident()
+
+    def read(self, read: Callable[[], T], retries: int = 3, stale: Optional[T] = None) -> T:
+        """
+        run read() (e.g. reading several files) without overlapping a write;
+        lock-free unless writes keep overlapping it. stale: returned instead
+        of waiting while another process is writing (readers never wait for
+        writers, and a writer holding another lock can't deadlock with us)
+        """
+        for _ in range(retries):
+            generation = self.generation
+            if generation % 2 == 0 or self.owned():
+                with self._shared(wait=stale is None) as free:
+                    if not free:
+                        return stale
+                    result = read()
+                if self.generation == generation:
+                    return result
+        with self:
+            return read()
+
+
+_locks: Dict[str, WriteLock] = {}
+_locks_guard = threading.Lock()
+
+
+def write_lock(path) -> WriteLock:
+    """
+    the process-wide WriteLock of a file or directory; other processes are
+    locked out through <dir>/.lock or <file>.lock
+    """
+    key = os.path.abspath(path)
+    with _locks_guard:
+        if key not in _locks:
+            lock_path = Path(key)/".lock" if os.path.isdir(key) else Path(f"{key}.lock")
+            _locks[key] = WriteLock(lock_path)
+        return _locks[key]
+
+
+def atomic_write_json(path, data, indent=2):
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        # dumps, not dump: with indent=None it runs the C encoder
+        text = json.dumps(data, ensure_ascii=False, indent=indent)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def file_version(path):
+    """(mtime, size, inode) - changes on every os.replace, None if missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
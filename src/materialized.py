@@ -0,0 +1,249 @@
+"""
+materialized top-N recommendations of one user
+
+the best `size` unrated books for the user's current profile, in the order
+get_recommendations returns them (score, then catalog position):
+
+    rows = [[position, book_id, score], ...]
+
+saved next to the profile (user_recommendations.json) and served by
+get_recommendations without scoring the catalog. the versions of the
+profile file and books.json it was built from are kept with it, a list
+built for older ones is rebuilt:
+- after the user's own rating changes (BookRecommender._writing)
+- on the first request after a change made by another process
+
+a rating moves the average rating, and with it the preference for every
+value, so every score changes and the whole list is re-ranked. that is
+done on the catalog index's code columns (build_from_index): one
+preference per value of each feature, scores for all books by a few numpy
+gathers, and score_book's rounding only for the books that can reach the
+list (a few ms at 50k books, vs ~0.5 s calling score_book per book).
+
+added / edited books come from the catalog feed (apply): a book enters
+the list only if it scores above the last row (the k-th score), so an
+addition costs one score_book call instead of a rebuild.
+
+rows are a prefix of the full ranking; a request is served from them when
+the prefix is long enough for it (see BookRecommender._serve_materialized).
+"""
+import heapq
+import json
+import time
+from bisect import insort
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.concurrency import atomic_write_json
+
+# time-decayed profiles drift between writes: re-score at least this often
+DECAYED_MAX_AGE = 3600
+
+
+def index_sums(weights: Dict, index, profile: Dict) -> np.ndarray:
+    """
+    score_book's sum for every book of a CatalogIndex, before rounding:
+    one preference per value of each feature, gathered by the code columns.
+    same products added in the same order as score_book, so the same floats
+    """
+    from src.recommender import FEATURES
+
+    if profile['total_ratings'] == 0:
+        return np.full(index.count, 3.0)
+    sums = np.zeros(index.count)
+    for feature, (field, preferences_key) in FEATURES.items():
+        preferences = profile[preferences_key]
+        average = profile['average_rating']
+        # the vocabulary may be shared with a newer index: longer is fine
+        table = np.array([preferences.get(value, average)
+                          for value in index.vocabularies[field]], dtype=float)
+        sums += table[index.codes[field]] * weights[feature]
+    return sums
+
+
+def round_scores(sums: np.ndarray) -> np.ndarray:
+    """
+    round(x, 2) of every sum: np.rint picks the same hundredth except when
+    x * 100 lies next to a half, those few go through python's round
+    """
+    scaled = sums * 100
+    scores = np.rint(scaled) / 100
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        scores[i] = round(float(sums[i]), 2)
+    return scores
+
+
+def _as_list(version):
+    """file versions are tuples in memory, lists once saved as json"""
+    return list(version) if version is not None else None
+
+
+class MaterializedTopN:
+    def __init__(self, data: Dict):
+        self.built_at = data['built_at']
+        self.profile_version = data['profile_version']
+        self.catalog_version = data['catalog_version']
+        self.catalog_size = data['catalog_size']
+        self.weights = data['weights']
+        # lists saved before the decay setting was kept were built without it
+        self.half_life_days = data.get('half_life_days')
+        self.size = data['size']
+        # unrated books in the catalog; rows hold all of them if len(rows) == unrated
+        self.unrated = data['unrated']
+        self.rows = data['rows']
+
+    @property
+    def complete(self) -> bool:
+        return len(self.rows) == self.unrated
+
+    @classmethod
+    def build(cls, scorer, books: Sequence[Dict], profile: Dict, rated, size: int,
+              profile_version, catalog_version) -> 'MaterializedTopN':
+        """scorer: the BookRecommender (score_book + weights)"""
+        scored = []
+        for position, book in enumerate(books):
+            if book['id'] not in rated:
+                scored.append((-scorer.score_book(book, profile)['score'], position, book['id']))
+
+        return cls({
+            'built_at': time.time(),
+            'profile_version': _as_list(profile_version),
+            'catalog_version': _as_list(catalog_version),
+            'catalog_size': len(books),
+            'weights': dict(scorer.weights),
+            'half_life_days': scorer.half_life_days,
+            'size': size,
+            'unrated': len(scored),
+            'rows': [[position, book_id, -score]
+                     for score, position, book_id in heapq.nsmallest(size, scored)],
+        })
+
+    @classmethod
+    def build_from_index(cls, scorer, index, profile: Dict, rated, size: int,
+                         profile_version, catalog_version) -> 'MaterializedTopN':
+        """
+        same rows as build over index.books, scored from the code columns
+        (index_sums); books more than 0.02 below the k-th sum round below it
+        and are dropped before rounding and sorting the rest
+        """
+        count = index.count
+        sums = index_sums(scorer.weights, index, profile)
+
+        positions = np.flatnonzero(~index.ids_bitmap(rated))
+        unrated = len(positions)
+        if unrated > size > 0:
+            candidates = sums[positions]
+            kth = np.partition(candidates, unrated - size)[unrated - size]
+            positions = positions[candidates >= kth - 0.02]
+        scores = round_scores(sums[positions])
+        order = np.lexsort((positions, -scores))[:size]
+
+        return cls({
+            'built_at': time.time(),
+            'profile_version': _as_list(profile_version),
+            'catalog_version': _as_list(catalog_version),
+            'catalog_size': count,
+            'weights': dict(scorer.weights),
+            'half_life_days': scorer.half_life_days,
+            'size': size,
+            'unrated': unrated,
+            'rows': [[int(positions[i]), int(index.ids[positions[i]]), float(scores[i])]
+                     for i in order],
+        })
+
+    @classmethod
+    def load(cls, path: Path) -> Optional['MaterializedTopN']:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error {e} while reading {path}")
+            return None
+
+    def save(self, path: Path):
+        data = {
+            'built_at': self.built_at,
+            'profile_version': self.profile_version,
+            'catalog_version': self.catalog_version,
+            'catalog_size': self.catalog_size,
+            'weights': self.weights,
+            'half_life_days': self.half_life_days,
+            'size': self.size,
+            'unrated': self.unrated,
+            'rows': self.rows,
+        }
+        try:
+            atomic_write_json(path, data, indent=None)
+        except Exception as e:
+            print(f"Error {e} while saving {path}")
+
+    def built_for(self, profile_version, catalog_version) -> bool:
+        return (self.profile_version == _as_list(profile_version) and
+                self.catalog_version == _as_list(catalog_version))
+
+    def is_fresh(self, profile_version, catalog_version, weights: Dict, size: int,
+                 half_life_days: Optional[float] = None, max_age: Optional[float] = None) -> bool:
+        """
+        built from these files with these weights and decay setting
+        (max_age: for decayed profiles)
+        """
+        if max_age is not None and time.time() - self.built_at > max_age:
+            return False
+        return (self.built_for(profile_version, catalog_version) and
+                self.weights == weights and self.size == size and
+                self.half_life_days == half_life_days)
+
+    def apply(self, change: Dict, score: Optional[float]) -> Optional['MaterializedTopN']:
+        """
+        the list after one catalog change (see src/catalog_feed.py); score
+        is the book's new score, None if the user rated it. None = the list
+        was not built for the catalog the change applies to
+        """
+        position, book = change['position'], change['book']
+        # several changes of one write share their versions
+        if self.catalog_version not in (_as_list(change['before']), _as_list(change['after'])):
+            return None
+        updated = MaterializedTopN({
+            'built_at': self.built_at,
+            'profile_version': self.profile_version,
+            'catalog_version': _as_list(change['after']),
+            'catalog_size': self.catalog_size,
+            'weights': self.weights,
+            'half_life_days': self.half_life_days,
+            'size': self.size,
+            'unrated': self.unrated,
+            'rows': list(self.rows),
+        })
+
+        if change['op'] == 'add':
+            if position != self.catalog_size:
+                return None
+            updated.catalog_size += 1
+            if score is not None:
+                updated.unrated += 1
+        else:
+            if position >= self.catalog_size:
+                return None
+            # take the book out, put it back in at its new score below
+            updated.rows = [row for row in self.rows if row[0] != position]
+
+        if score is not None:
+            row = [position, book['id'], score]
+            key = (-score, position)
+            # only the k-th score matters: below it the book can't be in the list
+            if self.complete or (updated.rows and key < (-updated.rows[-1][2], updated.rows[-1][0])):
+                insort(updated.rows, row, key=lambda r: (-r[2], r[0]))
+                del updated.rows[self.size:]
+        return updated
+
+    def differences(self, other: 'MaterializedTopN') -> List[str]:
+        """what differs from another list (e.g. a rebuild), [] = same"""
+        problems = []
+        for name in ('catalog_size', 'unrated', 'rows'):
+            if getattr(self, name) != getattr(other, name):
+                problems.append(f"materialized.{name}: incremental list differs from a rebuild")
+        return problems
@@ -0,0 +1,308 @@
+"""
+popularity / quality ranking across all users, for cold-start users
+
+every book gets the same Bayesian weighted average used for the profile
+(see BookRecommender._update_profile), computed over all users' ratings:
+
+    score = (v / (v + m)) × R + (m / (v + m)) × C
+
+R: book's average rating, v: number of ratings, C: average of all ratings.
+
+the ranking is built in one pass over all ratings files, saved to
+data/popularity.json and refreshed once it is older than max_age. it keeps
+catalog positions next to ids, so serving k books is an O(k) slice.
+
+books added to the catalog are inserted without a rebuild (apply): with no
+ratings their score is C and they come after every unrated book already
+there, so all of them go in one place, found once by bisection. the
+ranking is kept as the rows it was built / loaded with plus the added rows
+spliced in at that place, and an edit that changes a book's genre is kept
+as an overlay; apply returns a new ranking sharing these (an add appends
+to the shared list of added rows, rows past its own count are invisible to
+the older ranking), so it is O(1) for an add and O(edited books) for an
+edit, and the one other threads may still be reading is not changed.
+ranking / by_genre put the full lists together, O(N), for saving and
+comparing with a rebuild.
+"""
+import json
+import copy
+import heapq
+import random
+import time
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from src.concurrency import atomic_write_json
+
+
+def user_ratings_files(data_dir: Path) -> List[Path]:
+    """default user's ratings + data/users/<user_id>/user_ratings.json"""
+    files = [data_dir/"user_ratings.json"]
+    files.extend(sorted((data_dir/"users").glob("*/user_ratings.json")))
+    return [f for f in files if f.exists()]
+
+
+def _rank_key(row: List):
+    return -row[2], -row[3], row[0]
+
+
+class PopularityRanking:
+    def __init__(self, data: Dict):
+        self.built_at = data['built_at']
+        self.global_average = data['global_average']
+        self.catalog_size = data['catalog_size']
+        # [[position, book_id, score, count, average], ...] best first, and
+        # genre -> indexes into it, best first: as built / loaded, not changed
+        self._base = data['ranking']
+        self._base_by_genre = data['by_genre']
+        # added books (shared by the rankings apply derives from this one,
+        # each sees the first _n_added), spliced in at _split
+        self._added = []
+        self._added_by_genre = {}  # genre -> offsets into _added
+        self._n_added = 0
+        C = round(self.global_average, 4)
+        self._split = bisect_right(self._base, (-C, 0, float('inf')), key=_rank_key)
+        # position -> (genre it was built with, current genre), edited books only
+        self._moved = {}
+        self._base_index = {}  # position -> index into _base, filled on the first edit
+
+    def __len__(self) -> int:
+        return len(self._base) + self._n_added
+
+    def _row(self, i: int) -> List:
+        """row i of the full ranking"""
+        if i < self._split:
+            return self._base[i]
+        if i < self._split + self._n_added:
+            return self._added[i - self._split]
+        return self._base[i - self._n_added]
+
+    def _index_of(self, position: int) -> int:
+        """index in the full ranking of a catalog position"""
+        if position >= len(self._base):
+            return self._split + position - len(self._base)
+        if not self._base_index:
+            self._base_index.update((row[0], i) for i, row in enumerate(self._base))
+        i = self._base_index[position]
+        return i if i < self._split else i + self._n_added
+
+    @property
+    def ranking(self) -> List[List]:
+        return list(self._ordered(stratify=False))
+
+    @property
+    def by_genre(self) -> Dict[str, List[int]]:
+        return {genre: list(indexes) for genre, indexes in self._genre_indexes().items()}
+
+    @classmethod
+    def build(cls, data_dir: Path, books: Sequence[Dict], m: float) -> 'PopularityRanking':
+        sums = {}
+        counts = {}
+        for path in user_ratings_files(Path(data_dir)):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    ratings = json.load(f)
+            except Exception as e:
+                print(f"Error {e} while reading {path}")
+                continue
+            for book_id, rating in ratings.items():
+                book_id = int(book_id)
+                sums[book_id] = sums.get(book_id, 0.0) + float(rating)
+                counts[book_id] = counts.get(book_id, 0) + 1
+
+        total = sum(counts.values())
+        C = sum(sums.values()) / total if total else 3.0
+
+        rows = []
+        for position, book in enumerate(books):
+            v = counts.get(book['id'], 0)
+            R = sums[book['id']] / v if v else C
+            score = (v / (v + m)) * R + (m / (v + m)) * C
+            rows.append([position, book['id'], round(score, 4), v, round(R, 4)])
+
+        # best score first, then more ratings, then catalog order
+        rows.sort(key=_rank_key)
+
+        by_genre = {}
+        for i, row in enumerate(rows):
+            by_genre.setdefault(books[row[0]]['genre'], []).append(i)
+
+        return cls({
+            'built_at': time.time(),
+            'global_average': C,
+            'catalog_size': len(books),
+            'ranking': rows,
+            'by_genre': by_genre,
+        })
+
+    @classmethod
+    def load(cls, path: Path) -> Optional['PopularityRanking']:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error {e} while reading {path}")
+            return None
+
+    def save(self, path: Path):
+        data = {
+            'built_at': self.built_at,
+            'global_average': self.global_average,
+            'catalog_size': self.catalog_size,
+            'ranking': self.ranking,
+            'by_genre': self.by_genre,
+        }
+        try:
+            atomic_write_json(path, data, indent=None)
+        except Exception as e:
+            print(f"Error {e} while saving {path}")
+
+    def _derived(self) -> 'PopularityRanking':
+        updated = copy.copy(self)
+        if len(self._added) != self._n_added:
+            # a newer ranking already appended to the shared rows: branch off
+            updated._added = self._added[:self._n_added]
+            updated._added_by_genre = {
+                genre: offsets[:bisect_left(offsets, self._n_added)]
+                for genre, offsets in self._added_by_genre.items()
+            }
+        return updated
+
+    def apply(self, change: Dict) -> Optional['PopularityRanking']:
+        """
+        the ranking after one catalog change (see src/catalog_feed.py);
+        None if it was not built for the catalog the change applies to
+        and must be rebuilt instead
+        """
+        position, book = change['position'], change['book']
+
+        if change['op'] == 'add':
+            if position != self.catalog_size:
+                return None
+            updated = self._derived()
+            C = round(self.global_average, 4)
+            updated._added_by_genre.setdefault(book['genre'], []).append(updated._n_added)
+            updated._added.append([position, book['id'], C, 0, C])
+            updated._n_added += 1
+            updated.catalog_size += 1
+            return updated
+
+        old = change['old']
+        if position >= self.catalog_size:
+            return None
+        if old['genre'] == book['genre']:
+            return self
+        updated = self._derived()
+        updated._moved = dict(self._moved)
+        built_with = self._moved.get(position, (old['genre'], None))[0]
+        if built_with == book['genre']:
+            del updated._moved[position]
+        else:
+            updated._moved[position] = (built_with, book['genre'])
+        return updated
+
+    def differences(self, other: 'PopularityRanking') -> List[str]:
+        """what differs from another ranking (e.g. a rebuild), [] = same"""
+        problems = []
+        for name in ('global_average', 'catalog_size', 'ranking', 'by_genre'):
+            if getattr(self, name) != getattr(other, name):
+                problems.append(f"popularity.{name}: incremental state differs from a rebuild")
+        return problems
+
+    def is_fresh(self, books: Sequence[Dict], max_age: float) -> bool:
+        """not too old and still built for this catalog (O(1) spot check)"""
+        if time.time() - self.built_at > max_age:
+            return False
+        if len(books) != self.catalog_size:
+            return False
+        for row in (self._row(0), self._row(len(self) - 1)) if len(self) else ():
+            if books[row[0]]['id'] != row[1]:
+                return False
+        return True
+
+    def _genre_indexes(self) -> Dict[str, Iterator[int]]:
+        """genre -> indexes into the full ranking, best first (lazy)"""
+        n_added, split = self._n_added, self._split
+        moved_in = {}
+        for position, (_, genre) in self._moved.items():
+            moved_in.setdefault(genre, []).append(self._index_of(position))
+
+        def indexes(genre: str) -> Iterator[int]:
+            base = self._base_by_genre.get(genre, [])
+            cut = bisect_left(base, split)
+            offsets = self._added_by_genre.get(genre, [])
+            merged = heapq.merge(
+                chain(islice(base, cut),
+                      (split + o for o in islice(offsets, bisect_left(offsets, n_added))),
+                      (i + n_added for i in islice(base, cut, None))),
+                sorted(moved_in.get(genre, []))
+            )
+            for i in merged:
+                moved = self._moved.get(self._row(i)[0])
+                if moved is None or moved[1] == genre:
+                    yield i
+
+        genres = set(self._base_by_genre) | set(self._added_by_genre) | set(moved_in)
+        result = {}
+        for genre in genres:
+            # peek: a genre whose books all moved to another one is gone
+            queue = indexes(genre)
+            first = next(queue, None)
+            if first is not None:
+                result[genre] = chain([first], queue)
+        return result
+
+    def _ordered(self, stratify: bool) -> Iterable[List]:
+        if not stratify:
+            yield from chain(islice(self._base, self._split),
+                             islice(self._added, self._n_added),
+                             islice(self._base, self._split, None))
+            return
+
+        # round-robin over genres, genres ordered by their best book
+        queues = []
+        for queue in self._genre_indexes().values():
+            first = next(queue)
+            queues.append((first, chain([first], queue)))
+        queues = [queue for _, queue in sorted(queues, key=lambda q: q[0])]
+        while queues:
+            live = []
+            for queue in queues:
+                i = next(queue, None)
+                if i is not None:
+                    yield self._row(i)
+                    live.append(queue)
+            queues = live
+
+    def top(self, books: Sequence[Dict], k: int,
+            exclude: Iterable[int] = (),
+            seed: Optional[int] = None,
+            stratify: bool = False,
+            pool_factor: int = 3) -> List[Tuple[Dict, List]]:
+        """
+        best k books not in `exclude` as [(book, row), ...]
+
+        seed: pick k out of the best k × pool_factor (keeping rank order),
+        so different sessions see some variety while one session's reruns
+        always get the same list
+        """
+        exclude = set(exclude)
+        size = k * pool_factor if seed is not None else k
+
+        pool = []
+        for row in self._ordered(stratify):
+            if row[1] in exclude:
+                continue
+            pool.append(row)
+            if len(pool) == size:
+                break
+
+        if seed is not None and len(pool) > k:
+            picked = sorted(random.Random(seed).sample(range(len(pool)), k))
+            pool = [pool[i] for i in picked]
+
+        return [(books[row[0]], row) for row in pool[:k]]
@@ -0,0 +1,133 @@
+"""
+time-decayed preference profile
+
+a rating given `age` seconds ago has weight 2^(-age / half_life), so a
+rating one half-life old counts half as much as one given today.
+
+instead of re-weighting every rating on each request, we keep per feature
+value decayed sums relative to a global decay clock (t0):
+
+    S = Σ rating_i × 2^((t_i - t0) / half_life)
+    W = Σ 2^((t_i - t0) / half_life)
+
+adding/removing a rating touches one entry per feature -> O(1).
+at time T the decayed mean is S / W (independent of T) and the decayed
+count is W × 2^((t0 - T) / half_life), which feeds the same Bayesian
+average used by the non-decayed profile. when the clock falls too far
+behind, all sums are rescaled to a new clock (rare, O(feature values)).
+
+state layout (stored under profile['decay']):
+    {
+        'half_life_days': float,
+        'clock': t0 (unix seconds),
+        'total': [S, W, n],
+        'genre_preferences': {value: [S, W, n]}, ...
+    }
+n is the raw number of ratings, used to drop entries whose ratings
+were all removed.
+"""
+from typing import Dict, Iterable, Tuple
+
+# rescale the sums before 2^exponent gets anywhere near float overflow
+_MAX_EXPONENT = 64
+
+
+def new_state(half_life_days: float, clock: float, profile_keys: Iterable[str]) -> Dict:
+    state = {
+        'half_life_days': half_life_days,
+        'clock': clock,
+        'total': [0.0, 0.0, 0],
+    }
+    for key in profile_keys:
+        state[key] = {}
+    return state
+
+
+def _half_life_seconds(state: Dict) -> float:
+    return state['half_life_days'] * 86400
+
+
+def _rescale(state: Dict, new_clock: float):
+    factor = 2 ** ((state['clock'] - new_clock) / _half_life_seconds(state))
+    state['clock'] = new_clock
+
+    state['total'][0] *= factor
+    state['total'][1] *= factor
+    for entries in state.values():
+        if isinstance(entries, dict):
+            for entry in entries.values():
+                entry[0] *= factor
+                entry[1] *= factor
+
+
+def apply_rating(state: Dict, feature_values: Dict[str, str], rating: float,
+                 timestamp: float, sign: int = 1):
+    """
+    add (sign=1) or remove (sign=-1) one rating in O(1)
+
+    feature_values: {profile key: book's value}, e.g. {'genre_preferences': 'علمی'}
+    """
+    exponent = (timestamp - state['clock']) / _half_life_seconds(state)
+    if exponent > _MAX_EXPONENT:
+        _rescale(state, timestamp)
+        exponent = 0.0
+
+    weight = 2 ** exponent
+
+    entries = [state['total']]
+    for key, value in feature_values.items():
+        if value not in state[key]:
+            state[key][value] = [0.0, 0.0, 0]
+        entries.append(state[key][value])
+
+    for entry in entries:
+        entry[0] += sign * rating * weight
+        entry[1] += sign * weight
+        entry[2] += sign
+
+    for key, value in feature_values.items():
+        if state[key][value][2] <= 0:
+            del state[key][value]
+    if state['total'][2] <= 0:
+        state['total'] = [0.0, 0.0, 0]
+
+
+def build_state(half_life_days: float,
+                entries: Iterable[Tuple[Dict[str, str], float, float]],
+                profile_keys: Iterable[str]) -> Dict:
+    """
+    full recomputation from (feature_values, rating, timestamp) entries
+    """
+    entries = list(entries)
+    clock = max((timestamp for _, _, timestamp in entries), default=0.0)
+
+    state = new_state(half_life_days, clock, profile_keys)
+    for feature_values, rating, timestamp in entries:
+        apply_rating(state, feature_values, rating, timestamp)
+    return state
+
+
+def preferences_at(state: Dict, now: float, m: float,
+                   profile_keys: Iterable[str]) -> Tuple[Dict[str, Dict[str, float]], float]:
+    """
+    Bayesian weighted averages at time `now`
+
+    returns ({profile key: {value: score}}, decayed overall average)
+    """
+    total_sum, total_weight, _ = state['total']
+    if total_weight <= 0:
+        return {key: {} for key in profile_keys}, 0
+
+    scale = 2 ** ((state['clock'] - now) / _half_life_seconds(state))
+    C = total_sum / total_weight  # decayed total average
+
+    preferences = {}
+    for key in profile_keys:
+        preferences[key] = {}
+        for value, (s, w, _) in state[key].items():
+            if w <= 0:
+                # all ratings of this value decayed below float precision
+                continue
+            v = w * scale  # decayed number of ratings
+            preferences[key][value] = (v / (v + m)) * (s / w) + (m / (v + m)) * C
+    return preferences, C
@@ -0,0 +1,195 @@
+"""
+opt-in sampling profiler for Streamlit reruns
+
+a background thread looks at the stack of the thread running the page
+every `interval` seconds (sys._current_frames) and counts identical
+stacks. nothing is traced per call, so the cost is one stack walk per
+sample; interval, stack depth and run time are all capped, which keeps
+the overhead bounded enough to switch it on briefly in production
+(benchmarks/profiler_overhead.py).
+
+the sampler needs the GIL, so while the page runs python code it gets
+far fewer samples than duration / interval; a sample therefore stands for
+the measured sampling time / number of samples, not for `interval`.
+
+each profiled rerun is written to
+    <out_dir>/<time>_<page>_<request_id>.collapsed       (flamegraph.pl / speedscope)
+    <out_dir>/<time>_<page>_<request_id>.speedscope.json (speedscope.app)
+only the newest `keep` reruns are kept.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+MIN_INTERVAL = 0.001
+MAX_DEPTH = 128
+DEFAULT_KEEP = 50
+_SUFFIXES = ('.collapsed', '.speedscope.json')
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, max_duration: float = 30.0,
+                 thread_id: Optional[int] = None):
+        self.interval = max(interval, MIN_INTERVAL)
+        self.max_duration = max_duration
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+
+        self.samples = Counter()  # tuple of (file, function, line) root -> leaf
+        self.sample_count = 0
+        self.started = None
+        self.duration = 0.0
+        self.sampled = 0.0  # time the sampler ran (stops at max_duration)
+        self._sampling_ended = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+
+        self.samples[tuple(stack)] += 1
+        self.sample_count += 1
+
+    def _run(self):
+        deadline = self.started + self.max_duration
+        while not self._stop.wait(self.interval):
+            if time.perf_counter() > deadline:
+                self._sampling_ended = deadline
+                break
+            self._sample()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started
+        self.sampled = (self._sampling_ended or self.started + self.duration) - self.started
+
+    @property
+    def sample_weight(self) -> float:
+        """seconds one sample stands for"""
+        return self.sampled / self.sample_count if self.sample_count else self.interval
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        filename, function, line = frame
+        return f"{function} ({Path(filename).name}:{line})"
+
+    def collapsed(self) -> str:
+        """one line per unique stack: 'root;caller;leaf count'"""
+        return "\n".join(
+            f"{';'.join(self._frame_name(f) for f in stack)} {count}"
+            for stack, count in self.samples.most_common()
+        ) + "\n"
+
+    def speedscope(self, name: str) -> dict:
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        for stack, count in self.samples.items():
+            indexes = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({'name': frame[1], 'file': frame[0], 'line': frame[2]})
+                indexes.append(frame_index[frame])
+            samples.append(indexes)
+            weights.append(count * self.sample_weight)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'book-recommender sampling profiler',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+    def save(self, out_dir: Path, page: str, request_id: str,
+             keep: int = DEFAULT_KEEP) -> Path:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stem = f"{time.strftime('%Y%m%d-%H%M%S')}_{page}_{request_id}"
+
+        with open(out_dir/f"{stem}.collapsed", 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+        with open(out_dir/f"{stem}.speedscope.json", 'w', encoding='utf-8') as f:
+            json.dump(self.speedscope(f"{page} {request_id}"), f)
+        prune_profiles(out_dir, keep)
+        return out_dir/stem
+
+
+def prune_profiles(out_dir: Path, keep: int):
+    """delete all but the newest `keep` profiled reruns in out_dir"""
+    runs = sorted(Path(out_dir).glob('*.collapsed'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for collapsed in runs[keep:]:
+        stem = collapsed.name[:-len('.collapsed')]
+        for suffix in _SUFFIXES:
+            try:
+                (Path(out_dir)/f"{stem}{suffix}").unlink()
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def profile_rerun(page: str, out_dir="profiles", interval: float = 0.005,
+                  max_duration: float = 30.0, request_id: Optional[str] = None,
+                  keep: int = DEFAULT_KEEP):
+    """
+    profile the body of the with-block (one page run) and write the files,
+    also when the page ends with an exception such as st.rerun()
+    """
+    request_id = request_id or uuid.uuid4().hex[:8]
+    profiler = SamplingProfiler(interval=interval, max_duration=max_duration)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        try:
+            path = profiler.save(out_dir, page, request_id, keep)
+            print(f"profile of {page} ({profiler.duration * 1000:.0f} ms, "
+                  f"{profiler.sample_count} samples) -> {path}.*")
+        except Exception as e:
+            print(f"Error {e} while saving profile")
+
+
+def profiling_enabled(query_params=None) -> bool:
+    """
+    BOOK_RECOMMENDER_PROFILE=1: every rerun
+    BOOK_RECOMMENDER_PROFILE=url: reruns with ?profile=1 in the page url
+    unset: never (a visitor can't switch it on)
+    """
+    mode = os.environ.get("BOOK_RECOMMENDER_PROFILE")
+    if mode == "1":
+        return True
+    return mode == "url" and bool(query_params) and query_params.get("profile") == "1"
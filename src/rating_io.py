@@ -0,0 +1,191 @@
+"""
+bulk ratings import / export (CSV or JSONL)
+
+accepted rows (column names are matched case-insensitively):
+- our own export:        book_id, rating[, rated_at]
+- Goodreads-style CSV:   Title, Author, My Rating[, Date Read, Date Added]
+  (My Rating 0 means "not rated" and is skipped)
+
+rows are streamed from the file, so memory grows with the number of
+ratings, not with the file size. see BookRecommender.import_ratings.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+ProgressCallback = Callable[[float, str], None]
+
+# not 'Book Id': in Goodreads exports that is Goodreads' own id
+_ID_COLUMNS = ['book_id']
+_RATING_COLUMNS = ['rating', 'my rating']
+_TITLE_COLUMNS = ['title']
+_AUTHOR_COLUMNS = ['author', 'author l-f']
+_TIME_COLUMNS = ['rated_at', 'date read', 'date added']
+
+
+def _open_binary(source):
+    """path or binary file object (e.g. a Streamlit upload) -> (file, size, close?)"""
+    if isinstance(source, (str, Path)):
+        path = Path(source)
+        return open(path, 'rb'), path.stat().st_size, True
+    try:
+        size = source.seek(0, io.SEEK_END)
+        source.seek(0)
+    except (AttributeError, OSError):
+        size = None
+    return source, size, False
+
+
+def _lines(f, size: Optional[int], progress: Optional[ProgressCallback],
+           every: int = 1000) -> Iterator[str]:
+    done = 0
+    for n, raw in enumerate(f):
+        done += len(raw)
+        if progress and size and n % every == 0:
+            progress(min(done / size, 1.0), "reading")
+        yield raw.decode('utf-8-sig') if n == 0 else raw.decode('utf-8')
+
+
+def _pick(row: Dict[str, str], names: List[str]) -> Optional[str]:
+    for name in names:
+        value = row.get(name)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def parse_time(value) -> Optional[float]:
+    """unix seconds, ISO date/time or Goodreads' 2024/01/31 -> unix seconds"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for parse in (datetime.fromisoformat,
+                  lambda v: datetime.strptime(v, '%Y/%m/%d')):
+        try:
+            return parse(value).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_number(value):
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def _row(line: int, record: Dict) -> Dict:
+    row = {str(k).strip().lower(): v for k, v in record.items() if k is not None}
+    return {
+        'line': line,
+        'book_id': _parse_number(_pick(row, _ID_COLUMNS)),
+        'title': _pick(row, _TITLE_COLUMNS),
+        'author': _pick(row, _AUTHOR_COLUMNS) or '',
+        'rating': _parse_number(_pick(row, _RATING_COLUMNS)),
+        'time': parse_time(_pick(row, _TIME_COLUMNS)),
+        'error': None,
+    }
+
+
+def _jsonl_rows(lines: Iterator[str]) -> Iterator[Dict]:
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield {'line': n, 'error': f"invalid JSON: {e.msg}"}
+            continue
+        if not isinstance(record, dict):
+            yield {'line': n, 'error': "each line must be a JSON object"}
+            continue
+        yield _row(n, record)
+
+
+def _csv_rows(lines: Iterator[str]) -> Iterator[Dict]:
+    reader = csv.DictReader(lines)
+    while True:
+        try:
+            record = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield {'line': reader.line_num, 'error': f"invalid CSV: {e}"}
+            continue
+        # line_num: lines read so far (header included) = the record's last line
+        yield _row(reader.line_num, record)
+
+
+def read_rating_rows(source, progress: Optional[ProgressCallback] = None,
+                     file_format: Optional[str] = None) -> Iterator[Dict]:
+    """
+    stream normalized rows:
+        {'line': n, 'book_id': ..., 'title': ..., 'author': ..., 'rating': ..., 'time': ..., 'error': None}
+    'line' is the line in the file. a line that can't be read yields
+    {'line': n, 'error': message} and reading goes on with the next one.
+    file_format: 'csv' or 'jsonl'; guessed from the file name when None
+    """
+    if file_format is None:
+        name = str(source) if isinstance(source, (str, Path)) else getattr(source, 'name', '')
+        file_format = 'jsonl' if name.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+    f, size, close = _open_binary(source)
+    try:
+        lines = _lines(f, size, progress)
+        if file_format == 'jsonl':
+            yield from _jsonl_rows(lines)
+        else:
+            yield from _csv_rows(lines)
+    finally:
+        if close:
+            f.close()
+    if progress:
+        progress(1.0, "reading")
+
+
+def write_ratings(target, rows: List[Tuple[int, float, Optional[float], Optional[Dict]]],
+                  file_format: Optional[str] = None):
+    """
+    rows: (book_id, rating, unix time or None, book or None)
+    target: path or text file object
+    """
+    if file_format is None:
+        file_format = 'jsonl' if str(target).lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+    close = isinstance(target, (str, Path))
+    f = open(target, 'w', encoding='utf-8', newline='') if close else target
+    try:
+        records = (
+            {
+                'book_id': book_id,
+                'title': book['title'] if book else '',
+                'author': book['author'] if book else '',
+                'rating': rating,
+                'rated_at': datetime.fromtimestamp(rated_at).isoformat(timespec='seconds')
+                if rated_at else '',
+            }
+            for book_id, rating, rated_at, book in rows
+        )
+        if file_format == 'jsonl':
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        else:
+            writer = csv.DictWriter(f, fieldnames=['book_id', 'title', 'author', 'rating', 'rated_at'])
+            writer.writeheader()
+            writer.writerows(records)
+    finally:
+        if close:
+            f.close()
@@ -1,7 +1,38 @@
+import copy
 import json
-from typing import List, Dict, Tuple
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import List, Dict, Tuple, Optional, Sequence
 from pathlib import Path
-import numpy as np
+
+from src.concurrency import atomic_write_json, file_version, write_lock
+
+# feature -> (book field, profile key)
+FEATURES = {
+    'genre': ('genre', 'genre_preferences'),
+    'style': ('style', 'style_preferences'),
+    'length': ('length_category', 'length_preferences'),
+    'topic': ('topic', 'topic_preferences'),
+}
+
+# default features' weights (sum=1)
+WEIGHTS = {
+    'genre': 0.4,
+    'style': 0.3,
+    'length': 0.2,
+    'topic': 0.1
+}
+
+PROFILE_KEYS = [key for _, key in FEATURES.values()]
+
+# Bayesian average: how many ratings are needed before a feature's own
+# average outweighs the user's overall average (see _update_profile)
+BAYESIAN_M = 5
+
+# one user's files as read together; version = their file_version()s
+UserState = namedtuple('UserState', ['version', 'ratings', 'rating_times', 'profile'])
+
 
 class BookRecommender:
     """
@@ -9,21 +40,98 @@ class BookRecommender:
     - based on book's features (genre, length(number of pages), style, topic)
     - learn from user's rating
     - calculate similarity and suggest related books
+
+    one object can serve many threads (see src/concurrency.py): changes to
+    a user's ratings are serialized per user directory and written
+    atomically; reads use the last published UserState and don't wait.
     """
-    def __init__(self, data_dir: str = "data"):
+    def __init__(self, data_dir: str = "data",
+                 half_life_days: Optional[float] = None,
+                 user_id: Optional[str] = None,
+                 popularity_max_age: float = 3600,
+                 book_manager=None,
+                 materialize_top: int = 500):
         self.data_dir = Path(data_dir)
-        self.ratings_file = self.data_dir/"user_ratings.json"
-        self.profile_file = self.data_dir/"user_profile.json"
+
+        # default user keeps its files in data/, other users in data/users/<user_id>/
+        self.user_id = user_id
+        self.user_dir = self.data_dir if user_id is None else self.data_dir/"users"/str(user_id)
+        self.user_dir.mkdir(parents=True, exist_ok=True)
+
+        self.ratings_file = self.user_dir/"user_ratings.json"
+        self.rating_times_file = self.user_dir/"user_rating_times.json"
+        self.profile_file = self.user_dir/"user_profile.json"
+
+        self._lock = write_lock(self.user_dir)
+        self._state = None
+
+        # best `materialize_top` unrated books, served by get_recommendations
+        # without scoring the catalog (see src/materialized.py); 0 = off
+        self.recommendations_file = self.user_dir/"user_recommendations.json"
+        self.materialize_top = materialize_top
+        self._top = None
+
+        # time-decayed profile (see src/profile_decay.py); None = every
+        # rating counts the same no matter how old it is
+        self.half_life_days = half_life_days
+
+        # cold-start ranking shared by all users (see src/popularity.py)
+        self.popularity_file = self.data_dir/"popularity.json"
+        self.popularity_max_age = popularity_max_age
+        self._popularity = None
+
+        # catalog to score against; None = a BookDataManager over data_dir
+        self._book_manager = None
+        if book_manager is not None:
+            self._use_catalog(book_manager)
 
         # features' weights (sum=1)
-        self.weights = {
-            'genre': 0.4,
-            'style': 0.3,
-            'length': 0.2,
-            'topic': 0.1
-        }
+        self.weights = dict(WEIGHTS)
+
+    def _files_version(self):
+        return tuple(file_version(path) for path in
+                     (self.ratings_file, self.rating_times_file, self.profile_file))
+
+    def _read_state(self) -> UserState:
+        version = self._files_version()
+        return UserState(version, self._read_ratings_file(),
+                         self._read_rating_times_file(), self._read_profile_file())
 
-    def load_ratings(self) -> Dict[str, float]:
+    def _snapshot(self) -> UserState:
+        """
+        ratings, times and profile as of the last completed write; files are
+        re-read only if they changed, and not while another thread or process
+        is in the middle of writing them (its result is published when it is done)
+        """
+        state = self._state
+        if state is not None and (self._lock.busy() or state.version == self._files_version()):
+            return state
+        # another process in the middle of a write: keep the last state too
+        state = self._lock.read(self._read_state, stale=state)
+        if not self._lock.owned():
+            # a writer's own reads see its unfinished write: not for others
+            self._state = state
+        return state
+
+    @contextmanager
+    def _writing(self):
+        """serialize changes to this user's files, publish the result at the end"""
+        with self._lock:
+            try:
+                yield
+            finally:
+                outermost = self._lock.depth == 1
+                if outermost:
+                    self._state = self._read_state()
+
+        if outermost and self._top is not None:
+            # rebuild the materialized list now, so reads stay lookups
+            self._materialized_top(self._snapshot())
+
+    def load_ratings(self) -> Dict[int, float]:
+        return dict(self._snapshot().ratings)
+
+    def _read_ratings_file(self) -> Dict[int, float]:
         try:
             with open(self.ratings_file, 'r', encoding='utf-8') as f:
                 ratings = json.load(f)
@@ -34,35 +142,271 @@ class BookRecommender:
             print(f"Error {e} in load ratings")
             return {}
 
+    def load_rating_times(self) -> Dict[int, float]:
+        """{book_id: unix time of the rating}"""
+        return dict(self._snapshot().rating_times)
+
+    def _read_rating_times_file(self) -> Dict[int, float]:
+        try:
+            with open(self.rating_times_file, 'r', encoding='utf-8') as f:
+                times = json.load(f)
+            return {int(k): float(v) for k, v in times.items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Error {e} in load rating times")
+            return {}
+
+    def load_snapshot(self) -> Tuple[Dict[int, float], Dict]:
+        """ratings and profile from the same write (load_ratings + load_profile may straddle one)"""
+        state = self._snapshot()
+        return dict(state.ratings), self._profile_from(state)
+
+    def _save_rating_times(self, times: Dict[int, float]):
+        atomic_write_json(self.rating_times_file, times)
+
+    def _catalog(self):
+        """BookDataManager of the catalog, kept so its index is reused"""
+        from src.book_data import BookDataManager
+
+        if self._book_manager is None:
+            self._use_catalog(BookDataManager(self.data_dir))
+        return self._book_manager
+
+    def _use_catalog(self, book_manager):
+        self._book_manager = book_manager
+        book_manager.feed.subscribe(self._on_catalog_change)
+
+    def _on_catalog_change(self, change: Dict):
+        """keep the popularity ranking and top-N list in step with added / edited books"""
+        popularity = self._popularity
+        if popularity is not None:
+            popularity = popularity.apply(change)
+            self._popularity = popularity  # None = rebuilt on next use
+            if popularity is not None:
+                popularity.save(self.popularity_file)
+
+        top = self._top
+        if top is not None:
+            state = self._snapshot()
+            if top.built_for(state.version[2], change['before']) or \
+                    top.built_for(state.version[2], change['after']):
+                book = change['book']
+                score = None
+                if book['id'] not in state.ratings:
+                    score = self.score_book(book, self._profile_from(state))['score']
+                top = top.apply(change, score)
+            else:
+                top = None
+            self._top = top  # None = rebuilt on next use
+            if top is not None:
+                top.save(self.recommendations_file)
+
     def save_rating(self, book_id: int, rating: float) -> bool:
-        if not 1 <= rating <= 5:
-            print("rate must be between 1 and 5")
+        from src.validation import validate_ratings
+
+        report = validate_ratings([(book_id, rating)],
+                                  known_ids=self._catalog().get_books_by_ids([book_id]))
+        if not report.ok:
+            report.print_errors()
             return False
 
-        ratings = self.load_ratings()
-        ratings[book_id] = rating
+        # read-modify-write: a concurrent save would otherwise drop one of the ratings
+        with self._writing():
+            ratings = self.load_ratings()
+            old_rating = ratings.get(book_id)
+            ratings[book_id] = rating
+
+            times = self.load_rating_times()
+            old_time = times.get(book_id)
+            times[book_id] = time.time()
+
+            try:
+                atomic_write_json(self.ratings_file, ratings)
+                self._save_rating_times(times)
+
+                if self.half_life_days:
+                    self._update_decayed_profile(
+                        book_id, old=(old_rating, old_time), new=(rating, times[book_id])
+                    )
+                else:
+                    self._update_profile()
+                return True
+            except Exception as e:
+                print(f"Error {e} in saving rate!")
+                return False
+
+    def import_ratings(self, source, progress_callback=None,
+                       overwrite: bool = True,
+                       file_format: Optional[str] = None) -> Dict:
+        """
+        bulk import from CSV / JSONL (see src/rating_io.py)
 
-        try:
-            with open(self.ratings_file, 'w', encoding='utf-8') as f:
-                json.dump(ratings, f, ensure_ascii=False, indent=2)
+        rows are streamed and matched to the catalog (by book_id, or by
+        title + author through the catalog index), validated as one batch,
+        then the ratings file is written once and the profile rebuilt once.
+
+        progress_callback(fraction, message) is called while reading
+        overwrite=False keeps existing ratings of the same book
+
+        returns {'imported', 'skipped', 'unmatched': [line, ...], 'errors': [...]}
+        errors use the file's line numbers as 'row'
+        """
+        from src.rating_io import read_rating_rows
+        from src.validation import validate_ratings
+
+        index = self._catalog().get_index()
+        now = time.time()
+
+        pairs = []  # (book_id, rating)
+        pair_lines = []
+        pair_times = []
+        unmatched = []
+        unreadable = []
+        skipped = 0
+        for row in read_rating_rows(source, progress_callback, file_format):
+            if row['error']:
+                unreadable.append({'row': row['line'], 'field': 'line', 'code': 'parse',
+                                   'message': row['error']})
+                continue
+            if row['rating'] in (None, 0):
+                # Goodreads exports "My Rating: 0" for shelved-but-unrated books
+                skipped += 1
+                continue
+
+            book_id = row['book_id']
+            if book_id is None:
+                book = index.match_book(row['title'], row['author']) if row['title'] else None
+                if book is None:
+                    unmatched.append(row['line'])
+                    continue
+                book_id = book['id']
+
+            pairs.append((book_id, row['rating']))
+            pair_lines.append(row['line'])
+            pair_times.append(row['time'] or now)
+
+        report = validate_ratings(pairs, known_ids=index.positions)
+        invalid = set(report.invalid_rows())
+
+        with self._writing():
+            ratings = self.load_ratings()
+            times = self.load_rating_times()
+            imported = 0
+            for i, (book_id, rating) in enumerate(pairs):
+                if i in invalid or (not overwrite and book_id in ratings):
+                    continue
+                ratings[book_id] = float(rating)
+                times[book_id] = pair_times[i]
+                imported += 1
+
+            if imported:
+                if progress_callback:
+                    progress_callback(1.0, "saving")
+                try:
+                    atomic_write_json(self.ratings_file, ratings)
+                    self._save_rating_times(times)
+                    self._update_profile()
+                except Exception as e:
+                    print(f"Error {e} in importing rates!")
+                    imported = 0
+
+        errors = unreadable + [dict(e, row=pair_lines[e['row']]) for e in report.errors]
+        errors.sort(key=lambda e: e['row'])
+        return {
+            'imported': imported,
+            'skipped': skipped,
+            'unmatched': unmatched,
+            'errors': errors
+        }
+
+    def export_ratings(self, target, file_format: Optional[str] = None) -> int:
+        """write all ratings (with title, author, time) as CSV or JSONL"""
+        from src.rating_io import write_ratings
+
+        index = self._catalog().get_index()
+        state = self._snapshot()
+        ratings, times = state.ratings, state.rating_times
+
+        rows = []
+        for book_id, rating in ratings.items():
+            position = index.positions.get(book_id)
+            book = index.books[position] if position is not None else None
+            rows.append((book_id, rating, times.get(book_id), book))
+
+        write_ratings(target, rows, file_format)
+        return len(rows)
+
+    def delete_rating(self, book_id: int) -> bool:
+        with self._writing():
+            ratings = self.load_ratings()
+            if book_id not in ratings:
+                return False
+
+            old_rating = ratings.pop(book_id)
+            times = self.load_rating_times()
+            old_time = times.pop(book_id, None)
+
+            try:
+                atomic_write_json(self.ratings_file, ratings)
+                self._save_rating_times(times)
+
+                if self.half_life_days and ratings:
+                    self._update_decayed_profile(book_id, old=(old_rating, old_time), new=None)
+                else:
+                    self._update_profile()
+                return True
+            except Exception as e:
+                print(f"Error {e} in deleting rate!")
+                return False
+
+    def _update_decayed_profile(self, book_id: int, old: Tuple, new: Optional[Tuple]):
+        """
+        O(1) profile update for time-decay mode: take the book's old rating
+        out of the decayed sums and put the new one in
+        """
+        from src import profile_decay
+
+        profile = self._read_profile_file()
+        state = profile.get('decay')
+        # looked up by id, not a scan of the catalog
+        book = self._catalog().get_books_by_ids([book_id]).get(book_id)
 
+        if (state is None or book is None or
+                state['half_life_days'] != self.half_life_days or
+                (old[0] is not None and old[1] is None)):
+            # no usable state yet (or we can't tell what to take out) -> rebuild
             self._update_profile()
-            return True
-        except Exception as e:
-            print(f"Error {e} in saving rate!")
-            return False
+            return
+
+        feature_values = {key: book[field] for field, key in FEATURES.values()}
+        if old[0] is not None:
+            profile_decay.apply_rating(state, feature_values, old[0], old[1], sign=-1)
+        if new is not None:
+            profile_decay.apply_rating(state, feature_values, new[0], new[1])
+
+        ratings = self.load_ratings()
+        profile['total_ratings'] = len(ratings)
+        self._write_profile(self._materialize_decay(profile, state))
 
     def _update_profile(self):
         """
         update user profile based on ratings
         """
-        from src.book_data import BookDataManager
+        import numpy as np
 
         ratings = self.load_ratings()
         if not ratings:
+            # last rating was deleted -> reset profile
+            self._write_profile(self._empty_profile())
             return
 
-        book_manager = BookDataManager(self.data_dir)
+        # only the rated books, looked up by id: keeps the write short
+        books_by_id = self._catalog().get_books_by_ids(ratings)
+
+        if self.half_life_days:
+            self._rebuild_decayed_profile(ratings, books_by_id)
+            return
 
         profile = {
             'genre_preferences': {},  # {genre: avg_rating}
@@ -80,7 +424,7 @@ class BookRecommender:
         topic_ratings = {}
 
         for book_id, rating in ratings.items():
-            book = book_manager.get_book_by_id(book_id)
+            book = books_by_id.get(book_id)
             if not book:
                 continue
 
@@ -115,7 +459,7 @@ class BookRecommender:
         # m: this number shows, how many data is needed to achieve a real rate
 
         C = sum(ratings.values()) / len(ratings)  # total average
-        m = 5
+        m = BAYESIAN_M
 
         profile['genre_preferences'] = {
             g: (len(r) / (len(r) + m)) * np.mean(r) + (m / (len(r) + m)) * C
@@ -139,136 +483,424 @@ class BookRecommender:
 
 
         # ذخیره پروفایل
+        self._write_profile(profile)
+
+    def _rebuild_decayed_profile(self, ratings: Dict[int, float], books_by_id: Dict[int, Dict]):
+        """
+        full recomputation of the decayed sums, O(ratings); used the first
+        time decay mode sees a profile and as the reference for the O(1) path
+        """
+        from src import profile_decay
+
+        times = self.load_rating_times()
+        missing = [book_id for book_id in ratings if book_id not in times]
+        if missing:
+            # ratings from before timestamps were recorded count as "now"
+            now = time.time()
+            for book_id in missing:
+                times[book_id] = now
+            self._save_rating_times(times)
+
+        entries = [
+            ({key: books_by_id[book_id][field] for field, key in FEATURES.values()},
+             rating, times[book_id])
+            for book_id, rating in ratings.items() if book_id in books_by_id
+        ]
+        state = profile_decay.build_state(self.half_life_days, entries, PROFILE_KEYS)
+
+        profile = self._empty_profile()
+        profile['total_ratings'] = len(ratings)
+        self._write_profile(self._materialize_decay(profile, state))
+
+    @staticmethod
+    def _materialize_decay(profile: Dict, state: Dict, now: Optional[float] = None) -> Dict:
+        """fill the preference dicts from the decayed sums at time `now`"""
+        from src import profile_decay
+
+        if now is None:
+            now = time.time()
+        preferences, average = profile_decay.preferences_at(state, now, BAYESIAN_M, PROFILE_KEYS)
+        profile.update(preferences)
+        profile['average_rating'] = average
+        profile['decay'] = state
+        return profile
+
+    def _write_profile(self, profile: Dict):
         try:
-            with open(self.profile_file, 'w', encoding='utf-8') as f:
-                json.dump(profile, f, ensure_ascii=False, indent=2)
+            atomic_write_json(self.profile_file, profile)
         except Exception as e:
             print(f"Error {e} in saving profile")
 
-
-    def load_profile(self) -> Dict:
+    def _read_profile_file(self) -> Dict:
         try:
             with open(self.profile_file, 'r', encoding='utf-8') as f:
                 profile = json.load(f)
             return profile
         except FileNotFoundError:
-            return {
-                'genre_preferences': {},
-                'length_preferences': {},
-                'style_preferences': {},
-                'topic_preferences': {},
-                'total_ratings': 0,
-                'average_rating': 0
-            }
+            return self._empty_profile()
+
+    def load_profile(self) -> Dict:
+        return self._profile_from(self._snapshot())
+
+    def _profile_from(self, state: UserState) -> Dict:
+        """the caller's own copy of the state's profile"""
+        profile = copy.deepcopy(state.profile)
+
+        # built with decay turned on / off or another half-life: rebuild
+        decay = profile.get('decay')
+        if profile['total_ratings'] and (bool(decay) != bool(self.half_life_days) or
+                                         (decay and decay['half_life_days'] != self.half_life_days)):
+            with self._writing():
+                self._update_profile()
+            profile = copy.deepcopy(self._snapshot().profile)
+            decay = profile.get('decay')
+
+        # decay keeps going between writes -> re-evaluate at the current time
+        if (self.half_life_days and decay and profile['total_ratings'] and
+                decay['half_life_days'] == self.half_life_days):
+            profile = self._materialize_decay(profile, decay)
+
+        return profile
+
+    @staticmethod
+    def _empty_profile() -> Dict:
+        return {
+            'genre_preferences': {},
+            'length_preferences': {},
+            'style_preferences': {},
+            'topic_preferences': {},
+            'total_ratings': 0,
+            'average_rating': 0
+        }
 
-    def calculate_similarity(self, book: Dict) -> float:
+    def score_book(self, book: Dict, profile: Optional[Dict] = None) -> Dict:
         """
-        calculate the similarity between book and ratings
+        score a book against the profile and keep the intermediates
 
         Score = (Genre_Score × 0.4) + (Style_Score × 0.3) +
                 (Length_Score × 0.2) + (Topic_Score × 0.1)
 
         each score is between 1 to 5
+
+        returns:
+            {
+                'score': final score (rounded),
+                'cold_start': True if the user has no ratings yet,
+                'contributions': {
+                    feature: {
+                        'value': book's value for the feature,
+                        'preference': user's score for that value,
+                        'known': False if the value is not in the profile
+                                 (preference falls back to average rating),
+                        'weight': feature weight,
+                        'contribution': preference × weight
+                    }
+                }
+            }
         """
-        profile = self.load_profile()
+        if profile is None:
+            profile = self.load_profile()
 
         # if profile is empty return an average rate (3)
         if profile['total_ratings'] == 0:
-            return 3.0
+            return {'score': 3.0, 'cold_start': True, 'contributions': {}}
+
+        contributions = {}
+        final_score = 0.0
+        for feature, (field, preferences_key) in FEATURES.items():
+            value = book[field]
+            preferences = profile[preferences_key]
+            known = value in preferences
+            # if the value is not read, use average
+            preference = preferences[value] if known else profile['average_rating']
+            weight = self.weights[feature]
+
+            contributions[feature] = {
+                'value': value,
+                'preference': preference,
+                'known': known,
+                'weight': weight,
+                'contribution': preference * weight
+            }
+            final_score += preference * weight
 
-        genre_score = profile['genre_preferences'].get(
-            book['genre'],
-            profile['average_rating']  # if the genre is not read, use average
-        )
+        return {
+            'score': round(final_score, 2),
+            'cold_start': False,
+            'contributions': contributions
+        }
 
-        style_score = profile['style_preferences'].get(
-            book['style'],
-            profile['average_rating']
-        )
+    def calculate_similarity(self, book: Dict, profile: Optional[Dict] = None) -> float:
+        """
+        calculate the similarity between book and ratings (see score_book)
+        """
+        return self.score_book(book, profile)['score']
 
-        length_score = profile['length_preferences'].get(
-            book['length_category'],
-            profile['average_rating']
-        )
 
-        topic_score = profile['topic_preferences'].get(
-            book['topic'],
-            profile['average_rating']
-        )
+    def get_popularity(self, books: Sequence[Dict]):
+        """
+        popularity ranking over all users' ratings; loaded from
+        data/popularity.json and rebuilt when older than popularity_max_age
+        or built for a different catalog
+        """
+        from src.popularity import PopularityRanking
 
-        final_score = (
-                genre_score * self.weights['genre'] +
-                style_score * self.weights['style'] +
-                length_score * self.weights['length'] +
-                topic_score * self.weights['topic']
-        )
+        popularity = self._popularity
+        if popularity is None:
+            popularity = PopularityRanking.load(self.popularity_file)
 
-        return round(final_score, 2)
+        if popularity is None or not popularity.is_fresh(books, self.popularity_max_age):
+            popularity = PopularityRanking.build(self.data_dir, books, BAYESIAN_M)
+            popularity.save(self.popularity_file)
 
+        self._popularity = popularity
+        return popularity
 
-    def get_recommendations(self, books: List[Dict],
-                            top_n: int = 5) -> List[Tuple[Dict, float]]:
+    def get_recommendations(self, books: Sequence[Dict], top_n: int = 5,
+                            with_breakdown: bool = False,
+                            diversity: float = 0.0,
+                            candidate_pool: int = 200,
+                            seed: Optional[int] = None,
+                            stratify_genres: bool = False) -> List[Tuple]:
+        """
+        returns [(book, score), ...] or, with with_breakdown=True,
+        [(book, score, breakdown), ...] where breakdown is score_book's output
 
-        ratings = self.load_ratings()
-        profile = self.load_profile()
+        diversity: 0 = pure score order, up to 1 = maximum diversity.
+        when > 0 the best `candidate_pool` books are re-ranked with MMR
+        (see _rerank_mmr); scores themselves are not changed.
 
-        # recommend random books if there's no rate
+        users without ratings get the most popular books (see get_popularity);
+        seed (e.g. one per session) varies the pick but keeps it stable across
+        reruns, stratify_genres spreads it over genres.
+        """
+        state = self._snapshot()
+        ratings, profile = state.ratings, self._profile_from(state)
+
+        # recommend popular books if there's no rate
         if profile['total_ratings'] == 0:
-            import random
-            unrated = [b for b in books if b['id'] not in ratings]
-            random.shuffle(unrated)
-            return [(b, 3.0) for b in unrated[:top_n]]
+            popular = self.get_popularity(books).top(
+                books, top_n, exclude=ratings.keys(), seed=seed, stratify=stratify_genres
+            )
+            recommendations = []
+            for book, (_, _, score, count, average) in popular:
+                breakdown = {
+                    'score': round(score, 2),
+                    'cold_start': True,
+                    'contributions': {},
+                    'popularity': {'count': count, 'average': average}
+                }
+                recommendations.append((book, breakdown['score'], breakdown))
+            if with_breakdown:
+                return recommendations
+            return [(book, score) for book, score, _ in recommendations]
+
+        top = self._materialized_top(state, profile)
+        if top is not None:
+            served = self._serve_materialized(top, books, profile, top_n, with_breakdown,
+                                              diversity, candidate_pool)
+            if served is not None:
+                return served
 
         recommendations = []
 
         # recommend those books that had not been read (we don't want to suggest read books)
         for book in books:
             if book['id'] not in ratings:
-                score = self.calculate_similarity(book)
-                recommendations.append((book, score))
+                breakdown = self.score_book(book, profile)
+                recommendations.append((book, breakdown['score'], breakdown))
 
         recommendations.sort(key=lambda x: x[1], reverse=True)
 
-        return recommendations[:top_n]
+        if diversity > 0 and len(recommendations) > top_n:
+            recommendations = self._rerank_mmr(
+                self._candidate_pool(recommendations, max(candidate_pool, top_n), top_n),
+                top_n, diversity
+            )
 
-    def explain_recommendation(self, book: Dict) -> str:
-        profile = self.load_profile()
+        if with_breakdown:
+            return recommendations[:top_n]
+        return [(book, score) for book, score, _ in recommendations[:top_n]]
 
-        if profile['total_ratings'] == 0:
+    def _materialized_top(self, state: UserState, profile: Optional[Dict] = None):
+        """
+        the MaterializedTopN for this state's profile and the current
+        catalog, loaded or rebuilt if needed; None if turned off
+        """
+        from src.materialized import DECAYED_MAX_AGE, MaterializedTopN
+
+        if not self.materialize_top:
+            return None
+
+        manager = self._catalog()
+        catalog_version = manager._books_version()
+        max_age = DECAYED_MAX_AGE if self.half_life_days else None
+
+        top = self._top
+        if top is None:
+            top = MaterializedTopN.load(self.recommendations_file)
+        if top is not None and top.is_fresh(state.version[2], catalog_version, self.weights,
+                                            self.materialize_top, self.half_life_days, max_age):
+            self._top = top
+            return top
+
+        index = manager.get_index()
+        top = MaterializedTopN.build_from_index(
+            self, index, profile or self._profile_from(state), state.ratings,
+            self.materialize_top, state.version[2], catalog_version
+        )
+        self._top = top
+        top.save(self.recommendations_file)
+        return top
+
+    def _serve_materialized(self, top, books: Sequence[Dict], profile: Dict, top_n: int,
+                            with_breakdown: bool, diversity: float,
+                            candidate_pool: int) -> Optional[List[Tuple]]:
+        """
+        get_recommendations' result from the materialized rows, O(rows);
+        None if the rows are too few for this request or `books` is not the
+        catalog they were built from
+        """
+        if len(books) != top.catalog_size:
+            return None
+
+        diverse = diversity > 0 and top.unrated > top_n
+        if diverse:
+            size = max(candidate_pool, top_n)
+            ranked = [(books[position], score, book_id) for position, book_id, score in top.rows]
+            pool = self._candidate_pool(ranked, size, top_n)
+            if len(pool) < size and not top.complete:
+                return None  # the full ranking would fill the pool with more rows
+        else:
+            if top_n > len(top.rows) and not top.complete:
+                return None
+            pool = [(books[position], score, book_id) for position, book_id, score in top.rows[:top_n]]
+
+        if any(book['id'] != book_id for book, _, book_id in pool):
+            return None
+
+        picked = self._rerank_mmr(pool, top_n, diversity) if diverse else pool
+        if with_breakdown:
+            return [(book, score, self.score_book(book, profile)) for book, score, _ in picked]
+        return [(book, score) for book, score, _ in picked]
+
+    @staticmethod
+    def _candidate_pool(recommendations: List[Tuple], size: int,
+                        per_tuple: int) -> List[Tuple]:
+        """
+        best `size` candidates, keeping at most `per_tuple` books with the same
+        (genre, style, length, topic) tuple - more copies can never be picked
+        """
+        pool = []
+        seen = {}
+        for item in recommendations:
+            book = item[0]
+            key = tuple(book[field] for field, _ in FEATURES.values())
+            if seen.get(key, 0) < per_tuple:
+                seen[key] = seen.get(key, 0) + 1
+                pool.append(item)
+                if len(pool) == size:
+                    break
+        return pool
+
+    def _rerank_mmr(self, candidates: List[Tuple], top_n: int,
+                    diversity: float) -> List[Tuple]:
+        """
+        Maximal Marginal Relevance re-ranking
+
+        MMR(i) = (1 - diversity) × relevance(i) - diversity × max_sim(i, selected)
+
+        - relevance: score min-max scaled to [0, 1] within the candidates
+        - sim(i, j): sum of weights of the features i and j share (0 to 1)
+
+        candidates must be sorted by score; runs in O(top_n × len(candidates))
+        """
+        import numpy as np
+
+        diversity = min(max(diversity, 0.0), 1.0)
+        n = len(candidates)
+
+        # encode each feature's values as integer codes -> (n, 4) matrix
+        codes = np.empty((n, len(FEATURES)), dtype=np.int64)
+        for j, (field, _) in enumerate(FEATURES.values()):
+            vocabulary = {}
+            codes[:, j] = [
+                vocabulary.setdefault(book[field], len(vocabulary))
+                for book, *_ in candidates
+            ]
+        weights = np.array([self.weights[f] for f in FEATURES], dtype=np.float64)
+
+        scores = np.array([c[1] for c in candidates], dtype=np.float64)
+        spread = scores.max() - scores.min()
+        relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(n)
+        max_sim = np.zeros(n)
+        available = np.ones(n, dtype=bool)
+
+        selected = []
+        for _ in range(min(top_n, n)):
+            mmr = (1 - diversity) * relevance - diversity * max_sim
+            mmr[~available] = -np.inf
+            pick = int(np.argmax(mmr))  # ties -> higher score (earlier) wins
+
+            selected.append(pick)
+            available[pick] = False
+            max_sim = np.maximum(max_sim, (codes == codes[pick]) @ weights)
+
+        return [candidates[i] for i in selected]
+
+    @staticmethod
+    def render_explanation(breakdown: Dict) -> str:
+        """
+        build the "why this book?" text from score_book's intermediates (no I/O)
+        """
+        if breakdown['cold_start']:
+            popularity = breakdown.get('popularity')
+            if popularity and popularity['count'] > 0:
+                return (f"این کتاب بین خوانندگان محبوب است "
+                        f"(میانگین: {popularity['average']:.1f}⭐ از {popularity['count']} امتیاز)"
+                        f" - شما هنوز امتیازی نداده‌اید")
             return "این کتاب به صورت تصادفی انتخاب شده (شما هنوز امتیازی نداده‌اید)"
 
         reasons = []
+        for feature, item in breakdown['contributions'].items():
+            if not item['known']:
+                continue
 
-        # check genre
-        genre = book['genre']
-        if genre in profile['genre_preferences']:
-            avg = profile['genre_preferences'][genre]
-            if avg >= 4:
-                reasons.append(f"شما به ژانر '{genre}' علاقه زیادی دارید (میانگین: {avg:.1f}⭐)")
-            elif avg >= 3:
-                reasons.append(f"ژانر '{genre}' برای شما جالب است (میانگین: {avg:.1f}⭐)")
-
-        # check style
-        style = book['style']
-        if style in profile['style_preferences']:
-            avg = profile['style_preferences'][style]
-            if avg >= 4:
-                reasons.append(f"سبک '{style}' مورد پسند شماست (میانگین: {avg:.1f}⭐)")
-
-        # check length
-        length = book['length_category']
-        if length in profile['length_preferences']:
-            avg = profile['length_preferences'][length]
-            if avg >= 4:
-                reasons.append(f"کتاب‌های '{length}' را ترجیح می‌دهید (میانگین: {avg:.1f}⭐)")
+            value, avg = item['value'], item['preference']
+            if feature == 'genre':
+                if avg >= 4:
+                    reasons.append(f"شما به ژانر '{value}' علاقه زیادی دارید (میانگین: {avg:.1f}⭐)")
+                elif avg >= 3:
+                    reasons.append(f"ژانر '{value}' برای شما جالب است (میانگین: {avg:.1f}⭐)")
+            elif feature == 'style' and avg >= 4:
+                reasons.append(f"سبک '{value}' مورد پسند شماست (میانگین: {avg:.1f}⭐)")
+            elif feature == 'length' and avg >= 4:
+                reasons.append(f"کتاب‌های '{value}' را ترجیح می‌دهید (میانگین: {avg:.1f}⭐)")
+            elif feature == 'topic' and avg >= 4:
+                reasons.append(f"به موضوع '{value}' علاقه دارید (میانگین: {avg:.1f}⭐)")
 
         if not reasons:
             return "این کتاب بر اساس ترجیحات کلی شما انتخاب شده است"
 
         return " • " + " • ".join(reasons)
 
-    def get_rating_statistics(self) -> Dict:
-        ratings = self.load_ratings()
+    def explain_recommendation(self, book: Dict, breakdown: Optional[Dict] = None) -> str:
+        if breakdown is None:
+            breakdown = self.score_book(book)
+        return self.render_explanation(breakdown)
+
+    def explain_recommendations(self, books: List[Dict],
+                                profile: Optional[Dict] = None) -> List[str]:
+        """
+        explain several books with a single profile read
+        """
+        if profile is None:
+            profile = self.load_profile()
+        return [self.render_explanation(self.score_book(book, profile)) for book in books]
+
+    def get_rating_statistics(self, ratings: Optional[Dict[int, float]] = None) -> Dict:
+        if ratings is None:
+            ratings = self.load_ratings()
 
         if not ratings:
             return {
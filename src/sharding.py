@@ -0,0 +1,456 @@
+"""
+sharded recommendation serving
+
+the catalog is partitioned by book id range; every shard keeps and indexes
+only its own books (with their positions in the full catalog) and scores
+them with the same content-based scorer, vectorized over its CatalogIndex
+(src/materialized.py's index_sums / round_scores give score_book's
+scores). it returns its local ranking page by page; the sorted ranking of
+a request is cached, so the next pages don't score the books again. the coordinator keeps the
+user's ratings and profile, sends the profile with each request and
+k-way merges the shards' rankings:
+
+    single node:  sort all unrated books by (-score, catalog position)
+    sharded:      each shard sorts its books by the same key,
+                  the coordinator merges the sorted lists
+
+so the merged order is the single-node order, ties included. with
+diversity the shards apply the same per-(genre, style, length, topic) cap
+as _candidate_pool before returning (a book capped locally is also capped
+globally), and the coordinator runs MMR over the merged pool.
+
+users without ratings get the popularity ranking, built by the coordinator
+from a (position, id, genre) skeleton of the catalog; only the k books it
+picks are fetched from the shards.
+
+transports: LocalTransport (in-process) and SocketTransport (newline-
+delimited json over TCP, see serve_shard). LocalShardCluster starts shards
+as local processes, for tests and benchmarks.
+"""
+import heapq
+import json
+import multiprocessing as mp
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.book_data import BookDataManager
+from src.catalog_index import CatalogIndex
+from src.concurrency import file_version
+from src.materialized import index_sums, round_scores
+from src.recommender import WEIGHTS, BookRecommender
+
+SHARD_METHODS = ('info', 'top', 'skeleton', 'books')
+
+# sorted rankings kept per shard (one per recent user / profile)
+RANKING_CACHE_SIZE = 32
+
+
+def id_ranges(book_ids: Iterable[int], n_shards: int) -> List[Tuple[Optional[int], Optional[int]]]:
+    """
+    split ids into n_shards [low, high) ranges with about the same number of
+    books each; the first and last range are open, so new ids always land
+    in some shard
+    """
+    ids = sorted(book_ids)
+    n_shards = max(1, min(n_shards, len(ids)))
+    bounds = [ids[len(ids) * i // n_shards] for i in range(1, n_shards)]
+    lows = [None] + bounds
+    highs = bounds + [None]
+    return list(zip(lows, highs))
+
+
+def _in_range(book_id: int, low: Optional[int], high: Optional[int]) -> bool:
+    return (low is None or book_id >= low) and (high is None or book_id < high)
+
+
+class _SliceScorer:
+    """BookRecommender.score_book with given weights, without a user directory"""
+    half_life_days = None
+    score_book = BookRecommender.score_book
+
+    def __init__(self, weights: Dict):
+        self.weights = weights
+
+
+class CatalogShard:
+    """
+    the books of one id range, with their positions in the full catalog
+    (reloaded when books.json changes). a shard reads books.json but keeps
+    and indexes only its slice, and has no user: it writes no files
+    """
+    def __init__(self, data_dir: str, low: Optional[int], high: Optional[int]):
+        self.low = low
+        self.high = high
+        self.books_file = Path(data_dir)/"books.json"
+        # (books.json version, catalog positions, CatalogIndex of the slice)
+        self._slice = None
+        self._rankings = OrderedDict()  # request key -> (positions, scores), best first
+        self._rankings_lock = threading.Lock()
+
+    def _partition(self) -> Tuple[Optional[Tuple], np.ndarray, CatalogIndex]:
+        version = file_version(self.books_file)
+        state = self._slice
+        if state is None or state[0] != version:
+            try:
+                with open(self.books_file, 'r', encoding='utf-8') as f:
+                    books = json.load(f)
+            except FileNotFoundError:
+                print(f"File {self.books_file} not found!")
+                books = []
+            except json.JSONDecodeError as e:
+                print(f"Error {e} while reading json file!")
+                books = []
+            positions = [p for p, book in enumerate(books) if _in_range(book['id'], self.low, self.high)]
+            index = CatalogIndex([books[p] for p in positions])
+            del books  # only the slice stays
+            state = (version, np.array(positions, dtype=np.int64), index)
+            self._slice = state
+        return state
+
+    def info(self) -> Dict:
+        version, positions, _ = self._partition()
+        return {
+            'low': self.low,
+            'high': self.high,
+            'count': len(positions),
+            'version': list(version or ()),
+        }
+
+    def _ranking(self, profile: Dict, exclude: List[int],
+                 weights: Dict) -> Tuple[np.ndarray, np.ndarray]:
+        """slice positions of the unrated books and their scores, best first"""
+        version, _, index = self._partition()
+        key = json.dumps([version, profile, sorted(exclude), weights], sort_keys=True)
+        with self._rankings_lock:
+            if key in self._rankings:
+                self._rankings.move_to_end(key)
+                return self._rankings[key]
+
+        unrated = np.flatnonzero(~index.ids_bitmap(exclude))
+        scores = round_scores(index_sums(weights, index, profile)[unrated])
+        # ties: slice order is catalog order
+        order = np.lexsort((unrated, -scores))
+        ranking = (unrated[order], scores[order])
+
+        with self._rankings_lock:
+            self._rankings[key] = ranking
+            while len(self._rankings) > RANKING_CACHE_SIZE:
+                self._rankings.popitem(last=False)
+        return ranking
+
+    def top(self, profile: Dict, exclude: List[int], k: int, offset: int = 0,
+            per_tuple: Optional[int] = None, weights: Optional[Dict] = None,
+            with_breakdown: bool = False) -> Dict:
+        """
+        rows offset..offset+k of this shard's ranking of unrated books:
+            {'unrated': n, 'more': bool,
+             'rows': [[position, score, book, breakdown or None], ...]}
+        per_tuple: cap per feature tuple, like BookRecommender._candidate_pool
+        """
+        weights = weights or WEIGHTS
+        _, catalog_positions, index = self._partition()
+        local, scores = self._ranking(profile, exclude, weights)
+        books = index.books
+
+        ranked = ((books[int(i)], float(score), None, int(catalog_positions[i]))
+                  for i, score in zip(local, scores))
+        if per_tuple is not None:
+            ranked = BookRecommender._candidate_pool(ranked, offset + k + 1, per_tuple)
+            more = len(ranked) > offset + k
+            page = ranked[offset:offset + k]
+        else:
+            more = len(local) > offset + k
+            page = list(islice(ranked, offset, offset + k))
+
+        scorer = _SliceScorer(weights)
+        return {
+            'unrated': len(local),
+            'more': more,
+            'rows': [
+                [position, score, book, scorer.score_book(book, profile) if with_breakdown else None]
+                for book, score, _, position in page
+            ],
+        }
+
+    def skeleton(self) -> List[List]:
+        """[[position, id, genre], ...] - all the popularity ranking needs"""
+        _, positions, index = self._partition()
+        return [[int(position), book['id'], book['genre']]
+                for position, book in zip(positions, index.books)]
+
+    def books(self, ids: List[int]) -> List[Dict]:
+        _, _, index = self._partition()
+        books = index.books
+        return [books[index.positions[i]] for i in ids if i in index.positions]
+
+
+class LocalTransport:
+    """calls a CatalogShard in this process"""
+    def __init__(self, shard: CatalogShard):
+        self.shard = shard
+
+    def call(self, method: str, **kwargs):
+        if method not in SHARD_METHODS:
+            raise ValueError(f"unknown shard method {method}")
+        return getattr(self.shard, method)(**kwargs)
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """
+    one persistent TCP connection to a shard server; a request is one json
+    line {"method": ..., "args": {...}}, the reply one json line
+    {"result": ...} or {"error": "..."}
+    """
+    def __init__(self, host: str, port: int, timeout: float = 30.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._socket = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._socket = socket.create_connection(self.address, timeout=self.timeout)
+        self._file = self._socket.makefile('rwb')
+
+    def call(self, method: str, **kwargs):
+        request = (json.dumps({'method': method, 'args': kwargs}, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._file is None:
+                        self._connect()
+                    self._file.write(request)
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError(f"shard {self.address} closed the connection")
+                    break
+                except OSError:
+                    # stale connection: reconnect once
+                    self.close()
+                    if attempt == 2:
+                        raise
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(f"shard {self.address}: {response['error']}")
+        return response['result']
+
+    def close(self):
+        for closeable in (self._file, self._socket):
+            try:
+                if closeable is not None:
+                    closeable.close()
+            except OSError:
+                pass
+        self._file = None
+        self._socket = None
+
+
+def serve_shard(shard: CatalogShard, host: str = '127.0.0.1', port: int = 0,
+                ready=None):
+    """serve a shard over TCP until the process is stopped"""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    if request['method'] not in SHARD_METHODS:
+                        raise ValueError(f"unknown shard method {request['method']}")
+                    response = {'result': getattr(shard, request['method'])(**request['args'])}
+                except Exception as e:
+                    response = {'error': f"{type(e).__name__}: {e}"}
+                self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    shard.info()  # load the partition before accepting requests
+    with Server((host, port), Handler) as server:
+        if ready is not None:
+            ready.put(server.server_address[1])
+        server.serve_forever()
+
+
+def _run_shard_process(data_dir, low, high, host, ready):
+    serve_shard(CatalogShard(data_dir, low, high), host, 0, ready)
+
+
+class LocalShardCluster:
+    """
+    n shard servers as local processes over sockets:
+
+        with LocalShardCluster("data", 4) as transports:
+            coordinator = ShardedRecommender(recommender, transports)
+    """
+    def __init__(self, data_dir: str, n_shards: int, host: str = '127.0.0.1'):
+        self.data_dir = str(data_dir)
+        self.n_shards = n_shards
+        self.host = host
+        self.processes = []
+        self.transports = []
+
+    def start(self) -> List[SocketTransport]:
+        books = BookDataManager(self.data_dir).load_books()
+        ctx = mp.get_context('spawn')
+        for low, high in id_ranges((b['id'] for b in books), self.n_shards):
+            ready = ctx.Queue()
+            process = ctx.Process(target=_run_shard_process,
+                                  args=(self.data_dir, low, high, self.host, ready),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.transports.append(SocketTransport(self.host, ready.get(timeout=60)))
+        return self.transports
+
+    def stop(self):
+        for transport in self.transports:
+            transport.close()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.transports = []
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class ShardedRecommender:
+    """
+    coordinator: same results as recommender.get_recommendations(books, ...)
+    over the whole catalog, computed by the shards behind `transports`
+    """
+    def __init__(self, recommender: BookRecommender, transports: Sequence):
+        self.recommender = recommender
+        self.transports = list(transports)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.transports)))
+        self._skeleton = None
+        self._skeleton_versions = None
+
+    def _broadcast(self, method: str, **kwargs) -> List:
+        futures = [self._executor.submit(t.call, method, **kwargs) for t in self.transports]
+        return [f.result() for f in futures]
+
+    def _stream(self, transport, first_page: Dict, request: Dict, page_size: int) -> Iterator[Tuple]:
+        """one shard's ranking as (book, score, breakdown, position), fetching pages on demand"""
+        page, offset = first_page, 0
+        while True:
+            for position, score, book, breakdown in page['rows']:
+                yield book, score, breakdown, position
+            if not page['more']:
+                return
+            offset += page_size
+            page = transport.call('top', offset=offset, k=page_size, **request)
+
+    def _ranked(self, request: Dict, page_size: int) -> Tuple[int, Iterator[Tuple]]:
+        first_pages = self._broadcast('top', offset=0, k=page_size, **request)
+        streams = [
+            self._stream(transport, page, request, page_size)
+            for transport, page in zip(self.transports, first_pages)
+        ]
+        unrated = sum(page['unrated'] for page in first_pages)
+        return unrated, heapq.merge(*streams, key=lambda r: (-r[1], r[3]))
+
+    def _catalog_skeleton(self) -> List[Dict]:
+        versions = [info['version'] for info in self._broadcast('info')]
+        if self._skeleton is None or versions != self._skeleton_versions:
+            rows = sorted(row for part in self._broadcast('skeleton') for row in part)
+            self._skeleton = [{'id': book_id, 'genre': genre} for _, book_id, genre in rows]
+            self._skeleton_versions = versions
+        return self._skeleton
+
+    def _popular(self, ratings: Dict, top_n: int, seed: Optional[int],
+                 stratify_genres: bool) -> List[Tuple]:
+        skeleton = self._catalog_skeleton()
+        popular = self.recommender.get_popularity(skeleton).top(
+            skeleton, top_n, exclude=ratings.keys(), seed=seed, stratify=stratify_genres
+        )
+        ids = [book['id'] for book, _ in popular]
+        books = {b['id']: b for part in self._broadcast('books', ids=ids) for b in part}
+
+        recommendations = []
+        for book, (_, book_id, score, count, average) in popular:
+            breakdown = {
+                'score': round(score, 2),
+                'cold_start': True,
+                'contributions': {},
+                'popularity': {'count': count, 'average': average}
+            }
+            recommendations.append((books[book_id], breakdown['score'], breakdown))
+        return recommendations
+
+    def get_recommendations(self, top_n: int = 5,
+                            with_breakdown: bool = False,
+                            diversity: float = 0.0,
+                            candidate_pool: int = 200,
+                            seed: Optional[int] = None,
+                            stratify_genres: bool = False) -> List[Tuple]:
+        """
+        see BookRecommender.get_recommendations; raises if a shard fails
+        (OSError / RuntimeError), an empty list would read as "every book
+        is rated" and be cached as such
+        """
+        # ratings and profile of the same write
+        ratings, profile = self.recommender.load_snapshot()
+
+        if profile['total_ratings'] == 0:
+            recommendations = self._popular(ratings, top_n, seed, stratify_genres)
+        else:
+            request = {
+                'profile': profile,
+                'exclude': list(ratings),
+                'weights': self.recommender.weights,
+                'with_breakdown': with_breakdown,
+            }
+            if diversity > 0:
+                size = max(candidate_pool, top_n)
+                unrated, ranked = self._ranked(dict(request, per_tuple=top_n), size)
+                if unrated > top_n:
+                    pool = self.recommender._candidate_pool(ranked, size, top_n)
+                    ranked = iter(self.recommender._rerank_mmr(pool, top_n, diversity))
+                else:
+                    # nothing to re-rank: plain order, without the cap
+                    _, ranked = self._ranked(request, top_n)
+            else:
+                _, ranked = self._ranked(request, top_n)
+            recommendations = [(book, score, breakdown) for book, score, breakdown, _ in islice(ranked, top_n)]
+
+        if with_breakdown:
+            return recommendations
+        return [(book, score) for book, score, _ in recommendations]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for transport in self.transports:
+            transport.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="serve one catalog shard over TCP")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--low', type=int, default=None, help="first book id (inclusive)")
+    parser.add_argument('--high', type=int, default=None, help="last book id (exclusive)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7100)
+    args = parser.parse_args()
+
+    print(f"shard [{args.low}, {args.high}) on {args.host}:{args.port}")
+    serve_shard(CatalogShard(args.data_dir, args.low, args.high), args.host, args.port)
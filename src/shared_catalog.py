@@ -0,0 +1,341 @@
+"""
+process-shared catalog
+
+one process publishes the encoded catalog into a single memory-mapped file;
+every worker maps the same file read-only, so the catalog pages live once in
+the OS page cache no matter how many workers attach.
+
+- numeric columns (id, pages, year) and categorical codes (genre, style,
+  length_category, topic) are stored as aligned numpy arrays -> zero-copy views
+- string columns (title, author, description, ...) are stored as an offsets
+  array + one utf-8 blob and decoded only when a book is accessed
+- a search column holds each book's lowercased search text (see
+  CatalogIndex), so text search scans the mapped blob with mmap.find
+- a new generation is written to a temp file and moved over the old one with
+  os.replace, so readers see either the old or the new catalog, never a mix
+
+file layout:
+    MAGIC (8 bytes) | header offset (uint64) | header size (uint64) |
+    data blocks (8-byte aligned) | header (json)
+"""
+import json
+import mmap
+import os
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.catalog_index import CatalogIndex
+
+MAGIC = b'BOOKCAT1'
+_PREFIX_SIZE = 24
+_ALIGN = 8
+
+NUMERIC_FIELDS = {'id': 'int64', 'pages': 'int32', 'year': 'int32'}
+CATEGORICAL_FIELDS = ['genre', 'style', 'length_category', 'topic']
+STRING_FIELDS = ['title', 'author']
+OPTIONAL_STRING_FIELDS = ['description']
+
+_KNOWN_FIELDS = (set(NUMERIC_FIELDS) | set(CATEGORICAL_FIELDS) |
+                 set(STRING_FIELDS) | set(OPTIONAL_STRING_FIELDS))
+
+
+def _encode_strings(values: List[str]):
+    encoded = [v.encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    return offsets, b''.join(encoded)
+
+
+def publish_catalog(books: List[Dict], path, source_version=None) -> int:
+    """
+    encode books and atomically replace the shared catalog file
+
+    source_version: version of books.json the books came from, so readers
+    can tell when books.json was changed without a publish
+    returns the new generation number
+    """
+    path = Path(path)
+
+    generation = 1
+    current = open_shared_catalog(path)
+    if current is not None:
+        generation = current.generation + 1
+        del current
+
+    blocks = []  # (name, bytes)
+
+    for field, dtype in NUMERIC_FIELDS.items():
+        blocks.append((field, np.array([b[field] for b in books], dtype=dtype).tobytes()))
+
+    vocabularies = {}
+    for field in CATEGORICAL_FIELDS:
+        vocabulary = sorted(set(b[field] for b in books))
+        index = {v: i for i, v in enumerate(vocabulary)}
+        codes = np.array([index[b[field]] for b in books], dtype=np.int32)
+        vocabularies[field] = vocabulary
+        blocks.append((field, codes.tobytes()))
+
+    # fields we don't know about are kept as a json string per book
+    extras = [
+        {k: v for k, v in b.items() if k not in _KNOWN_FIELDS}
+        for b in books
+    ]
+    string_columns = {field: [b[field] for b in books] for field in STRING_FIELDS}
+    for field in OPTIONAL_STRING_FIELDS:
+        string_columns[field] = [b.get(field, '') for b in books]
+        present = np.array([field in b for b in books], dtype=np.uint8)
+        blocks.append((f'{field}.present', present.tobytes()))
+    string_columns['_extra'] = [json.dumps(e, ensure_ascii=False) if e else '' for e in extras]
+    string_columns['_search'] = [CatalogIndex._book_text(b) for b in books]
+
+    for field, values in string_columns.items():
+        offsets, blob = _encode_strings(values)
+        blocks.append((f'{field}.offsets', offsets.tobytes()))
+        blocks.append((f'{field}.data', blob))
+
+    header = {
+        'generation': generation,
+        'source_version': list(source_version) if source_version else None,
+        'count': len(books),
+        'blocks': {},
+        'vocabularies': vocabularies,
+        'numeric': NUMERIC_FIELDS,
+    }
+
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * _PREFIX_SIZE)
+        offset = _PREFIX_SIZE
+        for name, data in blocks:
+            header['blocks'][name] = [offset, len(data)]
+            f.write(data)
+            offset += len(data)
+            padding = -offset % _ALIGN
+            f.write(b'\0' * padding)
+            offset += padding
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        f.write(header_bytes)
+        f.seek(0)
+        f.write(MAGIC)
+        f.write(offset.to_bytes(8, 'little'))
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return generation
+
+
+def open_shared_catalog(path) -> Optional['SharedCatalog']:
+    """attach to the current generation, or None if nothing is published"""
+    try:
+        return SharedCatalog(path)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"Error {e} while attaching shared catalog!")
+        return None
+
+
+class SharedCatalog:
+    """
+    read-only, zero-copy view of one published generation
+
+    the mapping stays valid after a newer generation replaces the file
+    (the old inode lives until the last view of it is dropped)
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self.file_id = os.fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:8] != MAGIC:
+            raise ValueError(f"{self.path} is not a shared catalog file")
+
+        header_offset = int.from_bytes(self._mm[8:16], 'little')
+        header_size = int.from_bytes(self._mm[16:24], 'little')
+        header = json.loads(self._mm[header_offset:header_offset + header_size].decode('utf-8'))
+
+        self.generation = header['generation']
+        self.source_version = header.get('source_version')
+        self.count = header['count']
+        self.vocabularies = header['vocabularies']
+        self._blocks = header['blocks']
+
+        # zero-copy column views (np.frombuffer on a read-only mmap is read-only)
+        self.columns = {}
+        for field, dtype in header['numeric'].items():
+            self.columns[field] = self._array(field, dtype)
+        for field in CATEGORICAL_FIELDS:
+            self.columns[field] = self._array(field, 'int32')
+
+        self._strings = {}
+        for name in self._blocks:
+            if name.endswith('.offsets'):
+                field = name[:-len('.offsets')]
+                self._strings[field] = (self._array(name, 'int64'),
+                                        self._blocks[f'{field}.data'][0])
+
+        self._present = {
+            field: self._array(f'{field}.present', 'uint8')
+            for field in OPTIONAL_STRING_FIELDS
+        }
+        self._id_search = None  # (sorted ids, their positions or None)
+
+    def _array(self, name: str, dtype: str) -> np.ndarray:
+        offset, size = self._blocks[name]
+        itemsize = np.dtype(dtype).itemsize
+        return np.frombuffer(self._mm, dtype=dtype, count=size // itemsize, offset=offset)
+
+    def is_current(self) -> bool:
+        """False once a newer generation has replaced the file"""
+        try:
+            return os.stat(self.path).st_ino == self.file_id
+        except FileNotFoundError:
+            return False
+
+    def find(self, book_ids: List[int]) -> Dict[int, int]:
+        """
+        {book_id: position} for the given ids that are in the catalog, by
+        binary search over the id column (no per-book index is built)
+        """
+        if self._id_search is None:
+            ids = self.columns['id']
+            if len(ids) < 2 or bool(np.all(ids[1:] > ids[:-1])):
+                # ids are assigned in increasing order: search the mapped column itself
+                self._id_search = (ids, None)
+            else:
+                order = np.argsort(ids, kind='stable')
+                self._id_search = (ids[order], order)
+        sorted_ids, order = self._id_search
+
+        found = {}
+        at = np.searchsorted(sorted_ids, np.array(book_ids, dtype=np.int64))
+        for book_id, i in zip(book_ids, at):
+            if i < len(sorted_ids) and sorted_ids[i] == book_id:
+                found[book_id] = int(order[i]) if order is not None else int(i)
+        return found
+
+    def string(self, field: str, i: int) -> str:
+        offsets, base = self._strings[field]
+        start, end = int(offsets[i]), int(offsets[i + 1])
+        return self._mm[base + start:base + end].decode('utf-8')
+
+    @property
+    def searchable(self) -> bool:
+        """False for files published before the search column existed"""
+        return '_search' in self._strings
+
+    def text(self, i: int) -> str:
+        """search text of book i (CatalogIndex._book_text)"""
+        if self.searchable:
+            return self.string('_search', i)
+        return CatalogIndex._book_text({
+            'title': self.string('title', i), 'author': self.string('author', i),
+            'genre': self.category('genre', i), 'topic': self.category('topic', i),
+        })
+
+    def search(self, query: str) -> List[int]:
+        """
+        positions of the books whose search text contains `query` (already
+        lowercased), found by mmap.find over the search blob - utf-8 keeps
+        substring matches, and every text ends with a separator the query
+        can't contain, so a match never spans two books
+        """
+        offsets, base = self._strings['_search']
+        needle = query.encode('utf-8')
+        end = base + int(offsets[-1])
+        found = []
+        start = self._mm.find(needle, base, end)
+        while start != -1:
+            i = int(np.searchsorted(offsets, start - base, side='right')) - 1
+            found.append(i)
+            # continue from the next book - one hit per book is enough
+            start = self._mm.find(needle, base + int(offsets[i + 1]), end)
+        return found
+
+    def category(self, field: str, i: int) -> str:
+        return self.vocabularies[field][int(self.columns[field][i])]
+
+    def book(self, i: int) -> Dict:
+        book = {
+            'id': int(self.columns['id'][i]),
+            'title': self.string('title', i),
+            'author': self.string('author', i),
+            'genre': self.category('genre', i),
+            'pages': int(self.columns['pages'][i]),
+            'length_category': self.category('length_category', i),
+            'style': self.category('style', i),
+            'topic': self.category('topic', i),
+            'year': int(self.columns['year'][i]),
+        }
+        for field in OPTIONAL_STRING_FIELDS:
+            if self._present[field][i]:
+                book[field] = self.string(field, i)
+
+        extra = self.string('_extra', i)
+        if extra:
+            book.update(json.loads(extra))
+        return book
+
+    def books(self) -> 'SharedBookList':
+        return SharedBookList(self)
+
+    def positions(self) -> 'SharedPositions':
+        return SharedPositions(self)
+
+    def __len__(self):
+        return self.count
+
+
+class SharedBookList(Sequence):
+    """
+    list-like view of a SharedCatalog; book dicts are built on access and
+    are not kept, so holding the list costs nothing per book
+    """
+    def __init__(self, catalog: SharedCatalog):
+        self.catalog = catalog
+
+    def __len__(self):
+        return self.catalog.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.catalog.book(j) for j in range(*i.indices(self.catalog.count))]
+        if i < 0:
+            i += self.catalog.count
+        if not 0 <= i < self.catalog.count:
+            raise IndexError('book index out of range')
+        return self.catalog.book(i)
+
+    def __iter__(self):
+        for i in range(self.catalog.count):
+            yield self.catalog.book(i)
+
+
+class SharedPositions(Mapping):
+    """
+    {book_id: position} over a SharedCatalog's id column, looked up with
+    find instead of being held as a dict
+    """
+    def __init__(self, catalog: SharedCatalog):
+        self.catalog = catalog
+
+    def __getitem__(self, book_id):
+        if not isinstance(book_id, (int, np.integer)) or isinstance(book_id, bool):
+            raise KeyError(book_id)
+        found = self.catalog.find([book_id])
+        if book_id not in found:
+            raise KeyError(book_id)
+        return found[book_id]
+
+    def __iter__(self):
+        return (int(book_id) for book_id in self.catalog.columns['id'])
+
+    def __len__(self):
+        return self.catalog.count
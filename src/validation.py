@@ -0,0 +1,169 @@
+"""
+batch validation for books and ratings
+
+the whole batch is checked (one pass per check, plain python) before
+anything is saved, and every problem is reported as a structured error
+instead of a printed message:
+
+    {'row': 3, 'field': 'pages', 'code': 'range', 'message': '...'}
+
+used by BookDataManager.add_book / add_books (bulk import),
+BookDataManager.check_integrity (load-time checks) and
+BookRecommender.save_rating.
+"""
+from numbers import Integral, Real
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+REQUIRED_FIELDS = [
+    'title', 'author', 'genre', 'pages',
+    'length_category', 'style', 'topic', 'year'
+]
+STRING_FIELDS = ['title', 'author', 'genre', 'length_category', 'style', 'topic']
+
+VALID_LENGTHS = ['کوتاه', 'متوسط', 'بلند']
+VALID_STYLES = ['ساده', 'آکادمیک', 'شاعرانه']
+
+MIN_RATING = 1
+MAX_RATING = 5
+
+
+class ValidationReport:
+    def __init__(self, total_rows: int):
+        self.total_rows = total_rows
+        self.errors: List[Dict] = []
+
+    def add(self, row: int, field: str, code: str, message: str):
+        self.errors.append({'row': row, 'field': field, 'code': code, 'message': message})
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def invalid_rows(self) -> List[int]:
+        return sorted(set(e['row'] for e in self.errors))
+
+    def valid_rows(self) -> List[int]:
+        invalid = set(e['row'] for e in self.errors)
+        return [i for i in range(self.total_rows) if i not in invalid]
+
+    def by_row(self) -> Dict[int, List[Dict]]:
+        rows = {}
+        for error in self.errors:
+            rows.setdefault(error['row'], []).append(error)
+        return rows
+
+    def print_errors(self):
+        for error in self.errors:
+            print(f"row {error['row']}: {error['message']}")
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, Integral) and not isinstance(value, bool)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+
+def validate_books(books: Sequence[Dict],
+                   existing: Sequence[Dict] = (),
+                   require_id: bool = True) -> ValidationReport:
+    """
+    validate a batch of books
+
+    existing: books already in the catalog, checked for duplicate ids/titles
+    require_id: False for new books whose ids are assigned after validation
+    """
+    report = ValidationReport(len(books))
+
+    # required fields
+    for field in REQUIRED_FIELDS:
+        for row, book in enumerate(books):
+            if field not in book:
+                report.add(row, field, 'missing', f"Field {field} does not exist!")
+
+    # types
+    for field in STRING_FIELDS:
+        for row, book in enumerate(books):
+            if field in book and not (isinstance(book[field], str) and book[field].strip()):
+                report.add(row, field, 'type', f"{field} must be a non-empty string!")
+
+    for row, book in enumerate(books):
+        if 'pages' not in book:
+            continue
+        if not _is_int(book['pages']):
+            report.add(row, 'pages', 'type', "The number of pages must be a positive integer!")
+        elif book['pages'] <= 0:
+            report.add(row, 'pages', 'range', "The number of pages must be a positive integer!")
+
+    for row, book in enumerate(books):
+        if 'year' in book and not _is_int(book['year']):
+            report.add(row, 'year', 'type', "the year value must be an integer number!")
+
+    # enumerations
+    for field, valid in (('length_category', VALID_LENGTHS), ('style', VALID_STYLES)):
+        valid = set(valid)
+        for row, book in enumerate(books):
+            if field in book and book[field] not in valid:
+                report.add(row, field, 'enum', f"the {field} of the book must be one of {sorted(valid)}")
+
+    # duplicate ids
+    ids = [b.get('id') for b in books]
+    seen_ids = {b['id'] for b in existing if 'id' in b}
+    for row, book_id in enumerate(ids):
+        if book_id is None:
+            if require_id:
+                report.add(row, 'id', 'missing', "Field id does not exist!")
+            continue
+        if not _is_int(book_id):
+            report.add(row, 'id', 'type', "id must be an integer!")
+            continue
+        if book_id in seen_ids:
+            report.add(row, 'id', 'duplicate', f"duplicate id {book_id}")
+        seen_ids.add(book_id)
+
+    # duplicate titles (same title + author)
+    seen_titles = {_title_key(b) for b in existing if 'title' in b and 'author' in b}
+    for row, book in enumerate(books):
+        if not isinstance(book.get('title'), str) or not isinstance(book.get('author'), str):
+            continue
+        key = _title_key(book)
+        if key in seen_titles:
+            report.add(row, 'title', 'duplicate', f"duplicate book '{book['title']}' by {book['author']}")
+        seen_titles.add(key)
+
+    report.errors.sort(key=lambda e: e['row'])
+    return report
+
+
+def _title_key(book: Dict) -> Tuple[str, str]:
+    return ' '.join(book['title'].split()).casefold(), ' '.join(book['author'].split()).casefold()
+
+
+def validate_ratings(ratings: Iterable[Tuple[int, float]],
+                     known_ids: Optional[Iterable[int]] = None) -> ValidationReport:
+    """
+    validate (book_id, rating) pairs; known_ids = ids in the catalog
+    (None skips the "book exists" check)
+    """
+    ratings = list(ratings)
+    report = ValidationReport(len(ratings))
+
+    for row, (book_id, _) in enumerate(ratings):
+        if not _is_int(book_id):
+            report.add(row, 'book_id', 'type', "book id must be an integer!")
+
+    for row, (_, rating) in enumerate(ratings):
+        if not _is_number(rating):
+            report.add(row, 'rating', 'type', "rate must be a number!")
+        elif not MIN_RATING <= rating <= MAX_RATING:  # also catches nan
+            report.add(row, 'rating', 'range', f"rate must be between {MIN_RATING} and {MAX_RATING}")
+
+    if known_ids is not None:
+        known_ids = known_ids if isinstance(known_ids, (set, frozenset, dict)) else set(known_ids)
+        for row, (book_id, _) in enumerate(ratings):
+            if _is_int(book_id) and book_id not in known_ids:
+                report.add(row, 'book_id', 'unknown_book', f"book {book_id} does not exist!")
+
+    report.errors.sort(key=lambda e: e['row'])
+    return report